@@ -1,19 +1,22 @@
 import logging
-from logging.handlers import SMTPHandler, RotatingFileHandler
+from logging.handlers import RotatingFileHandler
 
 import os
 from flask import Flask
 from config import Config
-from flask_sqlalchemy import SQLAlchemy
 from flask_mail import Mail
 from flask_migrate import Migrate
 from flask_login import LoginManager
 
+from app.replicas import RoutingSQLAlchemy
+from app.logqueue import ThrottledSMTPHandler, JSONFormatter, BatchingHandler, start_queue_logging
+
 
 app = Flask(__name__)
 app.config.from_object(Config)
 mail = Mail(app)
-db = SQLAlchemy(app)
+# Reads of the views marked @read_only may go to replicas, see app.replicas.
+db = RoutingSQLAlchemy(app)
 migrate = Migrate(app, db)
 login = LoginManager(app)
 
@@ -25,15 +28,40 @@ login.login_view = 'signin2'
 # The app package is defined by the app directory and the __init__.py script.
 # The routes module needs to import the app variable just declared, so it is
 # imported at bottom to avoid circular imports.
-from . import routes, models, errors
+from . import routes, models, errors, api
+from .catalog import level_catalog
+from .fragments import FragmentCacheExtension
+from .assets import BundleExtension
+from .querywatch import query_watch
+
+# Templates read levels from the in-memory catalog, e.g.
+# level_catalog.get(user.level_id), instead of querying them.
+app.jinja_env.globals['level_catalog'] = level_catalog
+
+# The layout blocks of production/base.html are wrapped in {% cache %} tags.
+app.jinja_env.add_extension(FragmentCacheExtension)
+# Groups of <link>/<script> tags are wrapped in {% bundle %} tags, which point
+# at the files built by `flask assets build` once there are any.
+app.jinja_env.add_extension(BundleExtension)
+
+# With QUERY_WATCH_ENABLED set, N+1 patterns and slow statements of every
+# request are logged by query_watch.
 
 
 if not app.debug:
+    # None of the handlers below is attached to app.logger directly: they run
+    # on a listener thread fed through a bounded queue (see app.logqueue), so
+    # logging never adds latency to a request, not even an error that has to
+    # be mailed. When the queue is full, records are dropped rather than
+    # waited for.
+    handlers = []
+
     # Setting up the email logger is somewhat tedious due to having to handle
     # optional security options that are present in many email servers. But in
     # essence, the code below creates a SMTPHandler instance, sets its level so that
-    # it only reports errors and not warnings, informational or debugging messages,
-    # and finally attaches it to the app.logger object from Flask.
+    # it only reports errors and not warnings, informational or debugging messages.
+    # Repeated errors from the same place are only mailed once per
+    # LOG_MAIL_DEDUP_WINDOW, and at most LOG_MAIL_MAX_PER_HOUR mails go out.
     if app.config['MAIL_SERVER']:
         auth = None
         if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
@@ -41,25 +69,34 @@ if not app.debug:
         secure = None
         if app.config['MAIL_USE_TLS']:
             secure = ()
-        mail_handler = SMTPHandler(
+        mail_handler = ThrottledSMTPHandler(
             mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
             fromaddr=f'no-reply@{app.config["MAIL_SERVER"]}',
             toaddrs=app.config['ADMINS'],
             subject='ModernFlask Failure',
             credentials=auth,
-            secure=secure)
+            secure=secure,
+            dedup_window=app.config['LOG_MAIL_DEDUP_WINDOW'],
+            max_per_window=app.config['LOG_MAIL_MAX_PER_HOUR'],
+            rate_window=3600)
         mail_handler.setLevel(logging.ERROR)
-        app.logger.addHandler(mail_handler)
+        handlers.append(mail_handler)
 
     # There are some failure conditions that do not end in a Python exception
     # and are not a major problem, but they may still be interesting enough to
-    # save for debugging purposes. So we have a log file for the application.
+    # save for debugging purposes. So we have a log file for the application,
+    # with one JSON object per line, written in batches.
     if not os.path.exists('logs'):
         os.mkdir('logs')
-    file_handler = RotatingFileHandler(filename='logs/modern_flask.log', maxBytes=10240, backupCount=5)
-    file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
-    file_handler.setLevel(logging.INFO)
-    app.logger.addHandler(file_handler)
+    file_handler = RotatingFileHandler(filename='logs/modern_flask.log',
+                                       maxBytes=app.config['LOG_FILE_MAX_BYTES'], backupCount=5)
+    file_handler.setFormatter(JSONFormatter())
+    batch_handler = BatchingHandler(capacity=app.config['LOG_BATCH_SIZE'], target=file_handler,
+                                    interval=app.config['LOG_BATCH_INTERVAL'])
+    batch_handler.setLevel(logging.INFO)
+    handlers.append(batch_handler)
+
+    start_queue_logging(app.logger, handlers, maxsize=app.config['LOG_QUEUE_SIZE'])
 
     # To make the logging more useful, we lower the logging level to the INFO
     # category, both in the application logger and the file logger handler.
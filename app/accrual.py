@@ -0,0 +1,118 @@
+from datetime import datetime
+from time import time, perf_counter
+
+from sqlalchemy import func, select, cast, literal, Integer
+
+from app import app, db
+from app.events import events
+from app.models import User, Level, CreditEntry, user_cache
+
+
+class AccrualReport(object):
+
+    def __init__(self, period, users, seconds):
+        self.period = period
+        self.users = users
+        self.seconds = seconds
+
+    @property
+    def rate(self):
+        return self.users / self.seconds if self.seconds else 0.0
+
+    def __repr__(self):
+        return f'<AccrualReport period={self.period} users={self.users} {self.rate:.0f} users/s>'
+
+
+def current_period(now=None, length=None):
+    """
+    Returns the index of the accrual period containing `now`, counted from the
+    epoch in steps of ACCRUAL_PERIOD seconds.
+    """
+    length = length or app.config['ACCRUAL_PERIOD']
+    return int((now if now is not None else time()) // length)
+
+
+def accrual_amount(level):
+    """Credits earned by one user of a level in one accrual period."""
+    return cast(func.coalesce(level.c.earning_rate, 0) * func.coalesce(level.c.hash_rate, 0), Integer)
+
+
+def accrue(period=None, chunk_size=None):
+    """
+    Credits every user for the accrual periods they have not been paid for.
+
+    Each user row remembers the last period it was credited for in
+    `accrued_period`, and the UPDATE only touches rows behind the target
+    period, so running the same tick twice is a no-op and a missed tick is
+    caught up on the next one by crediting all elapsed periods at once. Users
+    never accrued before are credited for a single period.
+
+    The work is one set-based INSERT ... SELECT into the credit ledger and one
+    UPDATE looking up the level table per chunk of ACCRUAL_CHUNK_SIZE user
+    ids, each chunk in its own transaction so that locks stay short; a crash
+    midway leaves the finished chunks marked and the next tick completes the
+    rest. The rows of a chunk are locked (SELECT ... FOR UPDATE) before the
+    ledger is written: a concurrent run waits for the chunk, then finds it
+    accrued and credits nobody twice. SQLite takes its write lock with the
+    first INSERT, which serializes the runs the same way. The ledger allows a
+    single 'accrual <period>' entry per user besides.
+
+    :param period: the period to accrue up to, defaults to the current one
+    :param chunk_size: the number of user ids covered by one UPDATE
+    :return: an AccrualReport
+    """
+    period = period if period is not None else current_period()
+    chunk_size = chunk_size or app.config['ACCRUAL_CHUNK_SIZE']
+    user = User.__table__
+    level = Level.__table__
+    ledger = CreditEntry.__table__
+    reason = literal(f'accrual {period}')
+
+    elapsed = period - func.coalesce(user.c.accrued_period, period - 1)
+    behind = func.coalesce(user.c.accrued_period, period - 1) < period
+
+    started = perf_counter()
+    processed = 0
+    low, high = db.session.query(func.min(user.c.id), func.max(user.c.id)).one()
+    if low is None:
+        return AccrualReport(period, 0, 0.0)
+
+    for first in range(low, high + 1, chunk_size):
+        in_chunk = user.c.id.between(first, first + chunk_size - 1)
+        # Ignored by SQLite, which has no row locks.
+        db.session.execute(select([user.c.id]).where(in_chunk & behind).order_by(user.c.id).with_for_update())
+        earned = accrual_amount(level) * elapsed
+        # Stamped per chunk: the rollups rely on entries being about as old
+        # as their ids, see app.rollup._horizon().
+        now = literal(datetime.utcnow())
+        entries = select([user.c.id, earned, reason, now]) \
+            .select_from(user.join(level, user.c.level_id == level.c.id)) \
+            .where(in_chunk & behind & (earned != 0))
+        db.session.execute(ledger.insert().from_select(['user_id', 'delta', 'reason', 'timestamp'], entries))
+        # The level is looked up with a correlated subquery rather than an
+        # UPDATE ... FROM join, which SQLite before 3.33 lacks and which would
+        # skip users without a level: those are marked accrued as well, for
+        # nothing, so that they are not behind forever.
+        amount = select([accrual_amount(level)]).where(level.c.id == user.c.level_id).as_scalar()
+        stmt = user.update().where(in_chunk & behind) \
+            .values(credit=func.coalesce(user.c.credit, 0) + func.coalesce(amount, 0) * elapsed,
+                    accrued_period=period)
+        result = db.session.execute(stmt)
+        db.session.commit()
+        processed += result.rowcount
+
+    # The rows were changed behind the ORM's back, so cached snapshots of
+    # this worker are stale. Other workers catch up when their entries expire.
+    user_cache.clear()
+
+    # One event for everybody rather than one per user, and only when some
+    # balance changed: users catching up were credited several periods at
+    # once, so the dashboards reload their balance instead of adding an
+    # amount.
+    if processed:
+        events.publish(None, 'accrual', {'period': period})
+
+    report = AccrualReport(period, processed, perf_counter() - started)
+    app.logger.info(f'Accrued period {period} for {report.users} users '
+                    f'in {report.seconds:.2f}s ({report.rate:.0f} users/s)')
+    return report
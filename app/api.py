@@ -0,0 +1,81 @@
+from flask import g, request, jsonify
+
+from app import app
+from app.history import activity_page
+from app.models import User, Rollup
+from app.passwords import PasswordBusy
+from app.replicas import read_only
+from app.rollup import series, GRANULARITIES
+from app.tokens import token_auth, token_required, TokenError
+
+###
+# JSON API, authenticated with the bearer tokens of app.tokens
+###
+
+
+def _error(message, status):
+    response = jsonify({'error': message})
+    response.status_code = status
+    return response
+
+
+@app.route('/api/tokens', methods=['POST'])
+def api_tokens():
+    # Credentials as JSON or as a form.
+    data = request.get_json(silent=True) or request.form
+    user = User.query.filter_by(username=data.get('username')).first()
+    try:
+        valid = user is not None and user.check_password(data.get('password') or '')
+    except PasswordBusy:
+        return _error('Too many sign-ins right now, try again in a moment', 503)
+    if not valid:
+        return _error('Invalid username or password', 401)
+    return jsonify(token_auth.issue(user))
+
+
+@app.route('/api/tokens/refresh', methods=['POST'])
+def api_refresh_token():
+    data = request.get_json(silent=True) or request.form
+    try:
+        return jsonify(token_auth.refresh(data.get('refresh_token') or ''))
+    except TokenError as e:
+        return _error(str(e), 401)
+
+
+@app.route('/api/tokens/revoke', methods=['POST'])
+@token_required
+def api_revoke_token():
+    # Revokes the access token of the request, and the refresh token given
+    # with it if any: a sign-out.
+    token_auth.revocations.revoke(g.token_identity.claims)
+    data = request.get_json(silent=True) or request.form
+    if data.get('refresh_token'):
+        try:
+            claims = token_auth.decode(data['refresh_token'], 'refresh')
+        except TokenError:
+            claims = None
+        if claims is not None and claims['uid'] == g.token_identity.id:
+            token_auth.revocations.revoke(claims)
+    return jsonify({'revoked': True})
+
+
+@app.route('/api/stats/series.json')
+@token_required
+@read_only
+def api_stats_series():
+    user_id = Rollup.GLOBAL if request.args.get('scope') == 'global' else g.token_identity.id
+    granularity = request.args.get('granularity')
+    if granularity not in GRANULARITIES:
+        granularity = 'hour'
+    return jsonify({
+        'granularity': granularity,
+        'series': series(user_id, granularity, request.args.get('points', type=int)),
+    })
+
+
+@app.route('/api/history/activities.json')
+@token_required
+@read_only
+def api_history_activities():
+    return jsonify(activity_page(g.token_identity.id, request.args.get('cursor'),
+                                 request.args.get('limit', type=int)))
@@ -0,0 +1,278 @@
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+from mimetypes import guess_type
+from time import monotonic
+
+from flask import request, send_file, safe_join, abort, url_for
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from app import app
+from app.fragments import fragment_cache
+
+# Optional, `pip install rjsmin rcssmin brotli`: without the minifiers the
+# bundles are only concatenated (with comments and blank space stripped from
+# the CSS), and without brotli no .br variants are written.
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+BUNDLE_BLOCK = re.compile(r'{%-?\s*bundle\s+["\']([^"\']+)["\']\s*-?%}(.*?){%-?\s*endbundle\s*-?%}', re.S)
+STATIC_REFERENCE = re.compile(r'url_for\(\s*["\']static["\']\s*,\s*filename\s*=\s*["\']([^"\']+)["\']\s*\)')
+COMMENTS = re.compile(r'{#.*?#}|<!--.*?-->', re.S)
+CSS_URL = re.compile(r'url\(\s*(["\']?)([^"\')]+)\1\s*\)')
+CSS_COMMENT = re.compile(r'/\*.*?\*/', re.S)
+
+
+class MissingAssets(Exception):
+    """Raised by a build when templates reference static files that do not exist."""
+
+    def __init__(self, missing):
+        super(MissingAssets, self).__init__(', '.join(f'{name}: {filename}' for name, filename in missing))
+        self.missing = missing
+
+
+class Assets(object):
+    """
+    Bundled, content-hashed static assets.
+
+    Templates wrap groups of <link>/<script> tags in {% bundle "name.css" %}
+    ... {% endbundle %}. `flask assets build` traces the static files these
+    blocks reference, concatenates and minifies each group into one file of
+    ASSETS_DIR named after the hash of its content, writes .gz and .br
+    variants next to it, and records the names in manifest.json. Once a
+    manifest exists, every bundle block renders as a single tag pointing at
+    the hashed file; without one (or with ASSETS_BUNDLED off) the original
+    tags are rendered, which is handier while working on the sources.
+
+    Hashed files never change, so they are served with a one year
+    Cache-Control, picking the precompressed variant the client accepts.
+
+    A build on a live deploy replaces manifest.json; each worker notices
+    within a second, reloads it and drops the cached fragments that embed
+    the old tags. The files of the previous build are kept, for the pages
+    already rendered with them.
+    """
+
+    CHECK_INTERVAL = 1
+
+    def __init__(self, app=None):
+        self.manifest = {}
+        self._mtime = None
+        self._checked = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config['ASSETS_BUNDLED']
+        self.directory = app.config['ASSETS_DIR']
+        self.max_age = app.config['ASSETS_MAX_AGE']
+        self.load()
+        app.before_request(self.check)
+
+    def load(self):
+        path = os.path.join(self.directory, 'manifest.json')
+        try:
+            self._mtime = os.stat(path).st_mtime
+            with open(path) as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self._mtime = None
+            self.manifest = {}
+
+    def check(self):
+        """Reloads the manifest if a build replaced it."""
+        if monotonic() - self._checked < self.CHECK_INTERVAL:
+            return
+        self._checked = monotonic()
+        try:
+            mtime = os.stat(os.path.join(self.directory, 'manifest.json')).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self._mtime:
+            self.load()
+            # The stylesheet and script fragments hold the old tags.
+            fragment_cache.clear()
+
+    def url(self, name):
+        """:return: the URL of the hashed file of a bundle, or None if not built"""
+        if not self.enabled or name not in self.manifest:
+            return None
+        return url_for('asset', filename=self.manifest[name])
+
+    def send(self, filename):
+        path = safe_join(self.directory, filename)
+        if filename == 'manifest.json' or not os.path.isfile(path):
+            abort(404)
+        mimetype = guess_type(filename)[0]
+        encoding = None
+        for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if candidate in request.accept_encodings and os.path.isfile(path + suffix):
+                encoding, path = candidate, path + suffix
+                break
+        response = send_file(path, mimetype=mimetype, conditional=True, cache_timeout=self.max_age)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = f'public, max-age={self.max_age}, immutable'
+        return response
+
+    def trace(self):
+        """
+        Finds the bundle blocks of all templates.
+
+        :return: a dict of bundle name to the list of static files it references, in order
+        """
+        bundles = {}
+        for template in self.app.jinja_env.list_templates(extensions=['html']):
+            source = self.app.jinja_env.loader.get_source(self.app.jinja_env, template)[0]
+            for name, body in BUNDLE_BLOCK.findall(source):
+                files = bundles.setdefault(name, [])
+                for filename in STATIC_REFERENCE.findall(COMMENTS.sub('', body)):
+                    if filename not in files:
+                        files.append(filename)
+        return bundles
+
+    def build(self, log=print, allow_missing=False):
+        """
+        Builds every traced bundle and writes a new manifest.
+
+        Files referenced by the templates but missing from the static folder
+        fail the build before anything is written: in one bundle, the first
+        script that goes missing breaks every script after it. With
+        `allow_missing` they are reported and left out instead. Hashed files
+        used by neither the new manifest nor the one it replaces are removed.
+
+        :param log: called with one line of progress at a time
+        :param allow_missing: whether to build without the missing files
+        :return: the new manifest
+        :raise MissingAssets: if files are missing and not allowed to be
+        """
+        bundles = sorted(self.trace().items())
+        missing = [(name, filename) for name, files in bundles for filename in files
+                   if self._source(filename) is None]
+        if missing and not allow_missing:
+            raise MissingAssets(missing)
+
+        os.makedirs(self.directory, exist_ok=True)
+        manifest = {}
+        for name, files in bundles:
+            kind = os.path.splitext(name)[1]
+            parts = []
+            for filename in files:
+                path = self._source(filename)
+                if path is None:
+                    log(f'  {name}: missing {filename}, skipped')
+                    continue
+                with open(path, encoding='utf-8-sig') as f:
+                    text = f.read()
+                parts.append(self._css(text, filename) if kind == '.css' else self._js(text, filename))
+            content = ('\n' if kind == '.css' else '\n;\n').join(parts).encode('utf-8')
+            digest = hashlib.sha256(content).hexdigest()[:12]
+            stem = os.path.splitext(name)[0]
+            hashed = f'{stem}.{digest}{kind}'
+            path = os.path.join(self.directory, hashed)
+            with open(path, 'wb') as f:
+                f.write(content)
+            with open(path + '.gz', 'wb') as f:
+                f.write(gzip.compress(content, 9))
+            sizes = f'{len(content)} B, gzip {os.path.getsize(path + ".gz")} B'
+            if brotli is not None:
+                with open(path + '.br', 'wb') as f:
+                    f.write(brotli.compress(content))
+                sizes += f', brotli {os.path.getsize(path + ".br")} B'
+            manifest[name] = hashed
+            log(f'  {name}: {len(parts)} files -> {hashed} ({sizes})')
+        path = os.path.join(self.directory, 'manifest.json')
+        try:
+            with open(path) as f:
+                previous = json.load(f)
+        except (FileNotFoundError, ValueError):
+            previous = {}
+        # Replaced in one step, so that a worker never reads half a manifest.
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(path + '.tmp', path)
+        # The workers switch to the new files within a second, and the pages
+        # they rendered before still point at the previous ones.
+        keep = {'manifest.json'}
+        for hashed in list(manifest.values()) + list(previous.values()):
+            keep.update((hashed, hashed + '.gz', hashed + '.br'))
+        for filename in os.listdir(self.directory):
+            if filename not in keep:
+                os.remove(os.path.join(self.directory, filename))
+        self.load()
+        return manifest
+
+    def _source(self, filename):
+        """:return: the path of a file of the static folder, or None if there is no such file"""
+        path = safe_join(self.app.static_folder, filename)
+        return path if path is not None and os.path.isfile(path) else None
+
+    def _css(self, text, filename):
+        # url() references are relative to the original file, which the bundle
+        # is not next to; point them at the static folder instead.
+        base = posixpath.dirname(filename)
+
+        def rebase(match):
+            quote, target = match.groups()
+            if target.startswith(('data:', '#', '/')) or '//' in target:
+                return match.group(0)
+            path = posixpath.normpath(posixpath.join(base, target))
+            return f'url({quote}{self.app.static_url_path}/{path}{quote})'
+
+        text = re.sub(r'@charset\s+["\'][^"\']*["\']\s*;', '', CSS_URL.sub(rebase, text))
+        if rcssmin is not None:
+            return rcssmin.cssmin(text)
+        return re.sub(r'\s*\n\s*', '\n', CSS_COMMENT.sub('', text)).strip()
+
+    def _js(self, text, filename):
+        if rjsmin is not None and not filename.endswith('.min.js'):
+            return rjsmin.jsmin(text)
+        return text
+
+
+assets = Assets(app)
+
+
+class BundleExtension(Extension):
+    """
+    Adds the {% bundle "name" %} tag, see Assets.
+
+        {% bundle "base.js" %}
+        <script src="{{ url_for('static', filename='vendors/...') }}"></script>
+        ...
+        {% endbundle %}
+    """
+
+    tags = {'bundle'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        name = parser.parse_expression()
+        body = parser.parse_statements(['name:endbundle'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', [name]), [], [], body).set_lineno(lineno)
+
+    def _render(self, name, caller):
+        url = assets.url(name)
+        if url is None:
+            return caller()
+        if name.endswith('.css'):
+            return Markup('<link rel="stylesheet" href="%s">') % url
+        return Markup('<script src="%s"></script>') % url
@@ -0,0 +1,245 @@
+import http.cookiejar
+import math
+import platform
+import re
+import subprocess
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from werkzeug.security import generate_password_hash
+
+from app import app, db
+from app.models import User, Level, Activity
+
+BENCH_PREFIX = 'bench'
+BENCH_PASSWORD = 'bench'
+
+# name: (method, path, needs a signed in user, needs a fresh session)
+SCENARIOS = OrderedDict([
+    ('signin', ('POST', '/signin', False, True)),
+    ('home', ('GET', '/home', True, False)),
+    ('history', ('GET', '/history', True, False)),
+    ('history.json', ('GET', '/history/activities.json', True, False)),
+    ('pricing', ('GET', '/pricing', True, False)),
+    ('admin', ('GET', '/admin', True, False)),
+    ('admin.users', ('GET', '/admin/users.json?draw=1&start=0&length=50', True, False)),
+])
+
+
+def seed(users, activities=1000, batch_size=10000, log=print):
+    """
+    Fills the database with `users` benchmark users, bench0 ... benchN.
+
+    They all share one password hash, computed once, so a million users
+    take seconds instead of hours. bench0 is an admin with `activities`
+    activities, which the signed in scenarios run as. Balances are left at
+    zero so that the credit ledger stays consistent.
+    """
+    if not Level.query.count():
+        db.session.add(Level(title='Basic', hash_rate=11, earning_rate=5, profit_rate=1,
+                             affiliate_bonus=0.04, price=10, credit=0))
+        db.session.commit()
+    level_ids = [level.id for level in Level.query.order_by(Level.id)]
+    pwhash = generate_password_hash(BENCH_PASSWORD, method=f'pbkdf2:sha256:{app.config["PASSWORD_HASH_ITERATIONS"]}')
+    now = datetime.utcnow()
+    started = perf_counter()
+    for start in range(0, users, batch_size):
+        db.session.execute(User.__table__.insert(), [
+            {'username': f'{BENCH_PREFIX}{i}', 'email': f'{BENCH_PREFIX}{i}@example.com',
+             'password_hash': pwhash, 'level_id': level_ids[i % len(level_ids)], 'credit': 0,
+             'last_seen': now, 'confirmed': True, 'is_admin': i == 0}
+            for i in range(start, min(start + batch_size, users))])
+        db.session.commit()
+        log(f'  {min(start + batch_size, users)} users')
+    user_id = User.query.filter_by(username=f'{BENCH_PREFIX}0').first().id
+    for start in range(0, activities, batch_size):
+        db.session.execute(Activity.__table__.insert(), [
+            {'user_id': user_id, 'timestamp': now - timedelta(minutes=i), 'notes': f'Benchmark activity {i}'}
+            for i in range(start, min(start + batch_size, activities))])
+        db.session.commit()
+    elapsed = perf_counter() - started
+    log(f'Seeded {users} users and {activities} activities in {elapsed:.1f} s ({users / max(elapsed, 1e-6):.0f} users/s)')
+
+
+def unseed():
+    """Deletes the benchmark users and everything that refers to them."""
+    users = db.select([User.__table__.c.id]).where(User.__table__.c.username.like(f'{BENCH_PREFIX}%'))
+    for table in ('activity', 'credit_entry', 'rollup'):
+        table = db.Model.metadata.tables[table]
+        db.session.execute(table.delete().where(table.c.user_id.in_(users)))
+    db.session.execute(User.__table__.delete().where(User.__table__.c.username.like(f'{BENCH_PREFIX}%')))
+    db.session.commit()
+
+
+class ClientSession(object):
+    """A browser session on the Flask test client, without CSRF tokens."""
+
+    def __init__(self):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        return self.client.open(path, method=method, data=data).status_code
+
+    def prepare_signin(self):
+        return {'username': f'{BENCH_PREFIX}0', 'password': BENCH_PASSWORD}
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HTTPSession(object):
+    """A browser session against a running server, e.g. a local gunicorn."""
+
+    CSRF_TOKEN = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect())
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode('utf-8') if data is not None else None
+        try:
+            with self.opener.open(urllib.request.Request(self.base_url + path, body, method=method)) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def prepare_signin(self):
+        with self.opener.open(self.base_url + '/signin') as response:
+            match = self.CSRF_TOKEN.search(response.read().decode('utf-8'))
+        data = {'username': f'{BENCH_PREFIX}0', 'password': BENCH_PASSWORD}
+        if match:
+            data['csrf_token'] = match.group(1)
+        return data
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def run(scenarios, requests=200, concurrency=1, warmup=10, base_url=None, log=print):
+    """
+    Drives each scenario with `requests` requests spread over `concurrency`
+    threads, each with its own session, after `warmup` untimed ones.
+
+    Without `base_url` the requests go through the Flask test client, in
+    this process; with it, over HTTP to a running server.
+
+    :return: the results, ready to be written as JSON
+    """
+    if base_url is None:
+        app.config['WTF_CSRF_ENABLED'] = False
+
+    def new_session():
+        return HTTPSession(base_url) if base_url else ClientSession()
+
+    def signed_in_session():
+        session = new_session()
+        status = session.request('POST', '/signin', session.prepare_signin())
+        if status != 302:
+            raise RuntimeError(f'Could not sign in as {BENCH_PREFIX}0 (status {status}), run `flask bench seed` first')
+        return session
+
+    results = OrderedDict()
+    for name in scenarios:
+        method, path, signed_in, fresh = SCENARIOS[name]
+
+        def worker(session, count, timings, errors):
+            for _ in range(count):
+                data = None
+                if fresh:
+                    session = new_session()
+                    data = session.prepare_signin()
+                started = perf_counter()
+                status = session.request(method, path, data)
+                elapsed = perf_counter() - started
+                if status >= 400:
+                    errors.append(status)
+                if timings is not None:
+                    timings.append(elapsed)
+
+        # Sessions are opened up front, so that signing in is not timed and
+        # its failure stops the run.
+        sessions = [None if fresh else signed_in_session() if signed_in else new_session()
+                    for _ in range(concurrency)]
+        worker(sessions[0], warmup, None, [])
+        timings, errors = [], []
+        shares = [requests // concurrency + (i < requests % concurrency) for i in range(concurrency)]
+        threads = [threading.Thread(target=worker, args=(session, share, timings, errors))
+                   for session, share in zip(sessions, shares)]
+        started = perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = perf_counter() - started
+
+        timings.sort()
+        results[name] = {
+            'requests': len(timings),
+            'errors': len(errors),
+            'throughput': round(len(timings) / wall, 2),
+            'mean_ms': round(sum(timings) / len(timings) * 1000, 3),
+            'p50_ms': round(percentile(timings, 50) * 1000, 3),
+            'p95_ms': round(percentile(timings, 95) * 1000, 3),
+            'p99_ms': round(percentile(timings, 99) * 1000, 3),
+        }
+        log(f'{name:14s} {results[name]["throughput"]:9.1f} req/s  p50 {results[name]["p50_ms"]:8.2f} ms  '
+            f'p95 {results[name]["p95_ms"]:8.2f} ms  p99 {results[name]["p99_ms"]:8.2f} ms  '
+            f'{results[name]["errors"]} errors')
+
+    return {
+        'meta': {
+            'time': datetime.utcnow().isoformat() + 'Z',
+            'commit': _commit(),
+            'target': base_url or 'test client',
+            'database': db.engine.dialect.name,
+            'users': User.query.count(),
+            'concurrency': concurrency,
+            'python': platform.python_version(),
+        },
+        'scenarios': results,
+    }
+
+
+def compare(baseline, current, threshold=0.1):
+    """
+    Compares two runs scenario by scenario.
+
+    A scenario regressed when its throughput fell, or its p95 or p99 latency
+    rose, by more than `threshold` (a fraction).
+
+    :return: a list of (scenario, metric, before, after, relative change, regressed) tuples
+    """
+    rows = []
+    for name, after in current['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            continue
+        for metric, higher_is_better in (('throughput', True), ('p50_ms', False),
+                                         ('p95_ms', False), ('p99_ms', False)):
+            change = (after[metric] - before[metric]) / before[metric] if before[metric] else 0.0
+            worse = -change if higher_is_better else change
+            regressed = metric != 'p50_ms' and worse > threshold
+            rows.append((name, metric, before[metric], after[metric], change, regressed))
+    return rows
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=app.root_path).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
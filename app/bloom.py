@@ -0,0 +1,134 @@
+import math
+from hashlib import blake2b
+
+from sqlalchemy import select
+
+from app import app, db
+from app.tracking import BackgroundFlusher
+
+
+class BloomFilter(object):
+    """
+    A fixed-size Bloom filter over strings.
+
+    Sized for `capacity` items at a false positive rate of `error_rate`;
+    `x in bloom` may wrongly say yes, but never wrongly says no. The k bit
+    positions come from one blake2b digest split in two (double hashing).
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        digest = blake2b(item.encode('utf-8'), digest_size=16).digest()
+        a = int.from_bytes(digest[:8], 'little')
+        b = int.from_bytes(digest[8:], 'little') | 1
+        return ((a + i * b) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class TakenIdentities(BackgroundFlusher):
+    """
+    Per-worker prefilter of the usernames and emails already registered.
+
+    Availability probes first ask the Bloom filter: a name it has never seen
+    is certainly free and is answered without touching the database, and only
+    possible matches are looked up. The filter is built by a background
+    thread, started by the first probe of the worker, streaming the user
+    table by id; until it is ready every probe is a possible match, so the
+    requests never wait for it. It is then kept in sync by adding each signup
+    as it happens and, every BLOOM_REFRESH_INTERVAL seconds, by loading the
+    users other workers have created since (ids above the highest one seen).
+    When it holds more than BLOOM_CAPACITY users it is rebuilt twice as large
+    next to the one in use.
+
+    Signup validation itself always asks the database; the filter only
+    serves the live "is this taken" checks.
+    """
+
+    thread_name = 'bloom-loader'
+
+    def __init__(self, app=None):
+        self._filter = None
+        self._last_id = 0
+        super(TakenIdentities, self).__init__(app)
+
+    def init_app(self, app):
+        super(TakenIdentities, self).init_app(app)
+        self.capacity = app.config['BLOOM_CAPACITY']
+        self.error_rate = app.config['BLOOM_ERROR_RATE']
+        self.flush_interval = app.config['BLOOM_REFRESH_INTERVAL']
+        self.batch_size = app.config['BLOOM_BATCH_SIZE']
+
+    def might_be_taken(self, kind, value):
+        """
+        :param kind: 'username' or 'email'
+        :return: False if the value is certainly not registered
+        """
+        self._ensure_thread()
+        bloom = self._filter
+        if bloom is None:
+            self.wake()
+            return True
+        return f'{kind}:{value}' in bloom
+
+    def add(self, username, email):
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(f'username:{username}')
+                self._filter.add(f'email:{email}')
+
+    def flush(self):
+        # Two entries per user: the username and the email.
+        if self._filter is None or self._filter.count > 2 * self.capacity:
+            if self._filter is not None:
+                self.capacity *= 2
+            # Built aside, the probes keep using the current filter meanwhile.
+            bloom = BloomFilter(2 * self.capacity, self.error_rate)
+            last_id = self._load(bloom, 0)
+            with self._lock:
+                self._filter, self._last_id = bloom, last_id
+        # Anything created while the filter was being built, or since the
+        # last refresh.
+        self._last_id = self._load(self._filter, self._last_id, self._lock)
+
+    def shutdown(self):
+        # Nothing to write back.
+        self._stop.set()
+        self._wake.set()
+
+    def _load(self, bloom, last_id, lock=None):
+        """Adds the users with ids above `last_id`, and returns the highest id seen."""
+        table = db.Model.metadata.tables['user']
+        with db.get_engine(self.app).connect() as connection:
+            while True:
+                rows = connection.execute(
+                    select([table.c.id, table.c.username, table.c.email])
+                    .where(table.c.id > last_id)
+                    .order_by(table.c.id).limit(self.batch_size)).fetchall()
+                if lock is not None:
+                    lock.acquire()
+                try:
+                    for id, username, email in rows:
+                        bloom.add(f'username:{username}')
+                        bloom.add(f'email:{email}')
+                finally:
+                    if lock is not None:
+                        lock.release()
+                if rows:
+                    last_id = rows[-1][0]
+                if len(rows) < self.batch_size:
+                    return last_id
+
+
+taken_identities = TakenIdentities(app)
@@ -0,0 +1,352 @@
+import csv
+import gzip
+import io
+import itertools
+import json
+import os
+import sys
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
+from time import perf_counter
+
+from sqlalchemy import MetaData, Table, Column, Integer, String, Boolean, DateTime, select, text, and_
+from werkzeug.security import generate_password_hash
+
+from app import app, db
+from app.models import User, Level, Activity
+from app.partitions import partitions, month_table, add_months
+
+# The columns exported, and understood on import along with `password` for
+# passwords still in plain text. The ids are not kept: the users get new ones.
+USER_FIELDS = ('username', 'email', 'display_name', 'password_hash', 'level_id', 'credit',
+               'confirmed', 'is_admin', 'last_seen')
+DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S',
+                    '%Y-%m-%d')
+COLUMNS = ', '.join(USER_FIELDS)
+
+# The columns of the admin exports, without the password hashes.
+EXPORT_FIELDS = {
+    'users': ('id', 'username', 'display_name', 'email', 'level_id', 'credit', 'confirmed', 'is_admin',
+              'last_seen'),
+    'contracts': ('id', 'title', 'hash_rate', 'earning_rate', 'profit_rate', 'affiliate_bonus', 'price',
+                  'credit'),
+    'activities': ('id', 'user_id', 'username', 'level_id', 'timestamp', 'notes'),
+}
+
+# Chunks are first loaded into this temporary table, then inserted in one
+# statement that skips the usernames and emails already taken and opens a
+# ledger entry for the credit of every user it creates (see apply_credits).
+STAGING = Table('user_import', MetaData(),
+                Column('username', String(64)),
+                Column('email', String(120)),
+                Column('display_name', String(64)),
+                Column('password_hash', String(128)),
+                Column('level_id', Integer),
+                Column('credit', Integer),
+                Column('confirmed', Boolean),
+                Column('is_admin', Boolean),
+                Column('last_seen', DateTime),
+                prefixes=['TEMPORARY'])
+
+POSTGRES_INSERT = text(
+    f'WITH inserted AS ('
+    f'INSERT INTO "user" ({COLUMNS}) SELECT {COLUMNS} FROM user_import '
+    f'ON CONFLICT DO NOTHING RETURNING id, credit'
+    f'), ledger AS ('
+    f"INSERT INTO credit_entry (user_id, delta, reason, timestamp) "
+    f"SELECT id, credit, 'import', :now FROM inserted WHERE credit <> 0"
+    f') SELECT count(*) FROM inserted')
+# The WHERE clause tells SQLite's parser the ON CONFLICT is not a join constraint.
+INSERT = text(f'INSERT INTO "user" ({COLUMNS}) SELECT {COLUMNS} FROM user_import WHERE 1 ON CONFLICT DO NOTHING')
+LEDGER = text(
+    "INSERT INTO credit_entry (user_id, delta, reason, timestamp) "
+    "SELECT u.id, i.credit, 'import', :now FROM user_import i JOIN \"user\" u ON u.username = i.username "
+    "WHERE u.id > :before AND i.credit <> 0")
+
+
+class ImportReport(object):
+
+    def __init__(self):
+        self.read = 0
+        self.invalid = 0
+        self.inserted = 0
+        self.started = perf_counter()
+
+    @property
+    def skipped(self):
+        return self.read - self.invalid - self.inserted
+
+    @property
+    def rate(self):
+        return self.read / max(perf_counter() - self.started, 1e-6)
+
+
+def format_of(path, fmt=None):
+    """:return: fmt, or 'csv' or 'jsonl' after the extension of path"""
+    if fmt:
+        return fmt
+    name = path[:-3] if path.endswith('.gz') else path
+    return 'csv' if name.endswith('.csv') else 'jsonl'
+
+
+def open_file(path, mode):
+    """Opens a text file for 'r' or 'w', '-' meaning stdin or stdout and *.gz gzipped."""
+    if path == '-':
+        stream = sys.stdin if mode == 'r' else sys.stdout
+        return open(stream.fileno(), mode, encoding='utf-8', newline='', closefd=False)
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8', newline='')
+    return open(path, mode, encoding='utf-8', newline='')
+
+
+def read_records(f, fmt):
+    """Yields the records of a CSV (with a header) or JSON lines file as dicts."""
+    if fmt == 'csv':
+        yield from csv.DictReader(f)
+        return
+    for line in f:
+        if line.strip():
+            yield json.loads(line)
+
+
+class _Echo(object):
+    # Lets csv.writer hand back the lines instead of writing them.
+    def write(self, value):
+        return value
+
+
+def serialize(rows, fields, fmt):
+    """Yields the rows as CSV lines, after a header, or as JSON lines."""
+    if fmt == 'csv':
+        writer = csv.writer(_Echo())
+        yield writer.writerow(fields)
+        for row in rows:
+            yield writer.writerow([_plain(value) for value in row])
+        return
+    for row in rows:
+        yield json.dumps(dict(zip(fields, map(_plain, row)))) + '\n'
+
+
+def gzipped(chunks, level=6):
+    """Compresses an iterable of strings on the fly into gzip blocks."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        block = compressor.compress(chunk.encode('utf-8'))
+        if block:
+            yield block
+    yield compressor.flush()
+
+
+def stream(statement, batch_size=None, engine=None):
+    """
+    Yields the rows of a SELECT from a server-side cursor on PostgreSQL, so
+    that only `batch_size` of them are held in memory at a time.
+    """
+    batch_size = batch_size or app.config['BULK_CHUNK_SIZE']
+    with (engine or db.engine).connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(statement)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+
+
+def export_users(f, fmt='jsonl', batch_size=None, log=print):
+    """
+    Writes every user to f, ordered by id, in constant memory.
+
+    :return: the number of users written
+    """
+    batch_size = batch_size or app.config['BULK_CHUNK_SIZE']
+    user = User.__table__
+    started = perf_counter()
+    count = 0
+
+    def progress(rows):
+        nonlocal count
+        for row in rows:
+            count += 1
+            if count % batch_size == 0:
+                log(f'  {count} users ({count / (perf_counter() - started):.0f} rows/s)')
+            yield row
+
+    rows = stream(select([user.c[name] for name in USER_FIELDS]).order_by(user.c.id), batch_size)
+    for line in serialize(progress(rows), USER_FIELDS, fmt):
+        f.write(line)
+    return count
+
+
+def export_rows(name, level_ids=(), since=None, until=None, engine=None):
+    """
+    The rows of an admin export, streamed in constant memory.
+
+    Users are filtered on their level and when they were last seen,
+    activities on the level of their user and their timestamp; the
+    contracts are not filtered. On SQLite the past months moved out of the
+    activity table (see app.partitions) are read too, oldest first.
+
+    :param name: a key of EXPORT_FIELDS
+    :param level_ids: the levels to keep, all of them when empty
+    :param since: the first day to keep
+    :param until: the last day to keep
+    :return: an iterator of rows with the EXPORT_FIELDS of `name`
+    """
+    if name == 'contracts':
+        level = Level.__table__
+        return stream(select([level.c[field] for field in EXPORT_FIELDS[name]]).order_by(level.c.id), engine=engine)
+
+    user = User.__table__
+    if name == 'users':
+        clauses = _window(user.c.last_seen, since, until)
+        if level_ids:
+            clauses.append(user.c.level_id.in_(level_ids))
+        return stream(select([user.c[field] for field in EXPORT_FIELDS[name]])
+                      .where(and_(*clauses)).order_by(user.c.id), engine=engine)
+
+    sources = [Activity.__table__]
+    if (engine or db.engine).dialect.name == 'sqlite':
+        with (engine or db.engine).connect() as connection:
+            sources[:0] = [month_table(table) for month, table in reversed(partitions(connection))
+                           if (since is None or add_months(month, 1) > since)
+                           and (until is None or month < until + timedelta(days=1))]
+    return itertools.chain.from_iterable(_activities(table, user, level_ids, since, until, engine) for table in sources)
+
+
+def _activities(table, user, level_ids, since, until, engine):
+    clauses = _window(table.c.timestamp, since, until)
+    if level_ids:
+        clauses.append(user.c.level_id.in_(level_ids))
+    statement = select([table.c.id, table.c.user_id, user.c.username, user.c.level_id, table.c.timestamp,
+                        table.c.notes]) \
+        .select_from(table.outerjoin(user, user.c.id == table.c.user_id)) \
+        .where(and_(*clauses)).order_by(table.c.id)
+    return stream(statement, engine=engine)
+
+
+def _window(column, since, until):
+    clauses = []
+    if since is not None:
+        clauses.append(column >= since)
+    if until is not None:
+        clauses.append(column < until + timedelta(days=1))
+    return clauses
+
+
+def import_users(records, chunk_size=None, hash_workers=None, log=print):
+    """
+    Creates users from dicts with the USER_FIELDS, in chunks of `chunk_size`.
+
+    Each chunk is loaded into a temporary table, with COPY on PostgreSQL and
+    one executemany INSERT elsewhere, and inserted from there in a single
+    statement, in its own transaction. Users whose username or email is
+    already taken are skipped, so an import may be run again after a
+    failure. Passwords should come hashed, as `password_hash`: plain text
+    ones are hashed with PASSWORD_HASH_ITERATIONS rounds on `hash_workers`
+    processes, which is orders of magnitude slower.
+
+    :param records: an iterable of dicts, see read_records()
+    :return: an ImportReport
+    """
+    chunk_size = chunk_size or app.config['BULK_CHUNK_SIZE']
+    report = ImportReport()
+    now = datetime.utcnow()
+    pool = None
+    method = f'pbkdf2:sha256:{app.config["PASSWORD_HASH_ITERATIONS"]}'
+
+    def hash_passwords(passwords):
+        nonlocal pool
+        if pool is None:
+            pool = ProcessPoolExecutor(hash_workers or os.cpu_count())
+        return pool.map(partial(generate_password_hash, method=method), passwords, chunksize=64)
+
+    chunk = []
+    with db.engine.connect() as connection:
+        STAGING.create(connection, checkfirst=True)
+        try:
+            for record in records:
+                report.read += 1
+                row = _user_row(record, now)
+                if row is None:
+                    report.invalid += 1
+                    continue
+                chunk.append(row)
+                if len(chunk) == chunk_size:
+                    report.inserted += _insert(connection, chunk, hash_passwords, now)
+                    chunk = []
+                    log(f'  {report.read} rows read, {report.inserted} users created ({report.rate:.0f} rows/s)')
+            if chunk:
+                report.inserted += _insert(connection, chunk, hash_passwords, now)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            STAGING.drop(connection)
+    return report
+
+
+def _insert(connection, rows, hash_passwords, now):
+    plain = [row for row in rows if row['password']]
+    if plain:
+        for row, pwhash in zip(plain, hash_passwords([row['password'] for row in plain])):
+            row['password_hash'] = pwhash
+    with connection.begin():
+        connection.execute(STAGING.delete())
+        if connection.dialect.name == 'postgresql':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for row in rows:
+                writer.writerow([row[name] for name in USER_FIELDS])
+            buffer.seek(0)
+            cursor = connection.connection.cursor()
+            cursor.copy_expert(f'COPY user_import ({COLUMNS}) FROM STDIN WITH (FORMAT csv)', buffer)
+            return connection.execute(POSTGRES_INSERT, now=now).scalar()
+        connection.execute(STAGING.insert(), [{name: row[name] for name in USER_FIELDS} for row in rows])
+        before = connection.execute(select([db.func.max(User.__table__.c.id)])).scalar() or 0
+        inserted = connection.execute(INSERT).rowcount
+        connection.execute(LEDGER, now=now, before=before)
+        return inserted
+
+
+def _user_row(record, now):
+    username = (record.get('username') or '').strip()
+    email = (record.get('email') or '').strip()
+    if not username or not email:
+        return None
+    try:
+        return {
+            'username': username,
+            'email': email,
+            'display_name': record.get('display_name') or None,
+            'password_hash': record.get('password_hash') or None,
+            'password': record.get('password') or None,
+            'level_id': int(record.get('level_id') or 1),
+            'credit': int(record.get('credit') or 0),
+            'confirmed': _bool(record.get('confirmed')),
+            'is_admin': _bool(record.get('is_admin')),
+            'last_seen': _datetime(record.get('last_seen')) or now,
+        }
+    except ValueError:
+        return None
+
+
+def _bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value or '').strip().lower() in ('1', 'true', 't', 'yes', 'y')
+
+
+def _datetime(value):
+    if not value:
+        return None
+    for fmt in DATETIME_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    raise ValueError(f'Not a date: {value}')
+
+
+def _plain(value):
+    return value.isoformat() if isinstance(value, datetime) else value
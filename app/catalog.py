@@ -0,0 +1,81 @@
+import threading
+from collections import namedtuple
+from time import monotonic
+from types import MappingProxyType
+
+from sqlalchemy import select
+
+from app import app, db
+from app.replicas import replica_reads
+
+LevelInfo = namedtuple('LevelInfo', ['id', 'title', 'hash_rate', 'earning_rate', 'profit_rate',
+                                     'affiliate_bonus', 'price', 'credit'])
+
+
+class LevelCatalog(object):
+    """
+    Process-wide, immutable copy of the level table.
+
+    Levels are a handful of rows that almost never change, so each worker
+    keeps them in memory as read-only LevelInfo tuples keyed by id. Any write
+    to the level table bumps a version counter in catalog_version (see the
+    mapper events in app.models); at most every LEVEL_CATALOG_CHECK_INTERVAL
+    seconds the counter is read, and the catalog is reloaded when it moved.
+    """
+
+    NAME = 'level'
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._levels = MappingProxyType({})
+        self._version = None
+        self._checked = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.check_interval = app.config['LEVEL_CATALOG_CHECK_INTERVAL']
+
+    def get(self, id):
+        return self.levels.get(id)
+
+    def all(self):
+        return tuple(self.levels[id] for id in sorted(self.levels))
+
+    @property
+    def levels(self):
+        if self._checked is None or monotonic() - self._checked >= self.check_interval:
+            self._refresh()
+        return self._levels
+
+    def expire(self):
+        """Makes the next access check the version counter."""
+        self._checked = None
+
+    def _refresh(self):
+        # A replica that lags only delays the reload until it catches up.
+        with self._lock, replica_reads():
+            if self._checked is not None and monotonic() - self._checked < self.check_interval:
+                return
+            versions = db.Model.metadata.tables['catalog_version']
+            version = db.session.execute(
+                select([versions.c.version]).where(versions.c.name == self.NAME)).scalar()
+            if self._version is None or version != self._version:
+                table = db.Model.metadata.tables['level']
+                rows = db.session.execute(select([table.c[field] for field in LevelInfo._fields]))
+                self._levels = MappingProxyType({row[0]: LevelInfo(*row) for row in rows})
+                self._version = version
+            self._checked = monotonic()
+
+    @staticmethod
+    def bump(connection):
+        """Increments the version counter, on the connection of the flush."""
+        versions = db.Model.metadata.tables['catalog_version']
+        result = connection.execute(
+            versions.update().where(versions.c.name == LevelCatalog.NAME)
+            .values(version=versions.c.version + 1))
+        if not result.rowcount:
+            connection.execute(versions.insert().values(name=LevelCatalog.NAME, version=1))
+
+
+level_catalog = LevelCatalog(app)
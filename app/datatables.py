@@ -0,0 +1,227 @@
+import base64
+import json
+
+from sqlalchemy import and_, or_, func, literal
+
+from app import db
+from app.cache import LRUCache
+
+
+class KeysetTable(object):
+    """
+    Server-side processing backend for datatables.net tables.
+
+    DataTables asks for a page with `start` and `length`, which naively maps
+    to LIMIT/OFFSET and gets slower the further the admin pages. Instead every
+    response carries an opaque `cursor` holding the sort key of its last row,
+    and the page script sends it back when moving to the next page, so the
+    query seeks straight to the first row it needs (keyset pagination). The
+    primary key breaks ties so the order is always total. A request without a
+    cursor, e.g. a jump to an arbitrary page number, falls back to OFFSET.
+
+    Rows are ordered on the bare column, so that its index serves the sort
+    and the seek, with NULLs where the database puts them. The counts only
+    feed the pager, so they are cached for `count_ttl` seconds rather than
+    taken on every draw.
+
+    :param model: the model class whose table is listed
+    :param columns: the column names in the same order as the DataTables columns
+    :param search: a function turning the global search value into a clause
+    :param filters: a dict of column name -> function turning a per-column
+                    search value into a clause, or None to ignore it
+    :param count_ttl: seconds the total and filtered counts are reused
+    """
+
+    MAX_LENGTH = 100
+
+    def __init__(self, model, columns, search=None, filters=None, count_ttl=60):
+        self.model = model
+        self.columns = columns
+        self.search = search
+        self.filters = filters or {}
+        self._counts = LRUCache(maxsize=256, ttl=count_ttl)
+
+    def query(self, args):
+        """
+        Runs one DataTables request.
+
+        :param args: the request arguments (request.args)
+        :return: a dict ready to be jsonify-ed
+        """
+        draw = args.get('draw', 0, type=int)
+        start = max(args.get('start', 0, type=int), 0)
+        length = args.get('length', 10, type=int)
+        if length <= 0 or length > self.MAX_LENGTH:
+            length = self.MAX_LENGTH
+
+        pk = self.model.id
+        column = self.columns[args.get('order[0][column]', 0, type=int) % len(self.columns)]
+        descending = args.get('order[0][dir]') == 'desc'
+        key = getattr(self.model, column)
+
+        clauses = []
+        searched = []
+        value = args.get('search[value]', '').strip()
+        if value and self.search is not None:
+            clauses.append(self.search(value))
+            searched.append((None, value))
+        for index, name in enumerate(self.columns):
+            value = args.get(f'columns[{index}][search][value]', '').strip()
+            if value and name in self.filters:
+                clause = self.filters[name](value)
+                if clause is not None:
+                    clauses.append(clause)
+                    searched.append((name, value))
+
+        total = self._count(())
+        filtered = self._count(tuple(searched), clauses) if clauses else total
+
+        q = db.session.query(*[getattr(self.model, name) for name in self.columns]).filter(*clauses)
+        if descending:
+            q = q.order_by(key.desc(), pk.desc())
+        else:
+            q = q.order_by(key.asc(), pk.asc())
+        cursor = decode_cursor(args.get('cursor'))
+        if cursor is not None:
+            q = q.filter(self._seek(key, pk, cursor, descending))
+        elif start:
+            q = q.offset(start)
+        rows = [dict(zip(self.columns, row)) for row in q.limit(length)]
+
+        next_cursor = None
+        if len(rows) == length:
+            last = rows[-1]
+            next_cursor = encode_cursor(last[column], last['id'])
+        return {
+            'draw': draw,
+            'recordsTotal': total,
+            'recordsFiltered': filtered,
+            'data': rows,
+            'cursor': next_cursor,
+        }
+
+    def _count(self, searched, clauses=()):
+        count = self._counts.get(searched)
+        if count is None:
+            count = db.session.query(func.count(self.model.id)).filter(*clauses).scalar()
+            self._counts.set(searched, count)
+        return count
+
+    @staticmethod
+    def _seek(key, pk, cursor, descending):
+        value, last_id = cursor
+        after = pk < last_id if descending else pk > last_id
+        if key is pk:
+            return after
+        # NULLs compare as unknown, so they get a branch of their own. They
+        # sort after every value on PostgreSQL and before them on SQLite, and
+        # so come last in the listing when it goes in that direction.
+        nulls_last = (db.engine.dialect.name == 'postgresql') != descending
+        if value is None:
+            if nulls_last:
+                return and_(key.is_(None), after)
+            return or_(and_(key.is_(None), after), key.isnot(None))
+        # Bound explicitly, as SQLAlchemy refuses to order-compare a literal
+        # True/False.
+        value = literal(value)
+        seek = or_(key < value if descending else key > value, and_(key == value, after))
+        if nulls_last:
+            seek = or_(seek, key.is_(None))
+        return seek
+
+
+class CatalogTable(object):
+    """
+    The same DataTables protocol over a handful of rows held in memory, such
+    as the levels of app.catalog: searched, sorted and sliced in Python,
+    without a query.
+
+    :param rows: a function returning the rows, as namedtuples
+    :param columns: the field names in the same order as the DataTables columns
+    :param search: the fields whose prefix the global search value matches
+    """
+
+    MAX_LENGTH = KeysetTable.MAX_LENGTH
+
+    def __init__(self, rows, columns, search=()):
+        self.rows = rows
+        self.columns = columns
+        self.search = search
+
+    def query(self, args):
+        draw = args.get('draw', 0, type=int)
+        start = max(args.get('start', 0, type=int), 0)
+        length = args.get('length', 10, type=int)
+        if length <= 0 or length > self.MAX_LENGTH:
+            length = self.MAX_LENGTH
+
+        column = self.columns[args.get('order[0][column]', 0, type=int) % len(self.columns)]
+        descending = args.get('order[0][dir]') == 'desc'
+        rows = self.rows()
+        total = len(rows)
+        value = args.get('search[value]', '').strip().lower()
+        if value:
+            rows = [row for row in rows
+                    if any(str(getattr(row, name) or '').lower().startswith(value) for name in self.search)]
+        # NULLs first, as in an ascending listing of SQLite.
+        rows = sorted(rows, key=lambda row: (getattr(row, column) is not None, getattr(row, column), row.id),
+                      reverse=descending)
+        return {
+            'draw': draw,
+            'recordsTotal': total,
+            'recordsFiltered': len(rows),
+            'data': [{name: getattr(row, name) for name in self.columns} for row in rows[start:start + length]],
+            'cursor': None,
+        }
+
+
+def encode_cursor(value, id):
+    """
+    Packs the sort key of the last row of a page into an opaque token that the
+    client hands back to get the next page.
+    """
+    raw = json.dumps([value, id], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Unpacks a token made by encode_cursor().
+
+    :return: a (value, id) tuple, or None if the token is missing or invalid
+    """
+    if not cursor:
+        return None
+    try:
+        value, id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        return value, int(id)
+    except (ValueError, TypeError):
+        return None
+
+
+def match_prefix(column):
+    """Filter on a column prefix, which can still use the column's index."""
+    def clause(value):
+        value = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        return column.like(value + '%', escape='\\')
+    return clause
+
+
+def match_int(column):
+    def clause(value):
+        try:
+            return column == int(value)
+        except ValueError:
+            return None
+    return clause
+
+
+def match_bool(column):
+    def clause(value):
+        value = value.lower()
+        if value in ('1', 'true', 'yes'):
+            return column.is_(True)
+        if value in ('0', 'false', 'no'):
+            return column.isnot(True)
+        return None
+    return clause
@@ -1,14 +1,144 @@
+import atexit
+import os
+import queue
+import threading
+from time import monotonic
+
 from flask import render_template
 from flask_mail import Message
 from app import mail, app
 
 
+class MailQueue(object):
+    """
+    Outbound mail queue drained by background worker threads.
+
+    send() only puts the message on a bounded in-memory queue, so a slow or
+    unreachable SMTP server never holds up a request. Each of the MAIL_WORKERS
+    threads keeps its own SMTP connection open while there is mail to send
+    and sends everything waiting over it, closing it once the queue has been
+    idle for MAIL_IDLE_TIMEOUT seconds (Flask-Mail itself reconnects every
+    MAIL_MAX_EMAILS messages). A message that fails is retried after an
+    exponential backoff, up to MAIL_MAX_RETRIES times.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.sent = 0
+        self.failed = 0
+        self._queue = None
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config['MAIL_WORKERS']
+        self.idle_timeout = app.config['MAIL_IDLE_TIMEOUT']
+        self.max_retries = app.config['MAIL_MAX_RETRIES']
+        self.retry_delay = app.config['MAIL_RETRY_DELAY']
+        self._queue = queue.Queue(app.config['MAIL_QUEUE_SIZE'])
+        atexit.register(self.shutdown)
+
+    def send(self, msg):
+        """
+        Queues a message for delivery.
+
+        :return: False if the queue is full and the message was dropped
+        """
+        self._ensure_workers()
+        try:
+            self._queue.put_nowait((msg, 0))
+        except queue.Full:
+            self.app.logger.error(f'Mail queue full, dropped "{msg.subject}" to {msg.recipients}')
+            return False
+        return True
+
+    def join(self):
+        """Blocks until every queued message has been sent or given up on."""
+        self._queue.join()
+
+    def shutdown(self, timeout=10):
+        """Gives the workers up to `timeout` seconds to send what is queued."""
+        deadline = monotonic() + timeout
+        while self._threads and self._queue.unfinished_tasks and monotonic() < deadline:
+            self._stop.wait(0.1)
+        self._stop.set()
+
+    def _ensure_workers(self):
+        # Threads do not survive gunicorn's fork, so each worker process
+        # starts its own pool on first use.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._threads = [threading.Thread(target=self._work, name=f'mail-{i}', daemon=True)
+                             for i in range(self.workers)]
+            for thread in self._threads:
+                thread.start()
+
+    def _work(self):
+        with self.app.app_context():
+            while not self._stop.is_set():
+                try:
+                    item = self._queue.get(timeout=1)
+                except queue.Empty:
+                    continue
+                try:
+                    with mail.connect() as connection:
+                        while item is not None:
+                            msg, attempt = item
+                            item = None
+                            try:
+                                connection.send(msg)
+                            except Exception:
+                                self._retry(msg, attempt)
+                                # The connection may be broken, open a new one.
+                                raise
+                            self.sent += 1
+                            self._queue.task_done()
+                            try:
+                                item = self._queue.get(timeout=self.idle_timeout)
+                            except queue.Empty:
+                                item = None
+                except Exception:
+                    self.app.logger.exception('SMTP delivery failed')
+                    # Still set if the connection could not even be opened.
+                    if item is not None:
+                        self._retry(*item)
+
+    def _retry(self, msg, attempt):
+        if attempt >= self.max_retries:
+            self.failed += 1
+            self.app.logger.error(f'Giving up on "{msg.subject}" to {msg.recipients}')
+            self._queue.task_done()
+            return
+        delay = self.retry_delay * 2 ** attempt
+        timer = threading.Timer(delay, self._requeue, (msg, attempt + 1))
+        timer.daemon = True
+        timer.start()
+
+    def _requeue(self, msg, attempt):
+        # Put before task_done, so join() never sees an empty queue while a
+        # message is waiting for its retry.
+        self._queue.put((msg, attempt))
+        self._queue.task_done()
+
+
+mail_queue = MailQueue(app)
+
+
 # Note that Flask-Mail also supports Cc, Bcc, but we don't use here.
 def send_mail(subject, sender, recipients, body_text, body_html):
     msg = Message(subject=subject, sender=sender, recipients=recipients)
     msg.body = body_text
     msg.html = body_html
-    mail.send(msg)
+    mail_queue.send(msg)
 
 
 def send_password_reset_email(user):
@@ -0,0 +1,253 @@
+import atexit
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+from time import sleep, monotonic
+
+from app import app
+
+
+class Subscription(object):
+    """The events of one user (and the broadcasts) for one open stream."""
+
+    def __init__(self, bus, user_id, maxsize):
+        self.bus = bus
+        self.user_id = user_id
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+
+    def put(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            # A client that does not keep up misses events rather than
+            # holding up the publisher.
+            self.dropped += 1
+
+    def stream(self, heartbeat=15, retry=5000):
+        """
+        Yields the events in the text/event-stream format until the client
+        goes away, with a comment every `heartbeat` seconds so that proxies
+        keep the connection open and a dead client is noticed.
+        """
+        try:
+            yield f'retry: {retry}\n\n'
+            while True:
+                try:
+                    message = self.queue.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                yield f'event: {message["event"]}\ndata: {json.dumps(message["data"])}\n\n'
+        finally:
+            self.close()
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+class EventBus(object):
+    """
+    Publish/subscribe for the live updates of /events/stream.
+
+    Every open stream subscribes to the events of its user; events published
+    for no user go to every stream. Within a worker, publish() hands the
+    event to the matching subscriptions directly. To reach the streams held
+    by the other workers, and to publish from `flask accrue`, each process
+    also sends its events to the broker listening on EVENTS_BROKER_SOCKET
+    (`flask events broker`), which relays them to all the other processes:
+    a stand-in for a Redis or NATS pub/sub channel on a single machine.
+    Without a broker socket configured, no relay thread is started and events
+    only reach the streams of their own process. While the broker is down the
+    relay retries with an exponential backoff, from RETRY_MIN up to RETRY_MAX
+    seconds, dropping the events published in between.
+    """
+
+    RETRY_MIN = 0.5
+    RETRY_MAX = 30
+
+    def __init__(self, app=None):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._outgoing = queue.Queue()
+        self._pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.socket_path = app.config['EVENTS_BROKER_SOCKET']
+        self.queue_size = app.config['EVENTS_QUEUE_SIZE']
+        self.heartbeat = app.config['EVENTS_HEARTBEAT']
+        atexit.register(self.drain)
+
+    def subscribe(self, user_id):
+        self._ensure_thread()
+        subscription = Subscription(self, user_id, self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscribers.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscribers[subscription.user_id]
+
+    def publish(self, user_id, event, data):
+        """
+        :param user_id: the user to notify, or None for everybody
+        :param event: the event name, e.g. 'credit'
+        :param data: the payload, anything JSON serializable
+        """
+        message = {'user': user_id, 'event': event, 'data': data}
+        self._deliver(message)
+        if self.socket_path:
+            self._ensure_thread()
+            self._outgoing.put(message)
+
+    def drain(self, timeout=2):
+        """Gives the relay thread a moment to send what is pending, e.g. before a command exits."""
+        deadline = monotonic() + timeout
+        while self._pid == os.getpid() and self._outgoing.unfinished_tasks and monotonic() < deadline:
+            sleep(0.05)
+
+    def _deliver(self, message):
+        with self._lock:
+            if message['user'] is None:
+                subscriptions = [s for group in self._subscribers.values() for s in group]
+            else:
+                subscriptions = list(self._subscribers.get(message['user'], ()))
+        for subscription in subscriptions:
+            subscription.put(message)
+
+    def _ensure_thread(self):
+        # Threads do not survive gunicorn's fork: each worker starts its own.
+        if not self.socket_path or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._outgoing = queue.Queue()
+            threading.Thread(target=self._relay, name='event-relay', daemon=True).start()
+            self._pid = os.getpid()
+
+    def _relay(self):
+        warned = False
+        delay = self.RETRY_MIN
+        while True:
+            try:
+                connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                connection.connect(self.socket_path)
+            except OSError:
+                if not warned:
+                    self.app.logger.warning(f'No event broker on {self.socket_path}, '
+                                            f'events stay within each worker')
+                    warned = True
+                # Do not let events pile up while nobody relays them.
+                while not self._outgoing.empty():
+                    self._outgoing.get_nowait()
+                    self._outgoing.task_done()
+                sleep(delay)
+                delay = min(delay * 2, self.RETRY_MAX)
+                continue
+            warned = False
+            delay = self.RETRY_MIN
+            threading.Thread(target=self._receive, args=(connection,), name='event-receiver', daemon=True).start()
+            try:
+                while True:
+                    message = self._outgoing.get()
+                    try:
+                        if message is connection:
+                            # The broker went away, see _receive().
+                            break
+                        if not isinstance(message, socket.socket):
+                            connection.sendall(json.dumps(message).encode('utf-8') + b'\n')
+                    finally:
+                        self._outgoing.task_done()
+            except OSError:
+                pass
+            connection.close()
+
+    def _receive(self, connection):
+        try:
+            for line in connection.makefile('rb'):
+                self._deliver(json.loads(line))
+        except (OSError, ValueError):
+            pass
+        # Wakes the sender up, so that it reconnects even if nothing is
+        # being published.
+        self._outgoing.put(connection)
+
+
+events = EventBus(app)
+
+
+class _BrokerHandler(socketserver.StreamRequestHandler):
+    """
+    One connected process: reads the lines it sends and hands them to the
+    queues of the other processes, while a thread of its own writes the lines
+    queued for it, so that a slow process only holds up itself.
+    """
+
+    def setup(self):
+        super(_BrokerHandler, self).setup()
+        self.outgoing = queue.Queue(self.server.queue_size)
+        self.dropped = 0
+
+    def handle(self):
+        threading.Thread(target=self._send, name='event-broker-sender', daemon=True).start()
+        with self.server.lock:
+            self.server.clients.add(self)
+        try:
+            for line in self.rfile:
+                with self.server.lock:
+                    clients = list(self.server.clients)
+                for client in clients:
+                    if client is not self:
+                        client.put(line)
+        finally:
+            with self.server.lock:
+                self.server.clients.discard(self)
+            self.outgoing.put(None)
+
+    def put(self, line):
+        try:
+            self.outgoing.put_nowait(line)
+        except queue.Full:
+            # Like a Subscription, a process that does not keep up misses
+            # events rather than holding up the others.
+            self.dropped += 1
+
+    def _send(self):
+        # Whole lines from a single thread, so that those of two senders
+        # never interleave.
+        while True:
+            line = self.outgoing.get()
+            if line is None:
+                return
+            try:
+                self.wfile.write(line)
+                self.wfile.flush()
+            except (OSError, ValueError):
+                return
+
+
+class Broker(socketserver.ThreadingUnixStreamServer):
+    """Relays every line a process sends to all the other connected processes."""
+
+    daemon_threads = True
+    # Lines buffered for each connected process.
+    queue_size = 1000
+
+    def __init__(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        self.clients = set()
+        self.lock = threading.Lock()
+        super(Broker, self).__init__(path, _BrokerHandler)
@@ -20,13 +20,15 @@ class RegistrationForm(FlaskForm):
                               validators=[DataRequired(), EqualTo('password')])
     submit = SubmitField('Register')
 
-    def validate_username(self, username):
-        if User.query.filter_by(username=username.data).first():
-            raise ValidationError('Please use a different username.')
-
-    def validate_email(self, email):
-        if User.query.filter_by(email=email.data).first():
-            raise ValidationError('Please use a different email address.')
+    def validate(self):
+        # Both uniqueness checks are done together, in one round-trip.
+        valid = super(RegistrationForm, self).validate()
+        taken = User.find_taken(username=self.username.data, email=self.email.data)
+        if 'username' in taken:
+            self.username.errors.append('Please use a different username.')
+        if 'email' in taken:
+            self.email.errors.append('Please use a different email address.')
+        return valid and not taken
 
 
 class EditProfileForm(FlaskForm):
@@ -0,0 +1,112 @@
+import itertools
+from time import perf_counter
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+from app import app
+from app.cache import LRUCache
+
+
+class FragmentCache(object):
+    """
+    Per-worker store of rendered template fragments.
+
+    A fragment is keyed by its name, the id of the user it was rendered for
+    (None for fragments shared by everyone) and any extra vary values, so it
+    must not depend on anything else of the request. Entries live in a bounded
+    LRUCache and expire after FRAGMENT_CACHE_TTL seconds, which is also how
+    long a change made through another worker may take to show. Changes made
+    through this worker are dropped right away by invalidate_user() and
+    clear() (see the session and mapper events in app.models).
+
+    Rather than looking for the entries of a user, invalidate_user() moves the
+    user to a new version, which is part of the key: the old entries are no
+    longer reachable and fall out of the LRUCache on their own.
+
+    For every fragment the time of its last render is remembered, and each
+    hit adds it to `saved`, the rendering time the cache has spared.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.saved = 0.0
+        self._store = None
+        self._cost = {}
+        self._versions = {}
+        self._version = itertools.count(1)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config['FRAGMENT_CACHE_ENABLED']
+        self._store = LRUCache(maxsize=app.config['FRAGMENT_CACHE_SIZE'],
+                               ttl=app.config['FRAGMENT_CACHE_TTL'])
+
+    def render(self, name, user_id, vary, render):
+        """
+        :param render: callable rendering the fragment on a miss
+        :return: the cached or freshly rendered markup
+        """
+        if not self.enabled:
+            return render()
+        key = (name, user_id, self._versions.get(user_id, 0), vary)
+        html = self._store.get(key)
+        if html is not None:
+            self.saved += self._cost.get(name, 0.0)
+            return html
+        started = perf_counter()
+        html = render()
+        self._cost[name] = perf_counter() - started
+        self._store.set(key, html)
+        return html
+
+    def invalidate_user(self, user_id):
+        self._versions[user_id] = next(self._version)
+
+    def clear(self):
+        self._store.clear()
+
+    def stats(self):
+        stats = self._store.stats()
+        stats['saved_seconds'] = self.saved
+        return stats
+
+
+fragment_cache = FragmentCache(app)
+
+
+class FragmentCacheExtension(Extension):
+    """
+    Adds the {% cache %} tag, caching the markup between it and {% endcache %}.
+
+        {% cache "footer" %} ... {% endcache %}
+        {% cache "sidebar-menu", current_user.is_admin %} ... {% endcache %}
+        {% cache "top-navigation" for current_user.get_id() %} ... {% endcache %}
+
+    The first one is shared by all users, the second one is rendered once per
+    value of the expressions after the name, and the last one once per user,
+    so that it can be invalidated when that user changes.
+    """
+
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        name = parser.parse_expression()
+        vary = []
+        while parser.stream.skip_if('comma'):
+            vary.append(parser.parse_expression())
+        if parser.stream.skip_if('name:for'):
+            user_id = parser.parse_expression()
+        else:
+            user_id = nodes.Const(None)
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        call = self.call_method('_render', [name, user_id, nodes.List(vary)])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _render(self, name, user_id, vary, caller):
+        # Flask-Login hands out string ids, the models integer ones.
+        if user_id is not None:
+            user_id = int(user_id)
+        return fragment_cache.render(name, user_id, tuple(vary), caller)
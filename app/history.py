@@ -0,0 +1,77 @@
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+from app import app, db
+from app.datatables import encode_cursor, decode_cursor
+from app.models import Activity
+from app.partitions import partitions, month_table
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def activity_page(user_id, cursor=None, limit=None):
+    """
+    Returns one page of a user's activities, newest first.
+
+    Pages are fetched with keyset pagination on (user_id, timestamp, id): the
+    cursor holds the timestamp and id of the last row already shown, and the
+    next page starts right after it. With the composite index on those
+    columns every page, the first one included, is a short index range scan,
+    however many activities the user has.
+
+    :param user_id: id of the user
+    :param cursor: the cursor returned with the previous page, if any
+    :param limit: the number of activities on a page
+    :return: a dict with the rows under 'data' and the next cursor, which is
+             None on the last page
+    """
+    limit = min(limit or app.config['HISTORY_PAGE_SIZE'], app.config['HISTORY_PAGE_SIZE'])
+
+    timestamp, last_id = None, None
+    position = decode_cursor(cursor)
+    if position is not None:
+        try:
+            timestamp = datetime.strptime(position[0], TIMESTAMP_FORMAT)
+        except (TypeError, ValueError):
+            timestamp = None
+        last_id = position[1]
+
+    # One row more than asked tells whether there is a next page.
+    rows = _seek(Activity.__table__, user_id, timestamp, last_id, limit + 1)
+    if db.engine.dialect.name == 'sqlite':
+        # Past months live in their own tables (see app.partitions). They
+        # are read newest first until enough older rows are found, then
+        # merged with the rows still in the activity table.
+        older = []
+        for month, name in partitions(db.session.connection()):
+            if timestamp is not None and month > timestamp:
+                continue
+            older += _seek(month_table(name), user_id, timestamp, last_id, limit + 1 - len(older))
+            if len(older) > limit:
+                break
+        rows = sorted(rows + older, key=lambda row: (row.timestamp or datetime.min, row.id), reverse=True)[:limit + 1]
+    more = len(rows) > limit
+    rows = rows[:limit]
+
+    next_cursor = None
+    if more:
+        last = rows[-1]
+        next_cursor = encode_cursor(last.timestamp.strftime(TIMESTAMP_FORMAT), last.id)
+    return {
+        'data': [{'id': row.id,
+                  'timestamp': row.timestamp.strftime(TIMESTAMP_FORMAT) if row.timestamp else None,
+                  'notes': row.notes}
+                 for row in rows],
+        'cursor': next_cursor,
+    }
+
+
+def _seek(table, user_id, timestamp, last_id, limit):
+    """The first `limit` activities of a user in `table` after the position (timestamp, last_id)."""
+    q = db.session.query(table.c.id, table.c.timestamp, table.c.notes) \
+        .filter(table.c.user_id == user_id)
+    if timestamp is not None:
+        q = q.filter(or_(table.c.timestamp < timestamp,
+                         and_(table.c.timestamp == timestamp, table.c.id < last_id)))
+    return q.order_by(table.c.timestamp.desc(), table.c.id.desc()).limit(limit).all()
@@ -0,0 +1,61 @@
+from sqlalchemy import func, select, bindparam
+
+from app import app, db
+from app.models import User, CreditEntry, user_cache
+
+
+class Mismatch(object):
+
+    def __init__(self, user_id, credit, expected):
+        self.user_id = user_id
+        self.credit = credit
+        self.expected = expected
+
+    def __repr__(self):
+        return f'<Mismatch user={self.user_id} credit={self.credit} ledger={self.expected}>'
+
+
+def reconcile(fix=False, batch_size=None):
+    """
+    Recomputes every balance from the credit ledger and compares it with the
+    credit column.
+
+    Users are walked in one pass ordered by id, a batch at a time: each batch
+    seeks past the last id seen and sums the ledger of just those users with
+    the user_id index, so memory stays flat no matter how many users there
+    are and no cursor is held open across the fixes. With `fix`, diverging
+    balances are reset to the ledger total with one executemany UPDATE per
+    batch. Fixing should be done while no credits are being applied, since a
+    balance changed between the two reads of a batch would be clobbered.
+
+    :param fix: whether to correct the balances that do not match
+    :param batch_size: the number of users checked at a time
+    :return: a generator of Mismatch objects
+    """
+    batch_size = batch_size or app.config['LEDGER_BATCH_SIZE']
+    user = User.__table__
+    ledger = CreditEntry.__table__
+    fix_stmt = user.update().where(user.c.id == bindparam('_id')).values(credit=bindparam('_credit'))
+
+    last_id = 0
+    while True:
+        users = db.session.execute(
+            select([user.c.id, func.coalesce(user.c.credit, 0)])
+            .where(user.c.id > last_id).order_by(user.c.id).limit(batch_size)).fetchall()
+        if not users:
+            break
+        first_id, last_id = users[0][0], users[-1][0]
+        totals = dict(db.session.execute(
+            select([ledger.c.user_id, func.sum(ledger.c.delta)])
+            .where(ledger.c.user_id.between(first_id, last_id))
+            .group_by(ledger.c.user_id)).fetchall())
+        wrong = [Mismatch(user_id, credit, totals.get(user_id, 0))
+                 for user_id, credit in users if credit != totals.get(user_id, 0)]
+        if fix and wrong:
+            db.session.execute(fix_stmt, [{'_id': m.user_id, '_credit': m.expected} for m in wrong])
+            for m in wrong:
+                user_cache.invalidate(m.user_id)
+        # Ends the read transaction of this batch as well.
+        db.session.commit()
+        for m in wrong:
+            yield m
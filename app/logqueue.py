@@ -0,0 +1,157 @@
+import atexit
+import json
+import logging
+import queue
+import threading
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, MemoryHandler, SMTPHandler
+from time import monotonic
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Puts records on a bounded queue for the listener thread and returns at
+    once. When the queue is full (say, during an error storm) the record is
+    dropped and counted instead of making the request wait.
+    """
+
+    def __init__(self, queue):
+        super(NonBlockingQueueHandler, self).__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # Format the traceback now, while the frames still exist, but keep
+        # the record itself so handlers can use their own formatters.
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.template = str(record.msg)
+        record.message = record.getMessage()
+        record.msg, record.args, record.exc_info = record.message, None, None
+        return record
+
+
+class ThrottledSMTPHandler(SMTPHandler):
+    """
+    SMTPHandler that deduplicates and rate-limits the error emails.
+
+    A record with the same origin (file, line and message template) as one
+    mailed less than `dedup_window` seconds ago is not mailed again, and no
+    more than `max_per_window` emails are sent per `rate_window` seconds. The
+    number of suppressed records is mentioned in the next email sent for the
+    same origin.
+    """
+
+    def __init__(self, *args, dedup_window=600, max_per_window=10, rate_window=3600, **kwargs):
+        super(ThrottledSMTPHandler, self).__init__(*args, **kwargs)
+        self.dedup_window = dedup_window
+        self.max_per_window = max_per_window
+        self.rate_window = rate_window
+        self.suppressed = {}
+        self._last_sent = {}
+        self._sent_times = []
+
+    def emit(self, record):
+        key = (record.pathname, record.lineno, getattr(record, 'template', str(record.msg)))
+        now = monotonic()
+        self._sent_times = [t for t in self._sent_times if now - t < self.rate_window]
+        last = self._last_sent.get(key)
+        if (last is not None and now - last < self.dedup_window) \
+                or len(self._sent_times) >= self.max_per_window:
+            self.suppressed[key] = self.suppressed.get(key, 0) + 1
+            return
+        count = self.suppressed.pop(key, 0)
+        if count:
+            record.msg = f'{record.msg}\n\n({count} similar errors were not mailed)'
+        self._last_sent[key] = now
+        self._sent_times.append(now)
+        super(ThrottledSMTPHandler, self).emit(record)
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'path': record.pathname,
+            'line': record.lineno,
+            'process': record.process,
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+
+class BatchingHandler(MemoryHandler):
+    """
+    Buffers records and hands them to the target handler in batches: when
+    `capacity` records are waiting, when a record of `flushLevel` or above
+    arrives, or when the oldest buffered record is `interval` seconds old.
+    A timer thread makes sure a quiet period does not leave lines behind.
+    """
+
+    def __init__(self, capacity, target, flushLevel=logging.ERROR, interval=2.0):
+        super(BatchingHandler, self).__init__(capacity, flushLevel=flushLevel, target=target)
+        self.interval = interval
+        self._first = None
+        self._stop = threading.Event()
+        self._timer = threading.Thread(target=self._tick, name='log-batch-flusher', daemon=True)
+        self._timer.start()
+
+    def emit(self, record):
+        if self._first is None:
+            self._first = monotonic()
+        super(BatchingHandler, self).emit(record)
+
+    def shouldFlush(self, record):
+        return super(BatchingHandler, self).shouldFlush(record) \
+            or (self._first is not None and monotonic() - self._first >= self.interval)
+
+    def flush(self):
+        with self.lock:
+            super(BatchingHandler, self).flush()
+            self._first = None
+
+    def close(self):
+        self._stop.set()
+        super(BatchingHandler, self).close()
+
+    def _tick(self):
+        while not self._stop.wait(self.interval):
+            if self._first is not None and monotonic() - self._first >= self.interval:
+                self.flush()
+
+
+def start_queue_logging(logger, handlers, maxsize=10000):
+    """
+    Moves `handlers` behind a queue so that `logger` never blocks on them.
+
+    The logger only gets a NonBlockingQueueHandler, and a QueueListener thread
+    passes the records on to the real handlers. The listener is stopped, and
+    the handlers flushed, when the process exits.
+
+    :return: the QueueListener
+    """
+    records = queue.Queue(maxsize)
+    queue_handler = NonBlockingQueueHandler(records)
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    logger.addHandler(queue_handler)
+    listener.start()
+
+    def stop():
+        listener.stop()
+        for handler in handlers:
+            handler.close()
+    atexit.register(stop)
+    return listener
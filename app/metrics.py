@@ -0,0 +1,286 @@
+import glob
+import json
+import os
+import threading
+from time import perf_counter
+
+from flask import g, request, has_request_context, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import app
+from app.tracking import BackgroundFlusher
+
+# Not available on Windows, where the files of exited workers are kept.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'http_requests_total':
+        ('counter', 'Requests handled, by endpoint, method and status.', None),
+    'http_request_duration_seconds':
+        ('histogram', 'Time spent handling a request, by endpoint.', LATENCY_BUCKETS),
+    'sql_queries_per_request':
+        ('histogram', 'SQL statements executed per request, by endpoint.', QUERY_BUCKETS),
+    'sql_query_seconds_total':
+        ('counter', 'Time spent executing SQL statements, by endpoint.', None),
+    'template_render_seconds_total':
+        ('counter', 'Time spent rendering templates, by endpoint.', None),
+}
+
+
+class RequestStats(object):
+    """What the current request has spent so far, kept on flask.g."""
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.queries = 0
+        self.query_time = 0.0
+        self.render_time = 0.0
+        self.renders = []
+
+
+class Metrics(BackgroundFlusher):
+    """
+    Per-route request metrics, in the Prometheus text format.
+
+    Every worker counts in memory and a background thread writes its totals
+    to METRICS_DIR/<pid>.json every METRICS_FLUSH_INTERVAL seconds, replacing
+    the file atomically. /metrics sums the files of all the workers, so it
+    returns the same figures whichever worker answers the scrape. So that
+    counters never go down, the totals of workers that have exited are kept:
+    each flush adds the files of pids that are no longer running to
+    METRICS_DIR/retired.json and removes them, one worker at a time, so a
+    scrape reads one file per live worker plus one. Empty the directory when
+    the application is redeployed.
+
+    SQL statements are counted through engine events and template rendering
+    through Flask's signals (which need blinker), both attributed to the
+    request that caused them.
+    """
+
+    thread_name = 'metrics-writer'
+
+    def __init__(self, app=None):
+        self._counters = {}
+        self._histograms = {}
+        self._data_lock = threading.Lock()
+        self._loaded_pid = None
+        super(Metrics, self).__init__(app)
+
+    def init_app(self, app):
+        super(Metrics, self).init_app(app)
+        self.directory = app.config['METRICS_DIR']
+        self.flush_interval = app.config['METRICS_FLUSH_INTERVAL']
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Runs before the other before_request functions, so that they are
+        # included in the request's time.
+        app.before_request_funcs.setdefault(None, []).insert(0, self._start_request)
+        app.after_request(self._end_request)
+        before_render_template.connect(self._start_render, app)
+        template_rendered.connect(self._end_render, app)
+        event.listen(Engine, 'before_cursor_execute', self._start_query)
+        event.listen(Engine, 'after_cursor_execute', self._end_query)
+
+    def inc(self, name, labels, value=1):
+        self._ensure_thread()
+        key = (name, tuple(sorted(labels.items())))
+        with self._data_lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        self._ensure_thread()
+        key = (name, tuple(sorted(labels.items())))
+        buckets = METRICS[name][2]
+        with self._data_lock:
+            counts, total, count = self._histograms.get(key) or ([0] * len(buckets), 0, 0)
+            counts = [n + (value <= bound) for n, bound in zip(counts, buckets)]
+            self._histograms[key] = (counts, total + value, count + 1)
+
+    def flush(self):
+        if self._pid != os.getpid():
+            return
+        with self._data_lock:
+            snapshot = {
+                'counters': [[name, labels, value] for (name, labels), value in self._counters.items()],
+                'histograms': [[name, labels] + list(value) for (name, labels), value in self._histograms.items()],
+            }
+        _write(self._path(os.getpid()), snapshot)
+        self._retire()
+
+    def render(self):
+        """:return: the metrics of all the workers in the Prometheus text format"""
+        self.flush()
+        counters, histograms = {}, {}
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            snapshot = _read(path)
+            if snapshot is not None:
+                _add(counters, histograms, snapshot)
+
+        lines = []
+        for name, (kind, help, buckets) in sorted(METRICS.items()):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            if kind == 'counter':
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f'{name}{_labels(labels)} {value}')
+                continue
+            for (metric, labels), (counts, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, n in zip(buckets, counts):
+                    lines.append(f'{name}_bucket{_labels(labels + (("le", str(bound)),))} {n}')
+                lines.append(f'{name}_bucket{_labels(labels + (("le", "+Inf"),))} {count}')
+                lines.append(f'{name}_sum{_labels(labels)} {total}')
+                lines.append(f'{name}_count{_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f'{pid}.json')
+
+    def _retire(self):
+        """Folds the files of the workers that have exited into retired.json."""
+        if fcntl is None:
+            return
+        with open(os.path.join(self.directory, 'retire.lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another worker is at it.
+                return
+            dead = []
+            for path in glob.glob(os.path.join(self.directory, '*.json')):
+                pid = os.path.basename(path)[:-len('.json')]
+                if pid.isdigit() and not _running(int(pid)):
+                    dead.append(path)
+            if not dead:
+                return
+            retired = os.path.join(self.directory, 'retired.json')
+            counters, histograms = {}, {}
+            for path in [retired] + dead:
+                snapshot = _read(path)
+                if snapshot is not None:
+                    _add(counters, histograms, snapshot)
+            _write(retired, {
+                'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+                'histograms': [[name, labels] + list(value) for (name, labels), value in histograms.items()],
+            })
+            for path in dead:
+                os.remove(path)
+
+    def _ensure_thread(self):
+        if self._pid != os.getpid():
+            self._load(os.getpid())
+        super(Metrics, self)._ensure_thread()
+
+    def _load(self, pid):
+        # Values inherited through a fork belong to the parent: start over
+        # from this pid's own file, once.
+        with self._data_lock:
+            if self._loaded_pid == pid:
+                return
+            self._counters, self._histograms = {}, {}
+            try:
+                with open(self._path(pid)) as f:
+                    snapshot = json.load(f)
+                for name, labels, value in snapshot['counters']:
+                    self._counters[(name, tuple(map(tuple, labels)))] = value
+                for name, labels, counts, total, count in snapshot['histograms']:
+                    self._histograms[(name, tuple(map(tuple, labels)))] = (counts, total, count)
+            except (OSError, ValueError):
+                pass
+            self._loaded_pid = pid
+
+    def _start_request(self):
+        g._request_stats = RequestStats()
+
+    def _end_request(self, response):
+        stats = g.pop('_request_stats', None)
+        if stats is None:
+            return response
+        endpoint = request.endpoint or 'unmatched'
+        labels = {'endpoint': endpoint}
+        self.inc('http_requests_total',
+                 {'endpoint': endpoint, 'method': request.method, 'status': str(response.status_code)})
+        self.observe('http_request_duration_seconds', labels, perf_counter() - stats.started)
+        self.observe('sql_queries_per_request', labels, stats.queries)
+        self.inc('sql_query_seconds_total', labels, stats.query_time)
+        self.inc('template_render_seconds_total', labels, stats.render_time)
+        return response
+
+    def _start_render(self, sender, template, context, **extra):
+        stats = getattr(g, '_request_stats', None)
+        if stats is not None:
+            stats.renders.append(perf_counter())
+
+    def _end_render(self, sender, template, context, **extra):
+        stats = getattr(g, '_request_stats', None)
+        if stats is not None and stats.renders:
+            stats.render_time += perf_counter() - stats.renders.pop()
+
+    def _start_query(self, conn, cursor, statement, parameters, context, executemany):
+        if has_request_context():
+            conn.info.setdefault('query_started', []).append(perf_counter())
+
+    def _end_query(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get('query_started')
+        if not started or not has_request_context():
+            return
+        stats = getattr(g, '_request_stats', None)
+        elapsed = perf_counter() - started.pop()
+        if stats is not None:
+            stats.queries += 1
+            stats.query_time += elapsed
+
+
+def _running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write(path, snapshot):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(path + '.tmp', path)
+
+
+def _add(counters, histograms, snapshot):
+    """Adds the totals of a snapshot file to `counters` and `histograms`."""
+    for name, labels, value in snapshot['counters']:
+        key = (name, tuple(map(tuple, labels)))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, counts, total, count in snapshot['histograms']:
+        key = (name, tuple(map(tuple, labels)))
+        old_counts, old_total, old_count = histograms.get(key) or ([0] * len(counts), 0, 0)
+        histograms[key] = ([a + b for a, b in zip(old_counts, counts)], old_total + total, old_count + count)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+metrics = Metrics(app)
@@ -5,9 +5,16 @@ from urllib.parse import urlencode
 
 import jwt
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
-
+from sqlalchemy import event, bindparam, func, inspect
 from app import db, login, app
+from app.cache import LRUCache
+from app.catalog import level_catalog
+from app.events import events
+from app.fragments import fragment_cache
+from app.passwords import hasher
+from app.sqlite import sqlite_writer
+from app.tokens import token_auth
+from app.tracking import last_seen_tracker
 
 
 #  Current Database Schema
@@ -37,18 +44,53 @@ class User(UserMixin, db.Model):
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
     confirmed = db.Column(db.Boolean, default=False)
     is_admin = db.Column(db.Boolean, default=False)
+    accrued_period = db.Column(db.Integer)
 
     activities = db.relationship('Activity', backref='user', lazy='dynamic')
 
-    def modify_credits(self, delta):
-        self.credit += delta
-        db.session.add(self)
-        db.session.commit()
+    @property
+    def level(self):
+        # From the in-memory catalog rather than a lazy load per user.
+        return level_catalog.get(self.level_id)
+
+    def modify_credits(self, delta, reason=None):
+        apply_credits([(self.id, delta, reason)])
+        # The balance was changed in the database, reload it on next access.
+        db.session.expire(self, ['credit'])
 
     def modify_level(self, level):
         self.level_id = level
         db.session.add(self)
         db.session.commit()
+        info = level_catalog.get(level)
+        events.publish(self.id, 'level', {
+            'level_id': level,
+            'title': info.title if info else None,
+            'hash_rate': info.hash_rate if info else None,
+        })
+
+    @staticmethod
+    def find_taken(username=None, email=None):
+        """
+        Checks a username and an email for uniqueness in a single query.
+
+        :return: the set of the fields, among 'username' and 'email', that
+                 are already used by another user
+        """
+        clauses = []
+        if username:
+            clauses.append(User.username == username)
+        if email:
+            clauses.append(User.email == email)
+        if not clauses:
+            return set()
+        taken = set()
+        for row in db.session.query(User.username, User.email).filter(db.or_(*clauses)).limit(2):
+            if username and row.username == username:
+                taken.add('username')
+            if email and row.email == email:
+                taken.add('email')
+        return taken
 
     def avatar(self, size=128):
         digest = md5(self.email.lower().encode('utf-8')).hexdigest()
@@ -56,11 +98,25 @@ class User(UserMixin, db.Model):
         params = urlencode({'d': 'identicon', 's': size})
         return f'{base}/{digest}?{params}'
 
+    # Hashing runs on the bounded pool of app.passwords and raises
+    # PasswordBusy when too many sign-ins are already waiting for it.
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return hasher.verify(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        return hasher.needs_rehash(self.password_hash)
+
+    def rehash_password(self, password):
+        """
+        Hashes the same password again with the current cost. Unlike
+        set_password() this keeps the API tokens of the user valid, see
+        revoke_stale_tokens().
+        """
+        self.set_password(password)
+        self._password_rehashed = True
 
     def get_reset_password_token(self, expires_in=600):
         # Note that jwt.encode() returns a byte string
@@ -101,6 +157,87 @@ class User(UserMixin, db.Model):
         return f'<User {self.username}>'
 
 
+class UserSnapshot(UserMixin):
+    """
+    A detached, read-only copy of a User row.
+
+    Snapshots are what the cached user loader hands to Flask-Login, so they can
+    be shared between requests without being bound to any session. They carry
+    the plain column values only; code that needs to change the user must load
+    the real model with to_model() first.
+    """
+
+    FIELDS = ('id', 'username', 'display_name', 'email', 'level_id', 'credit',
+              'confirmed', 'is_admin')
+
+    def __init__(self, user):
+        for field in self.FIELDS:
+            object.__setattr__(self, field, getattr(user, field))
+        object.__setattr__(self, '_last_seen', user.last_seen)
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f'{self!r} is read-only')
+
+    @property
+    def level(self):
+        return level_catalog.get(self.level_id)
+
+    @property
+    def last_seen(self):
+        # Written behind the cache's back, see app.tracking.
+        return last_seen_tracker.last_seen(self.id, self._last_seen)
+
+    @property
+    def activities(self):
+        return Activity.query.filter_by(user_id=self.id)
+
+    def avatar(self, size=128):
+        return User.avatar(self, size)
+
+    def to_model(self):
+        return User.query.get(self.id)
+
+    def __repr__(self):
+        return f'<UserSnapshot {self.username}>'
+
+
+# Each worker keeps its own cache, so a change made by one worker only becomes
+# visible to the others once their entry expires after USER_CACHE_TTL seconds.
+user_cache = LRUCache(maxsize=app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_TTL'])
+
+
+@event.listens_for(db.session, 'after_flush')
+def collect_changed_users(session, flush_context):
+    # Only dropped once the transaction commits, see invalidate_cached_users():
+    # dropping them now would let a concurrent request cache the old row again.
+    changed = session.info.setdefault('changed_users', set())
+    changed.update(obj.id for obj in session.dirty | session.deleted if isinstance(obj, User))
+
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_cached_users(session):
+    for user_id in session.info.pop('changed_users', ()):
+        user_cache.invalidate(user_id)
+        fragment_cache.invalidate_user(user_id)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_changed_users(session):
+    session.info.pop('changed_users', None)
+
+
+@event.listens_for(User, 'after_update')
+def revoke_stale_tokens(mapper, connection, target):
+    # API access tokens carry the level and admin flag: make their holders
+    # refresh them. A new password ends every API session, a new hash of the
+    # same one does not.
+    state = inspect(target)
+    rehashed, target._password_rehashed = getattr(target, '_password_rehashed', False), False
+    password = state.attrs.password_hash.history.has_changes() and not rehashed
+    if password or state.attrs.level_id.history.has_changes() or state.attrs.is_admin.history.has_changes():
+        token_auth.revocations.revoke_user(target.id, refresh=password, connection=connection)
+
+
 @login.user_loader
 def load_user(id):
     """
@@ -112,10 +249,22 @@ def load_user(id):
     Flask-Login retrieves the ID of the user from the session, and then loads
     that user into the memory.
 
+    To avoid a query on every request the user is served from a per-worker
+    cache of read-only snapshots, which is invalidated whenever an update of
+    the row through the ORM is committed.
+
     :param id: unicode user id
-    :return: the corresponding user object
+    :return: the corresponding user snapshot
     """
-    return User.query.get(int(id))
+    id = int(id)
+    snapshot = user_cache.get(id)
+    if snapshot is None:
+        user = User.query.get(id)
+        if user is None:
+            return None
+        snapshot = UserSnapshot(user)
+        user_cache.set(id, snapshot)
+    return snapshot
 
 
 class Level(db.Model):
@@ -128,13 +277,158 @@ class Level(db.Model):
     price = db.Column(db.Integer)
     credit = db.Column(db.Integer)
 
-    users = db.relationship('User', backref='level', lazy='dynamic')
+    # User.level reads the catalog instead of a backref, see app.catalog.
+    users = db.relationship('User', lazy='dynamic')
 
     def __repr__(self):
         return f'<UserClass {self.title}>'
 
 
+class CatalogVersion(db.Model):
+    """Version counters of the in-memory catalogs, see app.catalog."""
+    name = db.Column(db.String(32), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+
+class TokenRevocation(db.Model):
+    """
+    A revoked API token (jti), or all the tokens of a user issued before a
+    time, see app.tokens. Times are seconds since the epoch, as in the tokens.
+    """
+    # A jti is revoked once, which is what makes a refresh token single use.
+    __table_args__ = (
+        db.UniqueConstraint('jti', name='uq_token_revocation_jti'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    jti = db.Column(db.String(32))
+    user_id = db.Column(db.Integer)
+    issued_before = db.Column(db.Float)
+    refresh = db.Column(db.Boolean, nullable=False, default=False)
+    expires = db.Column(db.Float, nullable=False, index=True)
+    created = db.Column(db.Float, index=True)
+
+
+class ReplicationHeartbeat(db.Model):
+    """Time stamped on the primary to measure the lag of the replicas, see app.replicas."""
+    id = db.Column(db.Integer, primary_key=True)
+    timestamp = db.Column(db.DateTime, nullable=False)
+
+
+@event.listens_for(Level, 'after_insert')
+@event.listens_for(Level, 'after_update')
+@event.listens_for(Level, 'after_delete')
+def bump_level_catalog(mapper, connection, target):
+    level_catalog.bump(connection)
+    level_catalog.expire()
+    fragment_cache.clear()
+
+
+class CreditEntry(db.Model):
+    """
+    One row of the append-only credit ledger. A user's credit column is a
+    running total of its entries, see apply_credits() and app.ledger.
+    """
+    # A user is credited once per accrual period, see app.accrual.
+    __table_args__ = (
+        db.Index('uq_credit_entry_user_id_accrual', 'user_id', 'reason', unique=True,
+                 postgresql_where=db.text("reason LIKE 'accrual %'"),
+                 sqlite_where=db.text("reason LIKE 'accrual %'")),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True, nullable=False)
+    delta = db.Column(db.Integer, nullable=False)
+    reason = db.Column(db.String(64))
+    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<CreditEntry {self.user_id}[{self.timestamp}]: {self.delta:+d}>'
+
+
+def apply_credits(entries):
+    """
+    Applies many credit changes in one transaction.
+
+    Every entry is appended to the ledger, and the balances are changed with
+    an atomic `credit = credit + :delta` in the database, so concurrent
+    workers never overwrite each other's changes. Deltas for the same user are
+    summed first so each balance is updated once.
+
+    :param entries: an iterable of (user_id, delta, reason) tuples
+    :return: the number of ledger entries written
+    """
+    now = datetime.utcnow()
+    rows = [{'user_id': user_id, 'delta': delta, 'reason': reason, 'timestamp': now}
+            for user_id, delta, reason in entries]
+    if not rows:
+        return 0
+    totals = {}
+    for row in rows:
+        totals[row['user_id']] = totals.get(row['user_id'], 0) + row['delta']
+
+    user = User.__table__
+    stmt = user.update() \
+        .where(user.c.id == bindparam('_id')) \
+        .values(credit=func.coalesce(user.c.credit, 0) + bindparam('_delta'))
+
+    def write(connection):
+        connection.execute(CreditEntry.__table__.insert(), rows)
+        connection.execute(stmt, [{'_id': user_id, '_delta': delta} for user_id, delta in totals.items()])
+
+    # On SQLite, small credit changes from concurrent requests are committed
+    # together by the single writer, see app.sqlite.
+    if sqlite_writer.available():
+        sqlite_writer.run(write)
+    else:
+        try:
+            write(db.session)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    for user_id, delta in totals.items():
+        user_cache.invalidate(user_id)
+        # Live balance updates on the dashboards, see app.events.
+        events.publish(user_id, 'credit', {'delta': delta})
+    return len(rows)
+
+
+class Rollup(db.Model):
+    """
+    Pre-aggregated dashboard figures of one user, or of all users when
+    user_id is GLOBAL, over an hour or a day. Maintained by app.rollup.
+    """
+    GLOBAL = 0
+
+    __table_args__ = (
+        db.UniqueConstraint('granularity', 'user_id', 'bucket', name='uq_rollup_granularity_user_id_bucket'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    granularity = db.Column(db.String(8), nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    bucket = db.Column(db.DateTime, nullable=False)
+    credits = db.Column(db.Integer, default=0)
+    activities = db.Column(db.Integer, default=0)
+    hash_rate = db.Column(db.Float)
+
+    def __repr__(self):
+        return f'<Rollup {self.granularity} {self.user_id}[{self.bucket}]>'
+
+
+class RollupWatermark(db.Model):
+    source = db.Column(db.String(32), primary_key=True)
+    last_id = db.Column(db.Integer, default=0)
+
+
 class Activity(db.Model):
+    # History pages seek on (user_id, timestamp, id), see app.history. The
+    # table is partitioned by month, see app.partitions.
+    __table_args__ = (
+        db.Index('ix_activity_user_id_timestamp_id', 'user_id', 'timestamp', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
@@ -0,0 +1,171 @@
+import gzip
+import json
+import os
+import re
+from datetime import datetime
+
+from sqlalchemy import MetaData, Table, Column, Index, Integer, DateTime, Text, select, func, and_, text
+
+from app import app
+from app.models import Activity
+
+PARTITION_NAME = re.compile(r'^activity_(\d{4})_(\d{2})$')
+
+
+def month_start(timestamp):
+    return datetime(timestamp.year, timestamp.month, 1)
+
+
+def add_months(month, n):
+    year, month = divmod(month.year * 12 + month.month - 1 + n, 12)
+    return datetime(year, month + 1, 1)
+
+
+def partition_name(month):
+    return f'activity_{month:%Y_%m}'
+
+
+def month_table(name):
+    """A table with the columns of activity, for one monthly partition."""
+    return Table(name, MetaData(),
+                 Column('id', Integer, primary_key=True),
+                 Column('user_id', Integer),
+                 Column('timestamp', DateTime),
+                 Column('notes', Text),
+                 Index(f'ix_{name}_user_id_timestamp_id', 'user_id', 'timestamp', 'id'))
+
+
+def partitions(connection):
+    """
+    Lists the monthly partitions of the activity table.
+
+    On PostgreSQL they are the partitions of the activity table itself, on
+    SQLite the activity_YYYY_MM tables that closed months are moved to.
+
+    :return: a list of (first day of the month, table name), newest first
+    """
+    if connection.dialect.name == 'postgresql':
+        names = connection.execute(text(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = 'activity'")).fetchall()
+    else:
+        names = connection.execute(text(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'activity!_%' ESCAPE '!'")).fetchall()
+    found = []
+    for name, in names:
+        match = PARTITION_NAME.match(name)
+        if match:
+            found.append((datetime(int(match.group(1)), int(match.group(2)), 1), name))
+    return sorted(found, reverse=True)
+
+
+def create_partitions(connection, ahead=None):
+    """
+    Creates the PostgreSQL partitions of the current month and of the `ahead`
+    next ones, so that new activities never land in activity_default.
+
+    :return: the names of the partitions created
+    """
+    ahead = app.config['ACTIVITY_PARTITIONS_AHEAD'] if ahead is None else ahead
+    existing = {name for _, name in partitions(connection)}
+    current = month_start(datetime.utcnow())
+    created = []
+    for i in range(ahead + 1):
+        month = add_months(current, i)
+        name = partition_name(month)
+        if name in existing:
+            continue
+        connection.execute(
+            f"CREATE TABLE {name} PARTITION OF activity "
+            f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{add_months(month, 1):%Y-%m-%d}')")
+        created.append(name)
+    return created
+
+
+def move_closed_months(connection):
+    """
+    Moves the activities of past months from the activity table of a SQLite
+    database into their activity_YYYY_MM table, one transaction per month.
+
+    Only rows already folded into the rollups (see app.rollup) are moved,
+    since those read the activity table from a watermark on. The newest row
+    always stays: SQLite numbers new rows after the highest id of the table,
+    which must not go back to ids already used by the moved ones.
+
+    :return: a list of (table name, rows moved)
+    """
+    activity = Activity.__table__
+    watermark = connection.execute(text(
+        "SELECT last_id FROM rollup_watermark WHERE source = 'activity'")).scalar() or 0
+    newest = connection.execute(select([func.max(activity.c.id)])).scalar() or 0
+    bound = min(watermark, newest - 1)
+    current = month_start(datetime.utcnow())
+    months = connection.execute(
+        select([func.distinct(func.strftime('%Y-%m', activity.c.timestamp))])
+        .where(and_(activity.c.timestamp < current, activity.c.id <= bound))).fetchall()
+
+    moved = []
+    for month, in sorted(months):
+        start = datetime.strptime(month, '%Y-%m')
+        name = partition_name(start)
+        table = month_table(name)
+        window = and_(activity.c.timestamp >= start, activity.c.timestamp < add_months(start, 1),
+                      activity.c.id <= bound)
+        with connection.begin():
+            table.create(connection, checkfirst=True)
+            columns = [activity.c.id, activity.c.user_id, activity.c.timestamp, activity.c.notes]
+            connection.execute(table.insert().from_select([c.name for c in columns], select(columns).where(window)))
+            count = connection.execute(activity.delete().where(window)).rowcount
+        moved.append((name, count))
+    return moved
+
+
+def expired(connection, retention_months=None):
+    """:return: the partitions older than the retention period, oldest first"""
+    retention_months = app.config['ACTIVITY_RETENTION_MONTHS'] if retention_months is None else retention_months
+    cutoff = add_months(month_start(datetime.utcnow()), -retention_months)
+    return [(month, name) for month, name in reversed(partitions(connection)) if month < cutoff]
+
+
+def archive(connection, name, directory=None, batch_size=10000):
+    """
+    Streams a partition to <directory>/<name>.jsonl.gz, one activity per line,
+    then drops it. The file is written under a temporary name and the
+    partition is only dropped once the file holds as many rows as the table.
+
+    :return: a (rows archived, path of the file) tuple
+    """
+    directory = directory or app.config['ACTIVITY_ARCHIVE_DIR']
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{name}.jsonl.gz')
+    table = month_table(name)
+
+    written = 0
+    # A server-side cursor on PostgreSQL, so that the rows are not all
+    # fetched into memory at once.
+    result = connection.execution_options(stream_results=True).execute(select([table]).order_by(table.c.id))
+    with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                f.write(json.dumps({
+                    'id': row.id,
+                    'user_id': row.user_id,
+                    'timestamp': row.timestamp.isoformat() if row.timestamp else None,
+                    'notes': row.notes,
+                }) + '\n')
+            written += len(rows)
+
+    count = connection.execute(select([func.count()]).select_from(table)).scalar()
+    if count != written:
+        os.remove(path + '.tmp')
+        raise RuntimeError(f'{name} has {count} rows but {written} were archived, not dropping it')
+    os.replace(path + '.tmp', path)
+    with connection.begin():
+        if connection.dialect.name == 'postgresql':
+            connection.execute(f'ALTER TABLE activity DETACH PARTITION {name}')
+        connection.execute(f'DROP TABLE {name}')
+    return written, path
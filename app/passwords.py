@@ -0,0 +1,108 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from time import perf_counter
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from app import app
+
+try:
+    from gevent import monkey
+    from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+except ImportError:
+    monkey = None
+
+
+class PasswordBusy(Exception):
+    """Raised when too many password hashes are already waiting to be computed."""
+
+
+class PasswordHasher(object):
+    """
+    Runs the password KDF on a small bounded thread pool.
+
+    PBKDF2 releases the GIL while it works, so with threaded or gevent workers
+    the other requests of the process keep being served while a hash is
+    computed (under gevent the pool is made of native threads, which do not
+    block the event loop), and PASSWORD_HASH_WORKERS caps how many cores
+    sign-ins may occupy at once. At most PASSWORD_HASH_QUEUE hashes may be
+    waiting or running; beyond that PasswordBusy is raised right away instead
+    of queueing the request behind a burst. A sync worker still waits for its
+    own hash.
+
+    The cost is PASSWORD_HASH_ITERATIONS rounds of pbkdf2:sha256; use
+    `flask passwords benchmark` to pick a value for the machine. Hashes made
+    with other parameters still verify, and needs_rehash() tells when one
+    should be replaced.
+    """
+
+    def __init__(self, app=None):
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._slots = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.workers = app.config['PASSWORD_HASH_WORKERS']
+        self.timeout = app.config['PASSWORD_HASH_TIMEOUT']
+        self.method = f'pbkdf2:sha256:{app.config["PASSWORD_HASH_ITERATIONS"]}'
+        self._slots = threading.BoundedSemaphore(self.workers + app.config['PASSWORD_HASH_QUEUE'])
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, method=self.method)
+
+    def verify(self, pwhash, password):
+        if not pwhash:
+            return False
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        return not pwhash or pwhash.split('$', 1)[0] != self.method
+
+    def _run(self, fn, *args, **kwargs):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordBusy()
+        try:
+            future = self._pool().submit(fn, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        # The slot is held until the hash is done, not until we stop waiting
+        # for it: a hash that timed out still occupies the pool.
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise PasswordBusy()
+
+    def _pool(self):
+        # A pool created before gunicorn forks has no threads in the child.
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    if monkey is not None and monkey.is_module_patched('threading'):
+                        self._executor = NativeThreadPoolExecutor(max_workers=self.workers)
+                    else:
+                        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+                    self._pid = os.getpid()
+        return self._executor
+
+
+hasher = PasswordHasher(app)
+
+
+def benchmark(iterations, rounds=20):
+    """
+    Measures the cost of one verification with the given iteration count.
+
+    :return: a (seconds per hash, sign-ins per second per core) tuple
+    """
+    pwhash = generate_password_hash('benchmark', method=f'pbkdf2:sha256:{iterations}')
+    started = perf_counter()
+    for _ in range(rounds):
+        check_password_hash(pwhash, 'benchmark')
+    seconds = (perf_counter() - started) / rounds
+    return seconds, 1 / seconds
@@ -0,0 +1,192 @@
+import json
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from time import perf_counter
+
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import app
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+PLACEHOLDER = re.compile(r'%\(\w+\)s|:\w+|%s|\?')
+PLACEHOLDER_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+WHITESPACE = re.compile(r'\s+')
+
+
+def normalize(statement):
+    """
+    Reduces a statement to its shape: literals and bound parameters become
+    `?`, IN lists collapse to a single `(?)` and whitespace is collapsed, so
+    that the queries of an N+1 loop all have the same shape.
+    """
+    shape = STRING_LITERAL.sub('?', statement)
+    shape = PLACEHOLDER.sub('?', shape)
+    shape = NUMBER_LITERAL.sub('?', shape)
+    shape = PLACEHOLDER_LIST.sub('(?)', shape)
+    return WHITESPACE.sub(' ', shape).strip()
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised by query_budget() when a block ran more queries than allowed."""
+
+
+class QueryRecorder(object):
+    """
+    The statements run by one thread while it is active, grouped by shape.
+
+    :param slow_threshold: statements taking at least this many seconds are
+                           also kept in full
+    """
+
+    def __init__(self, slow_threshold=float('inf')):
+        self.thread = threading.get_ident()
+        self.slow_threshold = slow_threshold
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = OrderedDict()
+        self.slow = []
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        shape = normalize(statement)
+        entry = self.shapes.setdefault(shape, [0, 0.0])
+        entry[0] += 1
+        entry[1] += duration
+        if duration >= self.slow_threshold:
+            self.slow.append((duration, statement))
+
+    def findings(self, repeat_threshold):
+        """
+        :return: a list of dicts, one per shape run at least `repeat_threshold`
+                 times ('repeated') and one per slow statement ('slow')
+        """
+        findings = [{'kind': 'repeated', 'count': count, 'seconds': round(seconds, 6), 'statement': shape}
+                    for shape, (count, seconds) in self.shapes.items() if count >= repeat_threshold]
+        findings += [{'kind': 'slow', 'seconds': round(duration, 6), 'statement': statement}
+                     for duration, statement in self.slow]
+        return findings
+
+    def summary(self, limit=10):
+        lines = [f'{self.count} queries in {self.duration * 1000:.1f} ms']
+        shapes = sorted(self.shapes.items(), key=lambda item: -item[1][0])
+        lines += [f'  {count:4d} x  {shape}' for shape, (count, _) in shapes[:limit]]
+        return '\n'.join(lines)
+
+
+class QueryWatch(object):
+    """
+    Spots N+1 patterns and slow statements.
+
+    With QUERY_WATCH_ENABLED (meant for tests and staging, it costs a regex
+    pass per statement) the statements of every request are grouped by
+    shape. A shape run QUERY_REPEAT_THRESHOLD times or more within one
+    request, which is what a lazy relationship read inside a template loop
+    looks like, and any statement taking SLOW_QUERY_THRESHOLD seconds or more
+    are logged as warnings and, if QUERY_REPORT_PATH is set, appended to that
+    file as JSON lines.
+
+    query_budget() records the statements of a block independently of the
+    setting, for tests.
+    """
+
+    def __init__(self, app=None):
+        self._recorders = []
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config['QUERY_WATCH_ENABLED']
+        self.repeat_threshold = app.config['QUERY_REPEAT_THRESHOLD']
+        self.slow_threshold = app.config['SLOW_QUERY_THRESHOLD']
+        self.report_path = app.config['QUERY_REPORT_PATH']
+        app.before_request(self._start_request)
+        app.after_request(self._end_request)
+        event.listen(Engine, 'before_cursor_execute', self._start_query)
+        event.listen(Engine, 'after_cursor_execute', self._end_query)
+
+    @contextmanager
+    def recording(self, slow_threshold=float('inf')):
+        """Records the statements the current thread runs within the block."""
+        recorder = QueryRecorder(slow_threshold)
+        with self._lock:
+            self._recorders.append(recorder)
+        try:
+            yield recorder
+        finally:
+            with self._lock:
+                self._recorders.remove(recorder)
+
+    @contextmanager
+    def budget(self, max_queries, max_repeats=None):
+        """
+        Fails when the block runs more than `max_queries` statements, or runs
+        any one shape more than `max_repeats` times::
+
+            with query_budget(5, max_repeats=1):
+                client.get('/history')
+
+        :raise QueryBudgetExceeded: with a summary of the statements run
+        """
+        with self.recording() as recorder:
+            yield recorder
+        if recorder.count > max_queries:
+            raise QueryBudgetExceeded(f'Expected at most {max_queries} queries, got {recorder.summary()}')
+        if max_repeats is not None:
+            repeated = recorder.findings(max_repeats + 1)
+            if repeated:
+                raise QueryBudgetExceeded(f'A statement ran more than {max_repeats} times, '
+                                          f'got {recorder.summary()}')
+
+    def report(self, endpoint, recorder):
+        findings = recorder.findings(self.repeat_threshold)
+        for finding in findings:
+            if finding['kind'] == 'repeated':
+                self.app.logger.warning(f'{endpoint}: possible N+1, {finding["count"]} x {finding["statement"]}')
+            else:
+                self.app.logger.warning(f'{endpoint}: slow query ({finding["seconds"]:.3f} s) {finding["statement"]}')
+        if findings and self.report_path:
+            timestamp = datetime.utcnow().isoformat() + 'Z'
+            with self._lock, open(self.report_path, 'a') as f:
+                for finding in findings:
+                    f.write(json.dumps(dict(finding, endpoint=endpoint, time=timestamp)) + '\n')
+        return findings
+
+    def _start_request(self):
+        if self.enabled:
+            g._query_recorder = QueryRecorder(self.slow_threshold)
+
+    def _end_request(self, response):
+        recorder = g.pop('_query_recorder', None)
+        if recorder is not None:
+            self.report(request.endpoint or request.path, recorder)
+        return response
+
+    def _start_query(self, conn, cursor, statement, parameters, context, executemany):
+        if not self.enabled and not self._recorders:
+            return
+        conn.info.setdefault('query_watch_started', []).append(perf_counter())
+
+    def _end_query(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get('query_watch_started')
+        if not started:
+            return
+        duration = perf_counter() - started.pop()
+        thread = threading.get_ident()
+        recorders = [recorder for recorder in self._recorders if recorder.thread == thread]
+        if has_request_context() and getattr(g, '_query_recorder', None) is not None:
+            recorders.append(g._query_recorder)
+        for recorder in recorders:
+            recorder.record(statement, duration)
+
+
+query_watch = QueryWatch(app)
+query_budget = query_watch.budget
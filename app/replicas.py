@@ -0,0 +1,150 @@
+import random
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from time import monotonic, time
+
+from flask import g, session, has_app_context, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm, select
+from sqlalchemy.sql.expression import UpdateBase
+
+
+def read_only(f):
+    """
+    Lets the queries of a view go to a replica.
+
+    Only for views that never write and can live with data up to
+    REPLICA_MAX_LAG seconds old.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        with replica_reads():
+            return f(*args, **kwargs)
+    return decorated_function
+
+
+@contextmanager
+def replica_reads():
+    """Lets the queries run within the block go to a replica, see read_only()."""
+    previous = g.get('_replica_reads', False)
+    g._replica_reads = True
+    try:
+        yield
+    finally:
+        g._replica_reads = previous
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session that sends the reads of read_only() views to a replica.
+
+    Everything else goes to the primary: flushes and UPDATE/INSERT/DELETE
+    statements, any read once the session has written, and the reads of a
+    browser session that wrote less than READ_YOUR_WRITES_WINDOW seconds ago.
+    The replica is picked once per session, so a request sees one snapshot.
+    """
+
+    def __init__(self, db, **options):
+        self.wrote = False
+        self.router = db.router
+        self._replica = None
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.wrote = True
+        elif not self.wrote and has_app_context() and g.get('_replica_reads') and self.router.replicas:
+            if self._replica is None:
+                self._replica = self.router.choose() or False
+            if self._replica:
+                return self._replica
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy with replica routing, see RoutingSession and ReplicaRouter."""
+
+    def init_app(self, app):
+        super(RoutingSQLAlchemy, self).init_app(app)
+        self.router = ReplicaRouter(app, self)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class ReplicaRouter(object):
+    """
+    Keeps track of how far behind each replica is.
+
+    The replicas are the SQLALCHEMY_BINDS named replica*, filled from
+    DATABASE_REPLICA_URLS. At most every REPLICA_CHECK_INTERVAL seconds a
+    worker compares the replication_heartbeat row of every replica with the
+    one of the primary, whose difference is the replica's lag (to within the
+    interval), and then stamps the current time into the primary's row if
+    it is older than the interval, for the next check to see. Replicas
+    more than REPLICA_MAX_LAG seconds behind, or that cannot be reached, get
+    no reads until a later check finds them caught up.
+    """
+
+    def __init__(self, app, db):
+        self.db = db
+        self.app = app
+        self.replicas = sorted(key for key in app.config['SQLALCHEMY_BINDS'] or {} if key.startswith('replica'))
+        self.max_lag = app.config['REPLICA_MAX_LAG']
+        self.check_interval = app.config['REPLICA_CHECK_INTERVAL']
+        self.window = app.config['READ_YOUR_WRITES_WINDOW']
+        self.lag = {}
+        self._checked = None
+        self._lock = threading.Lock()
+        app.after_request(self._remember_writes)
+
+    def choose(self):
+        """:return: the engine of an up to date replica, or None for the primary"""
+        if has_request_context() and session.get('_primary_until', 0) > time():
+            return None
+        if self._checked is None or monotonic() - self._checked >= self.check_interval:
+            self.check()
+        healthy = [key for key in self.replicas if self.lag.get(key) is not None and self.lag[key] <= self.max_lag]
+        if not healthy:
+            return None
+        return self.db.get_engine(self.app, bind=random.choice(healthy))
+
+    def check(self):
+        with self._lock:
+            if self._checked is not None and monotonic() - self._checked < self.check_interval:
+                return
+            heartbeat = self.db.Model.metadata.tables['replication_heartbeat']
+            now = datetime.utcnow()
+            primary = self.db.get_engine(self.app)
+            with primary.connect() as connection:
+                stamp = connection.execute(select([heartbeat.c.timestamp]).where(heartbeat.c.id == 1)).scalar()
+            for key in self.replicas:
+                try:
+                    with self.db.get_engine(self.app, bind=key).connect() as connection:
+                        replayed = connection.execute(
+                            select([heartbeat.c.timestamp]).where(heartbeat.c.id == 1)).scalar()
+                except Exception:
+                    self.app.logger.exception(f'Replica {key} is unreachable')
+                    self.lag[key] = None
+                    continue
+                if stamp is None:
+                    self.lag[key] = 0.0
+                else:
+                    self.lag[key] = (stamp - replayed).total_seconds() if replayed else float('inf')
+                if self.lag[key] > self.max_lag:
+                    self.app.logger.warning(f'Replica {key} is {self.lag[key]:.0f} s behind, reading from the primary')
+            # Read before stamping: right after the stamp, even a replica
+            # that is up to date would not have it yet.
+            with primary.begin() as connection:
+                if stamp is None:
+                    connection.execute(heartbeat.insert().values(id=1, timestamp=now))
+                elif (now - stamp).total_seconds() >= self.check_interval:
+                    connection.execute(heartbeat.update().where(heartbeat.c.id == 1).values(timestamp=now))
+            self._checked = monotonic()
+
+    def _remember_writes(self, response):
+        if self.replicas and self.db.session.registry.has() and self.db.session().wrote:
+            session['_primary_until'] = time() + self.window
+        return response
@@ -0,0 +1,191 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select, text, bindparam, DateTime
+
+from app import app, db
+from app.models import User, Level, CreditEntry, Activity, Rollup, RollupWatermark
+
+GRANULARITIES = ('hour', 'day')
+
+# Adds the new counts to an existing bucket and replaces its hash rate. The
+# ON CONFLICT clause is understood by both PostgreSQL and SQLite (3.24+).
+UPSERT = text(
+    'INSERT INTO rollup (granularity, user_id, bucket, credits, activities, hash_rate) '
+    'VALUES (:granularity, :user_id, :bucket, :credits, :activities, :hash_rate) '
+    'ON CONFLICT (granularity, user_id, bucket) DO UPDATE SET '
+    'credits = rollup.credits + excluded.credits, '
+    'activities = rollup.activities + excluded.activities, '
+    'hash_rate = COALESCE(excluded.hash_rate, rollup.hash_rate)'
+).bindparams(bindparam('bucket', type_=DateTime))
+
+
+def truncate(timestamp, granularity):
+    if granularity == 'day':
+        return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def _hour(column):
+    """SQL expression truncating a timestamp column to the hour."""
+    if db.engine.dialect.name == 'sqlite':
+        return func.strftime('%Y-%m-%d %H:00:00', column)
+    return func.date_trunc('hour', column)
+
+
+def _as_datetime(value):
+    # SQLite hands back the strftime() string, PostgreSQL a datetime.
+    if isinstance(value, str):
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    return value
+
+
+class Buckets(object):
+    """Accumulates per-user and global counts for hourly and daily buckets."""
+
+    def __init__(self):
+        self.rows = {}
+
+    def add(self, user_id, hour, credits=0, activities=0, hash_rate=None):
+        for granularity in GRANULARITIES:
+            bucket = truncate(hour, granularity)
+            for owner in (user_id, Rollup.GLOBAL):
+                row = self.rows.setdefault((granularity, owner, bucket), {
+                    'granularity': granularity, 'user_id': owner, 'bucket': bucket,
+                    'credits': 0, 'activities': 0, 'hash_rate': None,
+                })
+                row['credits'] += credits
+                row['activities'] += activities
+                if hash_rate is not None and owner != Rollup.GLOBAL:
+                    row['hash_rate'] = hash_rate
+
+    def __len__(self):
+        return len(self.rows)
+
+
+def _watermark(source):
+    mark = RollupWatermark.query.get(source)
+    if mark is None:
+        mark = RollupWatermark(source=source, last_id=0)
+        db.session.add(mark)
+    return mark
+
+
+def _horizon(table, settle):
+    """
+    The highest id that can be folded without skipping rows for good.
+
+    PostgreSQL hands out ids when rows are inserted, not when they are
+    committed: while a transaction is open, rows with higher ids may already
+    be visible and those with its lower ids are not, and a watermark past
+    them would never come back. So only rows older than `settle` seconds are
+    taken, assuming no transaction writing them stays open that long. SQLite
+    writes one transaction at a time, in id order, so everything is safe.
+    """
+    if db.engine.dialect.name == 'sqlite':
+        return db.session.query(func.max(table.c.id)).scalar() or 0
+    cutoff = datetime.utcnow() - timedelta(seconds=settle)
+    return db.session.query(func.max(table.c.id)).filter(table.c.timestamp < cutoff).scalar() or 0
+
+
+def _roll(source, aggregate, batch_size, settle):
+    """
+    Folds the rows of `source` added since its watermark into the rollups,
+    batch_size ids at a time. The buckets and the new watermark are written
+    in the same transaction, so every row is counted exactly once, provided
+    a single job runs at a time.
+    """
+    table = db.Model.metadata.tables[source]
+    high = _horizon(table, settle)
+    processed = 0
+    mark = _watermark(source)
+    while mark.last_id < high:
+        first, last = mark.last_id, min(mark.last_id + batch_size, high)
+        buckets = Buckets()
+        aggregate(buckets, table.c.id > first, table.c.id <= last)
+        if buckets.rows:
+            db.session.execute(UPSERT, list(buckets.rows.values()))
+        mark.last_id = last
+        db.session.commit()
+        processed += last - first
+    db.session.commit()
+    return processed
+
+
+def _aggregate_credits(buckets, *window):
+    entry, user, level = CreditEntry.__table__, User.__table__, Level.__table__
+    hour = _hour(entry.c.timestamp)
+    q = select([entry.c.user_id, hour, func.sum(entry.c.delta), level.c.hash_rate]) \
+        .select_from(entry.join(user, user.c.id == entry.c.user_id)
+                          .outerjoin(level, level.c.id == user.c.level_id)) \
+        .where(db.and_(*window)) \
+        .group_by(entry.c.user_id, hour, level.c.hash_rate)
+    for user_id, bucket, credits, hash_rate in db.session.execute(q):
+        buckets.add(user_id, _as_datetime(bucket), credits=int(credits or 0), hash_rate=hash_rate)
+
+
+def _aggregate_activities(buckets, *window):
+    activity = Activity.__table__
+    hour = _hour(activity.c.timestamp)
+    q = select([activity.c.user_id, hour, func.count(activity.c.id)]) \
+        .where(db.and_(*window)) \
+        .group_by(activity.c.user_id, hour)
+    for user_id, bucket, count in db.session.execute(q):
+        buckets.add(user_id, _as_datetime(bucket), activities=count)
+
+
+def _sample_hash_rate(now):
+    """Records the total hash rate of all users in the current buckets."""
+    user, level = User.__table__, Level.__table__
+    total = db.session.execute(
+        select([func.coalesce(func.sum(level.c.hash_rate), 0)])
+        .select_from(user.join(level, level.c.id == user.c.level_id))).scalar()
+    db.session.execute(UPSERT, [
+        {'granularity': granularity, 'user_id': Rollup.GLOBAL, 'bucket': truncate(now, granularity),
+         'credits': 0, 'activities': 0, 'hash_rate': float(total)}
+        for granularity in GRANULARITIES])
+    db.session.commit()
+
+
+def update_rollups(batch_size=None, settle=None):
+    """
+    Brings the hourly and daily rollups up to date.
+
+    Only credit ledger entries and activities with ids above the watermarks
+    left by the previous run are read, so each run costs in proportion to
+    what happened since, not to the length of the history. Each user gets a
+    row per hour and per day with the credits earned, the activities logged
+    and the hash rate of their level; user_id 0 holds the totals over all
+    users, with the hash rate sampled at the time of the run.
+
+    :param batch_size: the number of source ids folded per transaction
+    :param settle: the age in seconds rows must have to be folded, see _horizon()
+    :return: a dict of source table -> number of ids processed
+    """
+    batch_size = batch_size or app.config['ROLLUP_BATCH_SIZE']
+    settle = app.config['ROLLUP_SETTLE'] if settle is None else settle
+    done = {
+        'credit_entry': _roll('credit_entry', _aggregate_credits, batch_size, settle),
+        'activity': _roll('activity', _aggregate_activities, batch_size, settle),
+    }
+    _sample_hash_rate(datetime.utcnow())
+    return done
+
+
+def series(user_id, granularity='hour', points=None):
+    """
+    Returns the most recent rollup buckets of a user (or Rollup.GLOBAL),
+    oldest first, ready for the dashboard charts.
+    """
+    if granularity not in GRANULARITIES:
+        granularity = 'hour'
+    points = min(points or app.config['ROLLUP_MAX_POINTS'], app.config['ROLLUP_MAX_POINTS'])
+    step = timedelta(days=1) if granularity == 'day' else timedelta(hours=1)
+    since = truncate(datetime.utcnow(), granularity) - step * (points - 1)
+    rows = Rollup.query \
+        .filter_by(granularity=granularity, user_id=user_id) \
+        .filter(Rollup.bucket >= since) \
+        .order_by(Rollup.bucket) \
+        .limit(points).all()
+    return [{'bucket': row.bucket.isoformat(), 'credits': row.credits,
+             'activities': row.activities, 'hash_rate': row.hash_rate}
+            for row in rows]
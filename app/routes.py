@@ -1,21 +1,46 @@
+import hmac
 from datetime import datetime
-from flask import render_template, flash, redirect, url_for, request
+from functools import wraps
+
+from flask import render_template, flash, redirect, url_for, request, jsonify, abort, Response, stream_with_context
 from flask_login import current_user, login_user, logout_user, login_required
 from werkzeug.urls import url_parse
 
 from app import app, db
 from app.forms import LoginForm, RegistrationForm, EditProfileForm, ResetPasswordRequestForm, ResetPasswordForm, \
     SubmitTicketForm
-from app.models import User, Level
+from app.models import User, Rollup
+from app.assets import assets
+from app.bloom import taken_identities
+from app.bulk import EXPORT_FIELDS, export_rows, serialize, gzipped
+from app.catalog import level_catalog
+from app.datatables import KeysetTable, CatalogTable, match_prefix, match_int, match_bool
 from app.email import send_password_reset_email
+from app.events import events
+from app.history import activity_page
+from app.metrics import metrics
+from app.passwords import PasswordBusy
+from app.replicas import read_only
+from app.rollup import series, GRANULARITIES
+from app.tracking import last_seen_tracker
+
+
+def admin_required(f):
+    @wraps(f)
+    @login_required
+    def decorated(*args, **kwargs):
+        if not current_user.is_admin:
+            abort(403)
+        return f(*args, **kwargs)
+    return decorated
 
 
 @app.before_request
 def before_request():
+    # The last_seen timestamp is only recorded in memory here; the tracker
+    # flushes it to the database in bulk from a background thread.
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.add(current_user)
-        db.session.commit()
+        last_seen_tracker.touch(current_user.id, current_user.last_seen)
 
 
 ###
@@ -30,12 +55,57 @@ def index():
     return render_template('production/home.html', title='Home')
 
 
+@app.route('/stats/series.json')
+@login_required
+@read_only
+def stats_series():
+    # Charts read pre-aggregated rollups only; scope=global shows the totals
+    # over all users.
+    user_id = Rollup.GLOBAL if request.args.get('scope') == 'global' else current_user.id
+    granularity = request.args.get('granularity')
+    if granularity not in GRANULARITIES:
+        granularity = 'hour'
+    return jsonify({
+        'granularity': granularity,
+        'series': series(user_id, granularity, request.args.get('points', type=int)),
+    })
+
+
+@app.route('/events/stream')
+@login_required
+def event_stream():
+    # Server-sent events with the credit, level and accrual updates of the
+    # user, see app.events. The connection stays open: run gunicorn with an
+    # async worker class (-k gevent) so that an idle stream costs a greenlet
+    # rather than a thread. Nothing below touches the database.
+    subscription = events.subscribe(current_user.id)
+    return Response(subscription.stream(events.heartbeat), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/account/balance.json')
+@login_required
+def account_balance():
+    # Read from the primary, and not from the cached snapshot: the dashboard
+    # asks right after an accrual, see the 'accrual' event.
+    credit = db.session.query(User.credit).filter(User.id == current_user.id).scalar()
+    return jsonify({'credit': credit or 0})
+
+
 @app.route('/history')
 @login_required
 def history():
     return render_template('production/history.html', title='History')
 
 
+@app.route('/history/activities.json')
+@login_required
+@read_only
+def history_activities():
+    page = activity_page(current_user.id, request.args.get('cursor'), request.args.get('limit', type=int))
+    return jsonify(page)
+
+
 @app.route('/profile')
 @login_required
 def profile():
@@ -51,6 +121,7 @@ def contact_us():
 
 @app.route('/pricing')
 @login_required
+@read_only
 def pricing():
     return render_template('production/pricing.html', title='Pricing')
 
@@ -66,10 +137,70 @@ def test():
 
 
 @app.route('/admin')
+@admin_required
 def admin():
-    users = User.query.all()
-    contracts = Level.query.all()
-    return render_template('production/admin.html', title='Admin', users=users, contracts=contracts)
+    # The tables are filled page by page from the JSON endpoints below.
+    return render_template('production/admin.html', title='Admin')
+
+
+def search_users(value):
+    if value.isdigit():
+        return User.id == int(value)
+    return db.or_(match_prefix(User.username)(value), match_prefix(User.email)(value))
+
+
+user_table = KeysetTable(
+    User, ['id', 'username', 'display_name', 'email', 'level_id', 'is_admin'],
+    search=search_users,
+    filters={
+        'id': match_int(User.id),
+        'username': match_prefix(User.username),
+        'email': match_prefix(User.email),
+        'level_id': match_int(User.level_id),
+        'is_admin': match_bool(User.is_admin),
+    })
+
+# Levels are few and already in memory, see app.catalog.
+contract_table = CatalogTable(
+    level_catalog.all, ['id', 'title', 'hash_rate', 'profit_rate', 'affiliate_bonus', 'price'],
+    search=['title'])
+
+
+@app.route('/admin/users.json')
+@admin_required
+@read_only
+def admin_users():
+    return jsonify(user_table.query(request.args))
+
+
+@app.route('/admin/contracts.json')
+@admin_required
+def admin_contracts():
+    return jsonify(contract_table.query(request.args))
+
+
+@app.route('/admin/export/<name>.<fmt>.gz')
+@admin_required
+def admin_export(name, fmt):
+    # A whole table as gzipped CSV or JSON lines, e.g.
+    # /admin/export/activities.csv.gz?level=2&since=2018-01-01&until=2018-01-31
+    # The response is generated while it is sent, from a server-side cursor,
+    # so memory stays flat however large the table is.
+    if name not in EXPORT_FIELDS or fmt not in ('csv', 'jsonl'):
+        abort(404)
+    try:
+        since, until = (datetime.strptime(request.args[arg], '%Y-%m-%d') if request.args.get(arg) else None
+                        for arg in ('since', 'until'))
+    except ValueError:
+        abort(400)
+    level_ids = request.args.getlist('level', type=int)
+    # Read from a replica if one is up to date, see app.replicas.
+    engine = (db.router.replicas and db.router.choose()) or db.engine
+    rows = export_rows(name, level_ids, since, until, engine)
+    body = gzipped(serialize(rows, EXPORT_FIELDS[name], fmt))
+    filename = f'{name}-{datetime.utcnow():%Y%m%d}.{fmt}.gz'
+    return Response(stream_with_context(body), mimetype='application/gzip',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
 
 
 @app.route('/signin', methods=['GET', 'POST'])
@@ -81,10 +212,22 @@ def signin2():
     # After the user posted login credential
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
+        try:
+            valid = user is not None and user.check_password(form.password.data)
+        except PasswordBusy:
+            flash('Too many people are signing in right now, please try again in a moment')
+            return redirect(url_for('signin2'))
         # If the credential is invalid, return to login page
-        if user is None or not user.check_password(form.password.data):
+        if not valid:
             flash('Invalid username or password')
             return redirect(url_for('signin2'))
+        # Upgrade hashes made with an older cost now that the password is known
+        if user.password_needs_rehash():
+            try:
+                user.rehash_password(form.password.data)
+                db.session.commit()
+            except PasswordBusy:
+                pass
         # Otherwise log in the user
         login_user(user, remember=form.remember_me.data)
         next_page = request.args.get('next')
@@ -104,9 +247,14 @@ def signup2():
     form = RegistrationForm()
     if form.validate_on_submit():
         usr = User(username=form.username.data, email=form.email.data)
-        usr.set_password(form.password.data)
+        try:
+            usr.set_password(form.password.data)
+        except PasswordBusy:
+            flash('Too many people are signing up right now, please try again in a moment')
+            return render_template('production/signup.html', title='Sign Up', form=form)
         db.session.add(usr)
         db.session.commit()
+        taken_identities.add(usr.username, usr.email)
         # token = user.generate_confirmation_token()
         # send_email(user.email, 'Confirm Your Account', 'auth/email/confirm', user=user, token=token)
         # flash('A confirmation email has been sent to you by email.')
@@ -116,6 +264,21 @@ def signup2():
     return render_template('production/signup.html', title='Sign Up', form=form)
 
 
+@app.route('/signup/check')
+def signup_check():
+    """
+    Tells whether a username and/or email are still available, for the live
+    checks of the signup page. Values the Bloom filter has never seen are
+    answered without a query; the others are looked up together.
+    """
+    values = {kind: request.args.get(kind, '').strip() for kind in ('username', 'email')}
+    values = {kind: value for kind, value in values.items() if value}
+    maybe = {kind: value for kind, value in values.items()
+             if taken_identities.might_be_taken(kind, value)}
+    taken = User.find_taken(**maybe) if maybe else set()
+    return jsonify({kind: kind not in taken for kind in values})
+
+
 @app.route('/logout')
 @login_required
 def logout():
@@ -215,3 +378,22 @@ def logout():
 #         flash('Your password has been reset.')
 #         return redirect(url_for('login'))
 #     return render_template('reset_password.html', form=form)
+
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    """Serves the hashed bundles, precompressed and cacheable for a year."""
+    return assets.send(filename)
+
+
+@app.route('/metrics')
+def export_metrics():
+    """Request metrics of all the workers, for Prometheus to scrape."""
+    # Without a token, only the admins may look.
+    token = app.config['METRICS_TOKEN']
+    if token:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            abort(403)
+    elif not (current_user.is_authenticated and current_user.is_admin):
+        abort(403)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
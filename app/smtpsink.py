@@ -0,0 +1,106 @@
+import socketserver
+import threading
+from email import message_from_bytes
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """
+    A minimal SMTP server that accepts every message and keeps it in memory.
+
+    It stands in for a real mail server while developing or testing the mail
+    queue, e.g. with MAIL_SERVER=localhost and MAIL_PORT=8025:
+
+        sink = SMTPSink(('localhost', 8025))
+        sink.start()
+        ...
+        sink.messages  # list of email.message.Message
+        sink.stop()
+
+    or from a shell with `python -m app.smtpsink [port]`, which prints the
+    messages as they arrive. Only the commands smtplib needs for plain
+    delivery are understood; there is no TLS or authentication.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('localhost', 8025), echo=False):
+        self.messages = []
+        self.connections = 0
+        self.echo = echo
+        self._lock = threading.Lock()
+        self._thread = None
+        super(SMTPSink, self).__init__(address, SMTPSinkHandler)
+
+    def deliver(self, mail_from, rcpt_to, data):
+        message = message_from_bytes(data)
+        with self._lock:
+            self.messages.append(message)
+        if self.echo:
+            print(f'---------- MESSAGE FROM {mail_from} TO {", ".join(rcpt_to)} ----------')
+            print(data.decode('utf-8', 'replace'))
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='smtp-sink', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        with self.server._lock:
+            self.server.connections += 1
+        self.reply('220 localhost SMTP sink ready')
+        mail_from, rcpt_to = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii', 'replace').strip()
+            verb = command[:4].upper()
+            if verb in ('HELO', 'EHLO'):
+                self.reply('250 localhost')
+            elif verb == 'MAIL':
+                mail_from, rcpt_to = command[10:].strip(), []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                rcpt_to.append(command[8:].strip())
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line in (b'.\r\n', b'.\n'):
+                        break
+                    # Undo the dot-stuffing of the client.
+                    lines.append(line[1:] if line.startswith(b'..') else line)
+                self.server.deliver(mail_from, rcpt_to, b''.join(lines))
+                self.reply('250 OK')
+            elif verb in ('RSET', 'NOOP'):
+                mail_from, rcpt_to = None, []
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+if __name__ == '__main__':
+    import sys
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8025
+    sink = SMTPSink(('localhost', port), echo=True)
+    print(f'SMTP sink listening on localhost:{port}')
+    try:
+        sink.serve_forever()
+    except KeyboardInterrupt:
+        sink.server_close()
@@ -0,0 +1,281 @@
+import multiprocessing
+import os
+import queue
+import re
+import tempfile
+import threading
+from concurrent.futures import Future
+from time import monotonic, perf_counter, sleep
+
+from sqlalchemy import create_engine, event
+
+from app import app, db
+
+# Not available on Windows, where only the threads of one process are serialized.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+WRITE_STATEMENT = re.compile(r'\s*(INSERT|UPDATE|DELETE|REPLACE|CREATE|DROP|ALTER)\b', re.I)
+
+
+class WriteLockTimeout(Exception):
+    """Raised when the database write lock could not be taken in time."""
+
+
+class WriteLock(object):
+    """
+    Exclusive lock over the writers of all the processes of this machine.
+
+    A thread lock orders the connections of one process and an flock() on a
+    file next to the database the processes. Unlike SQLite's own locking,
+    the threads of a process queue on it instead of sleeping and retrying.
+    The flock() itself is polled without blocking, so that under gevent
+    (whose monkey-patched sleep() yields) the other greenlets of the worker
+    keep running while another process writes.
+    """
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self.owner = None
+        self._lock = threading.Lock()
+        self._fd = None
+        self._pid = None
+
+    def acquire(self):
+        if self._pid != os.getpid():
+            # Neither the thread lock nor the open file may be shared with
+            # the process we were forked from.
+            self._lock = threading.Lock()
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600) if fcntl else None
+            self._pid = os.getpid()
+        deadline = monotonic() + self.timeout
+        if not self._lock.acquire(timeout=self.timeout):
+            raise WriteLockTimeout(f'No write lock on {self.path} after {self.timeout} s')
+        try:
+            if self._fd is not None:
+                self._flock(deadline)
+        except Exception:
+            self._lock.release()
+            raise
+        self.owner = threading.get_ident()
+
+    def _flock(self, deadline):
+        delay = 0.0005
+        while True:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                if monotonic() >= deadline:
+                    raise WriteLockTimeout(f'No write lock on {self.path} after {self.timeout} s')
+                sleep(delay)
+                delay = min(delay * 2, 0.05)
+
+    def release(self):
+        self.owner = None
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+
+class SQLiteWriter(object):
+    """
+    Single-writer mode for SQLite databases.
+
+    SQLite allows one writer at a time, and several gunicorn workers writing
+    at once get "database is locked" errors or sleep in its busy handler.
+    In this mode:
+
+    - connections use WAL, so readers never wait for the writer, with
+      synchronous=NORMAL and the SQLITE_* cache and busy timeout settings;
+    - every connection of the engine takes a WriteLock before its first
+      write statement and keeps it until it commits or rolls back, so write
+      transactions run one after the other across threads and processes:
+      the accrual, imports, rollups and partition moves included;
+    - run() hands small write transactions (credits, and the last_seen and
+      activity flushes of app.tracking) to a writer thread that commits
+      up to SQLITE_GROUP_COMMIT_SIZE of them, arriving within
+      SQLITE_GROUP_COMMIT_WAIT seconds of each other, as one transaction.
+      If the group fails, its transactions are retried one by one. The
+      large batch jobs keep transactions of their own, under the lock.
+
+    It is on for sqlite:// file databases unless SQLITE_SINGLE_WRITER=0.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.lock = None
+        self._engine = None
+        self._queue = queue.Queue()
+        self._pid = None
+        self._thread_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        uri = app.config['SQLALCHEMY_DATABASE_URI']
+        if not app.config['SQLITE_SINGLE_WRITER'] or not uri.startswith('sqlite:///') or uri == 'sqlite://':
+            return
+        self.install(db.get_engine(app),
+                     busy_timeout=app.config['SQLITE_BUSY_TIMEOUT'],
+                     synchronous=app.config['SQLITE_SYNCHRONOUS'],
+                     cache_size=app.config['SQLITE_CACHE_SIZE'],
+                     group_size=app.config['SQLITE_GROUP_COMMIT_SIZE'],
+                     group_wait=app.config['SQLITE_GROUP_COMMIT_WAIT'],
+                     lock_timeout=app.config['SQLITE_WRITE_LOCK_TIMEOUT'])
+
+    def install(self, engine, busy_timeout=5000, synchronous='NORMAL', cache_size=20000,
+                group_size=200, group_wait=0.002, lock_timeout=30):
+        self.enabled = True
+        self.busy_timeout = busy_timeout
+        self.synchronous = synchronous
+        self.cache_size = cache_size
+        self.group_size = group_size
+        self.group_wait = group_wait
+        self.lock = WriteLock(engine.url.database + '-writelock', lock_timeout)
+        self._engine = engine
+        event.listen(engine, 'connect', self._configure)
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'commit', self._release)
+        event.listen(engine, 'rollback', self._release)
+        # In case a connection goes back to the pool in the middle of a write.
+        event.listen(engine, 'checkin', self._checkin)
+
+    def available(self):
+        """:return: whether run() may be used from this thread"""
+        # The writer thread would wait forever for a lock this thread holds.
+        return self.enabled and self.lock.owner != threading.get_ident()
+
+    def run(self, fn):
+        """
+        Runs fn(connection) in the next group commit and waits for it.
+
+        :return: what fn returned, once the group has been committed
+        """
+        self._ensure_thread()
+        future = Future()
+        self._queue.put((fn, future))
+        return future.result()
+
+    def _ensure_thread(self):
+        if self._pid == os.getpid():
+            return
+        with self._thread_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            threading.Thread(target=self._work, name='sqlite-writer', daemon=True).start()
+            self._pid = os.getpid()
+
+    def _work(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = monotonic() + self.group_wait
+            while len(batch) < self.group_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0, deadline - monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                with self._engine.begin() as connection:
+                    results = [fn(connection) for fn, _ in batch]
+            except Exception:
+                results = None
+            if results is not None:
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+                continue
+            for fn, future in batch:
+                try:
+                    with self._engine.begin() as connection:
+                        future.set_result(fn(connection))
+                except Exception as e:
+                    future.set_exception(e)
+
+    def _configure(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute(f'PRAGMA synchronous={self.synchronous}')
+        cursor.execute(f'PRAGMA busy_timeout={int(self.busy_timeout)}')
+        cursor.execute(f'PRAGMA cache_size=-{int(self.cache_size)}')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.close()
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if not conn.info.get('write_lock') and WRITE_STATEMENT.match(statement):
+            self.lock.acquire()
+            conn.info['write_lock'] = True
+
+    def _release(self, conn):
+        if conn.info.pop('write_lock', False):
+            self.lock.release()
+
+    def _checkin(self, dbapi_connection, connection_record):
+        if connection_record is not None and connection_record.info.pop('write_lock', False):
+            self.lock.release()
+
+
+sqlite_writer = SQLiteWriter(app)
+
+
+def _benchmark_worker(url, single_writer, threads, writes, results):
+    engine = create_engine(url)
+    writer = SQLiteWriter()
+    if single_writer:
+        writer.install(engine)
+    errors = []
+
+    def transaction(connection):
+        connection.execute('INSERT INTO ledger (account, delta) VALUES (?, 1)', (os.getpid(),))
+        connection.execute('UPDATE account SET balance = balance + 1 WHERE id = 1')
+
+    def work():
+        for _ in range(writes):
+            try:
+                if single_writer:
+                    writer.run(transaction)
+                else:
+                    with engine.begin() as connection:
+                        transaction(connection)
+            except Exception as e:
+                errors.append(str(e).splitlines()[0])
+
+    pool = [threading.Thread(target=work) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    results.put(errors)
+
+
+def benchmark(processes=4, threads=4, writes=100, single_writer=True):
+    """
+    Measures small write transactions (a ledger insert and a balance update)
+    on a scratch database, from `processes` processes of `threads` threads
+    each, as gunicorn's gthread workers would run them.
+
+    :return: a (committed transactions per second, list of errors) tuple
+    """
+    context = multiprocessing.get_context('fork')
+    with tempfile.TemporaryDirectory() as directory:
+        url = f'sqlite:///{os.path.join(directory, "bench.db")}'
+        engine = create_engine(url)
+        engine.execute('CREATE TABLE account (id INTEGER PRIMARY KEY, balance INTEGER NOT NULL)')
+        engine.execute('CREATE TABLE ledger (id INTEGER PRIMARY KEY, account INTEGER, delta INTEGER)')
+        engine.execute('INSERT INTO account (id, balance) VALUES (1, 0)')
+        engine.dispose()
+        results = context.Queue()
+        workers = [context.Process(target=_benchmark_worker, args=(url, single_writer, threads, writes, results))
+                   for _ in range(processes)]
+        started = perf_counter()
+        for worker in workers:
+            worker.start()
+        errors = [error for _ in workers for error in results.get()]
+        for worker in workers:
+            worker.join()
+        elapsed = perf_counter() - started
+        committed = create_engine(url).execute('SELECT balance FROM account').scalar()
+    return committed / elapsed, errors
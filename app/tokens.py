@@ -0,0 +1,282 @@
+import secrets
+import threading
+from functools import wraps
+from time import time
+
+import jwt
+from flask import g, request, jsonify
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from app.catalog import level_catalog
+from app.tracking import BackgroundFlusher, last_seen_tracker
+
+
+class TokenError(Exception):
+    """Raised when a token is malformed, expired, of the wrong kind or revoked."""
+
+
+class TokenIdentity(object):
+    """
+    The user an access token was issued to, as far as its claims tell.
+
+    Nothing is loaded from the database: the level comes from the in-memory
+    catalog. The claims are at most TOKEN_ACCESS_TTL seconds old.
+    """
+
+    def __init__(self, claims):
+        self.id = claims['uid']
+        self.level_id = claims['lvl']
+        self.is_admin = claims['adm']
+        self.claims = claims
+
+    @property
+    def level(self):
+        return level_catalog.get(self.level_id)
+
+    def __repr__(self):
+        return f'<TokenIdentity {self.id}>'
+
+
+class RevocationList(BackgroundFlusher):
+    """
+    Per-worker copy of the token_revocation table.
+
+    A row revokes either one token, by its jti, or all the tokens of a user
+    issued before a given time (only the access tokens unless `refresh` is
+    set). Rows are kept until the tokens they revoke would have expired
+    anyway, so the list stays small. Each worker loads it once, then a
+    background thread reads the rows added since every
+    TOKEN_REVOCATION_REFRESH_INTERVAL seconds: a token revoked by another
+    worker is accepted for at most that long, and checking one never
+    queries the database.
+
+    Rows are read by creation time, and each refresh reads again those
+    created up to TOKEN_REVOCATION_SETTLE seconds before the previous one:
+    a revocation whose transaction commits late, or stamped by a host whose
+    clock lags, is still picked up. Applying a row twice changes nothing.
+    """
+
+    thread_name = 'token-revocations'
+
+    def __init__(self, app=None):
+        self._jtis = {}
+        self._users = {}
+        self._loaded = None
+        self._data_lock = threading.Lock()
+        super(RevocationList, self).__init__(app)
+
+    def init_app(self, app):
+        super(RevocationList, self).init_app(app)
+        self.flush_interval = app.config['TOKEN_REVOCATION_REFRESH_INTERVAL']
+        self.settle = app.config['TOKEN_REVOCATION_SETTLE']
+
+    def is_revoked(self, claims):
+        self._ensure_thread()
+        if self._loaded is None:
+            self._load()
+        if claims['jti'] in self._jtis:
+            return True
+        cutoffs = self._users.get(claims['uid'])
+        if cutoffs is None:
+            return False
+        access, refresh, _ = cutoffs
+        return claims['iat'] < (refresh if claims['typ'] == 'refresh' else access)
+
+    def revoke(self, claims, connection=None):
+        """
+        Revokes one token, until it expires.
+
+        :return: False if the token had already been revoked, by any worker
+        """
+        try:
+            self._insert(connection, jti=claims['jti'], expires=claims['exp'])
+        except IntegrityError:
+            # jti is unique: somebody revoked it first.
+            with self._data_lock:
+                self._apply(claims['jti'], None, None, False, claims['exp'])
+            return False
+        return True
+
+    def revoke_user(self, user_id, refresh=False, connection=None):
+        """
+        Revokes the access tokens of a user issued until now, and its refresh
+        tokens too with `refresh`.
+
+        :param connection: the connection of a flush, to revoke within its
+                           transaction
+        """
+        self._insert(connection, user_id=user_id, issued_before=time(), refresh=refresh,
+                     expires=time() + app.config['TOKEN_REFRESH_TTL'])
+
+    def flush(self):
+        # Nothing to refresh in a process that never checked a token.
+        if self._loaded is not None:
+            self._load()
+
+    def _load(self):
+        table = db.Model.metadata.tables['token_revocation']
+        now = time()
+        since = self._loaded - self.settle if self._loaded is not None else 0
+        # Not within an app context of its own: popping it would remove the
+        # session of the request that checks its first token.
+        with db.get_engine(self.app).connect() as connection:
+            rows = connection.execute(
+                select([table.c.id, table.c.jti, table.c.user_id, table.c.issued_before, table.c.refresh,
+                        table.c.expires])
+                .where(table.c.created >= since).where(table.c.expires > now)
+                .order_by(table.c.id)).fetchall()
+        with self._data_lock:
+            for row in rows:
+                self._apply(row.jti, row.user_id, row.issued_before, row.refresh, row.expires)
+            self._jtis = {jti: expires for jti, expires in self._jtis.items() if expires > now}
+            self._users = {user_id: cutoffs for user_id, cutoffs in self._users.items() if cutoffs[2] > now}
+            self._loaded = now
+
+    def _insert(self, connection, jti=None, user_id=None, issued_before=None, refresh=False, expires=None):
+        table = db.Model.metadata.tables['token_revocation']
+        values = {'jti': jti, 'user_id': user_id, 'issued_before': issued_before, 'refresh': refresh,
+                  'expires': expires, 'created': time()}
+        if connection is None:
+            with db.engine.begin() as connection:
+                connection.execute(table.delete().where(table.c.expires < time()))
+                connection.execute(table.insert().values(**values))
+        else:
+            connection.execute(table.insert().values(**values))
+        # Effective right away in this worker, the others see it on their
+        # next refresh.
+        with self._data_lock:
+            self._apply(jti, user_id, issued_before, refresh, expires)
+
+    def _apply(self, jti, user_id, issued_before, refresh, expires):
+        if jti:
+            self._jtis[jti] = expires
+            return
+        # Per user: the access and refresh cutoffs, and when the entry may go.
+        access_cutoff, refresh_cutoff, until = self._users.get(user_id, (0, 0, 0))
+        access_cutoff = max(access_cutoff, issued_before)
+        if refresh:
+            refresh_cutoff = max(refresh_cutoff, issued_before)
+        self._users[user_id] = (access_cutoff, refresh_cutoff, max(until, expires))
+
+
+class TokenAuth(object):
+    """
+    Stateless authentication for the JSON API.
+
+    Signing in gives a short-lived access token, valid TOKEN_ACCESS_TTL
+    seconds, and a refresh token valid TOKEN_REFRESH_TTL seconds. Access
+    tokens carry the user's id, level and admin flag, so token_required
+    views authorize a request from the signature alone: no session cookie,
+    no user loader and no query. Exchanging a refresh token reads the user
+    again, for up to date claims, and revokes it: each one is used once.
+
+    Changing a user's level or admin flag revokes its access tokens, and
+    changing its password all of its tokens, see app.models.
+    """
+
+    ALGORITHM = 'HS256'
+
+    def __init__(self, app=None):
+        self.revocations = RevocationList()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.secret = app.config['TOKEN_SECRET_KEY'] or app.config['SECRET_KEY']
+        self.access_ttl = app.config['TOKEN_ACCESS_TTL']
+        self.refresh_ttl = app.config['TOKEN_REFRESH_TTL']
+        self.revocations.init_app(app)
+
+    def issue(self, user):
+        """
+        :param user: anything with the id, level_id and is_admin of a user
+        :return: a dict with the access and refresh tokens, ready to be jsonify-ed
+        """
+        now = time()
+        access = {'typ': 'access', 'uid': user.id, 'lvl': user.level_id, 'adm': bool(user.is_admin),
+                  'iat': now, 'exp': now + self.access_ttl, 'jti': secrets.token_urlsafe(12)}
+        refresh = {'typ': 'refresh', 'uid': user.id, 'iat': now, 'exp': now + self.refresh_ttl,
+                   'jti': secrets.token_urlsafe(12)}
+        return {
+            'access_token': self._encode(access),
+            'refresh_token': self._encode(refresh),
+            'token_type': 'Bearer',
+            'expires_in': self.access_ttl,
+        }
+
+    def decode(self, token, kind='access'):
+        """
+        :return: the claims of a valid token of the given kind
+        :raise TokenError: if it is not
+        """
+        try:
+            claims = jwt.decode(token, self.secret, algorithms=[self.ALGORITHM])
+        except jwt.InvalidTokenError as e:
+            raise TokenError(str(e))
+        if claims.get('typ') != kind:
+            raise TokenError(f'Not an {kind} token' if kind == 'access' else f'Not a {kind} token')
+        if self.revocations.is_revoked(claims):
+            raise TokenError('Token has been revoked')
+        return claims
+
+    def refresh(self, token):
+        """
+        Exchanges a refresh token for a new pair.
+
+        The token is revoked before the new pair is issued, and revoking it
+        is what fails if another worker exchanged it first, so two
+        concurrent requests never both get a pair.
+
+        :raise TokenError: if the token is not valid or its user is gone
+        """
+        claims = self.decode(token, 'refresh')
+        table = db.Model.metadata.tables['user']
+        user = db.session.execute(
+            select([table.c.id, table.c.level_id, table.c.is_admin]).where(table.c.id == claims['uid'])).first()
+        if user is None:
+            raise TokenError('Unknown user')
+        if not self.revocations.revoke(claims):
+            raise TokenError('Token has been revoked')
+        return self.issue(user)
+
+    def _encode(self, claims):
+        # Note that jwt.encode() returns a byte string
+        return jwt.encode(claims, self.secret, algorithm=self.ALGORITHM).decode('utf-8')
+
+
+token_auth = TokenAuth(app)
+
+
+def bearer_token():
+    header = request.headers.get('Authorization', '')
+    scheme, _, token = header.partition(' ')
+    return token.strip() if scheme.lower() == 'bearer' else None
+
+
+def token_required(f):
+    """
+    Authorizes an API view with the access token of the Authorization header,
+    and sets g.token_identity to its TokenIdentity. Answers 401 otherwise.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        token = bearer_token()
+        if not token:
+            return _unauthorized('Missing bearer token')
+        try:
+            claims = token_auth.decode(token)
+        except TokenError as e:
+            return _unauthorized(str(e))
+        g.token_identity = TokenIdentity(claims)
+        last_seen_tracker.touch(g.token_identity.id)
+        return f(*args, **kwargs)
+    return decorated
+
+
+def _unauthorized(message):
+    response = jsonify({'error': message})
+    response.status_code = 401
+    response.headers['WWW-Authenticate'] = 'Bearer'
+    return response
@@ -0,0 +1,296 @@
+import atexit
+import os
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from sqlalchemy import bindparam
+
+from app import app, db
+from app.cache import LRUCache
+from app.sqlite import sqlite_writer
+
+
+class BackgroundFlusher(object):
+    """
+    Base class for per-worker buffers that are written back by a background
+    thread.
+
+    The thread calls flush() every `flush_interval` seconds, or earlier when
+    wake() is called, and a final flush runs when the worker shuts down.
+    Subclasses implement flush() and read their settings in init_app().
+    """
+
+    thread_name = 'flusher'
+
+    def __init__(self, app=None):
+        self.flush_interval = 30
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        atexit.register(self.shutdown)
+
+    def flush(self):
+        raise NotImplementedError
+
+    def wake(self):
+        self._wake.set()
+
+    def shutdown(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout=self.flush_interval)
+        self.flush()
+
+    def _ensure_thread(self):
+        # Gunicorn forks workers after the app may have been imported, and
+        # threads do not survive a fork, so each process starts its own.
+        if self._pid == os.getpid() and self._thread is not None:
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None:
+                return
+            self._pid = os.getpid()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+            self._thread.start()
+
+    def _execute(self, statement, rows):
+        """
+        Runs one executemany in a transaction of its own: in the group
+        commits of the SQLite single-writer mode when it is on.
+        """
+        if sqlite_writer.available():
+            sqlite_writer.run(lambda connection: connection.execute(statement, rows))
+            return
+        with self.app.app_context():
+            try:
+                db.session.execute(statement, rows)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            finally:
+                db.session.remove()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception(f'{self.thread_name} failed to flush')
+
+
+class LastSeenTracker(BackgroundFlusher):
+    """
+    Write-behind tracker for User.last_seen.
+
+    Instead of committing a write transaction on every request, the request
+    path only records the time a user was seen in an in-memory dictionary that
+    is private to the worker process. A background thread flushes the pending
+    timestamps every LAST_SEEN_FLUSH_INTERVAL seconds as one bulk UPDATE, and a
+    final flush runs when the worker shuts down.
+
+    Updates that fall inside LAST_SEEN_RESOLUTION seconds of the value already
+    known for a user (either recorded by this worker or loaded from the
+    database) are skipped entirely, since nobody needs last_seen with
+    sub-minute precision.
+
+    The values recorded are remembered after they are flushed, in a bounded
+    LRUCache, and last_seen() hands them out: the cached UserSnapshots, which
+    the bulk UPDATE does not refresh, read last_seen through it.
+    """
+
+    thread_name = 'last-seen-flusher'
+
+    def __init__(self, app=None):
+        self.resolution = timedelta(seconds=60)
+        self._pending = {}
+        self._seen = LRUCache()
+        super(LastSeenTracker, self).__init__(app)
+
+    def init_app(self, app):
+        super(LastSeenTracker, self).init_app(app)
+        self.resolution = timedelta(seconds=app.config['LAST_SEEN_RESOLUTION'])
+        self.flush_interval = app.config['LAST_SEEN_FLUSH_INTERVAL']
+        self._seen = LRUCache(maxsize=app.config['USER_CACHE_SIZE'])
+
+    def last_seen(self, user_id, loaded=None):
+        """
+        :param loaded: the value read from the database, if any
+        :return: the latest of that value and the one recorded by this worker
+        """
+        seen = self._seen.get(user_id)
+        return max(seen, loaded) if seen and loaded else seen or loaded
+
+    def touch(self, user_id, known=None):
+        """
+        Records that a user has been seen now. Never touches the database.
+
+        :param user_id: id of the user
+        :param known: the last_seen value already loaded for the user, if any
+        :return: True if the timestamp was queued, False if it was skipped
+        """
+        now = datetime.utcnow()
+        with self._lock:
+            latest = self.last_seen(user_id, known)
+            if latest is not None and now - latest < self.resolution:
+                return False
+            self._pending[user_id] = now
+            self._seen.set(user_id, now)
+        self._ensure_thread()
+        return True
+
+    def flush(self):
+        """
+        Writes every pending timestamp with a single executemany UPDATE.
+
+        :return: the number of users updated
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        table = db.Model.metadata.tables['user']
+        stmt = table.update() \
+            .where(table.c.id == bindparam('_id')) \
+            .values(last_seen=bindparam('_last_seen'))
+        rows = [{'_id': user_id, '_last_seen': seen} for user_id, seen in pending.items()]
+        try:
+            self._execute(stmt, rows)
+        except Exception:
+            # Put the timestamps back so the next flush retries them,
+            # unless a newer value arrived in the meantime.
+            with self._lock:
+                for user_id, seen in pending.items():
+                    self._pending.setdefault(user_id, seen)
+            self.app.logger.exception('Failed to flush last_seen updates')
+            return 0
+        return len(rows)
+
+
+class ActivityRecorder(BackgroundFlusher):
+    """
+    Buffered bulk writer for Activity records.
+
+    record() only appends the event to a bounded in-memory queue of the
+    worker. The background thread writes the queue with one multi-row INSERT
+    whenever ACTIVITY_FLUSH_SIZE events are waiting or ACTIVITY_FLUSH_INTERVAL
+    seconds have passed, and whatever is left is written on shutdown.
+
+    When the queue holds ACTIVITY_QUEUE_SIZE events, the ACTIVITY_OVERFLOW
+    policy applies: 'drop' discards the new event right away, while 'block'
+    makes the caller wait up to ACTIVITY_BLOCK_TIMEOUT seconds for a flush to
+    make room before dropping it.
+    """
+
+    thread_name = 'activity-flusher'
+
+    def __init__(self, app=None):
+        self.max_size = 10000
+        self.flush_size = 500
+        self.overflow = 'drop'
+        self.block_timeout = 1.0
+        self._queue = deque()
+        self._room = threading.Condition(threading.Lock())
+        self.recorded = 0
+        self.dropped = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.last_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+        super(ActivityRecorder, self).__init__(app)
+
+    def init_app(self, app):
+        super(ActivityRecorder, self).init_app(app)
+        self.max_size = app.config['ACTIVITY_QUEUE_SIZE']
+        self.flush_size = app.config['ACTIVITY_FLUSH_SIZE']
+        self.flush_interval = app.config['ACTIVITY_FLUSH_INTERVAL']
+        self.overflow = app.config['ACTIVITY_OVERFLOW']
+        self.block_timeout = app.config['ACTIVITY_BLOCK_TIMEOUT']
+
+    def record(self, user_id, notes, timestamp=None):
+        """
+        Queues an activity for the user. Never touches the database.
+
+        :return: True if the event was queued, False if it was dropped
+        """
+        row = {'user_id': user_id, 'notes': notes, 'timestamp': timestamp or datetime.utcnow()}
+        with self._room:
+            if len(self._queue) >= self.max_size and self.overflow == 'block':
+                self.wake()
+                self._room.wait_for(lambda: len(self._queue) < self.max_size, self.block_timeout)
+            if len(self._queue) >= self.max_size:
+                self.dropped += 1
+                return False
+            self._queue.append(row)
+            self.recorded += 1
+            full = len(self._queue) >= self.flush_size
+        if full:
+            self.wake()
+        self._ensure_thread()
+        return True
+
+    def flush(self):
+        """
+        Writes the queued activities in batches of ACTIVITY_FLUSH_SIZE rows.
+
+        :return: the number of activities written
+        """
+        written = 0
+        while True:
+            with self._room:
+                batch = [self._queue.popleft() for _ in range(min(self.flush_size, len(self._queue)))]
+                self._room.notify_all()
+            if not batch:
+                return written
+            started = perf_counter()
+            try:
+                self._execute(db.Model.metadata.tables['activity'].insert(), batch)
+            except Exception:
+                with self._room:
+                    self.dropped += len(batch)
+                self.app.logger.exception(f'Failed to write {len(batch)} activities')
+                return written
+            latency = perf_counter() - started
+            with self._room:
+                self.flushed += len(batch)
+                self.flushes += 1
+                self.last_flush_latency = latency
+                self.total_flush_latency += latency
+            written += len(batch)
+
+    def stats(self):
+        with self._room:
+            return {
+                'queue_depth': len(self._queue),
+                'queue_size': self.max_size,
+                'recorded': self.recorded,
+                'dropped': self.dropped,
+                'flushed': self.flushed,
+                'flushes': self.flushes,
+                'last_flush_latency': self.last_flush_latency,
+                'avg_flush_latency': self.total_flush_latency / self.flushes if self.flushes else 0.0,
+            }
+
+
+last_seen_tracker = LastSeenTracker(app)
+activity_recorder = ActivityRecorder(app)
+
+
+def record_activity(user_id, notes, timestamp=None):
+    return activity_recorder.record(user_id, notes, timestamp)
@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 
 basedir = os.path.abspath(os.path.dirname(__file__))
@@ -10,9 +11,161 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # Read-only views may read from replicas, given as comma separated URLs.
+    # A replica more than REPLICA_MAX_LAG seconds behind is skipped, and a
+    # browser that wrote something reads from the primary for the next
+    # READ_YOUR_WRITES_WINDOW seconds.
+    SQLALCHEMY_BINDS = {f'replica{i}': url for i, url in
+                        enumerate(filter(None, (os.environ.get('DATABASE_REPLICA_URLS') or '').split(',')))}
+    REPLICA_MAX_LAG         = float(os.environ.get('REPLICA_MAX_LAG') or 10)
+    REPLICA_CHECK_INTERVAL  = float(os.environ.get('REPLICA_CHECK_INTERVAL') or 2)
+    READ_YOUR_WRITES_WINDOW = float(os.environ.get('READ_YOUR_WRITES_WINDOW') or 15)
+
+    # SQLite databases run in single-writer mode (see app.sqlite): WAL, one
+    # write transaction at a time across all workers, and small transactions
+    # committed in groups of up to SQLITE_GROUP_COMMIT_SIZE.
+    SQLITE_SINGLE_WRITER      = os.environ.get('SQLITE_SINGLE_WRITER', '1') != '0'
+    SQLITE_SYNCHRONOUS        = os.environ.get('SQLITE_SYNCHRONOUS') or 'NORMAL'
+    SQLITE_BUSY_TIMEOUT       = int(os.environ.get('SQLITE_BUSY_TIMEOUT') or 5000)
+    SQLITE_CACHE_SIZE         = int(os.environ.get('SQLITE_CACHE_SIZE') or 20000)
+    SQLITE_GROUP_COMMIT_SIZE  = int(os.environ.get('SQLITE_GROUP_COMMIT_SIZE') or 200)
+    SQLITE_GROUP_COMMIT_WAIT  = float(os.environ.get('SQLITE_GROUP_COMMIT_WAIT') or 0.002)
+    SQLITE_WRITE_LOCK_TIMEOUT = float(os.environ.get('SQLITE_WRITE_LOCK_TIMEOUT') or 30)
+
+    # last_seen is kept in memory by each worker and written back in bulk.
+    # Updates closer together than the resolution are dropped.
+    LAST_SEEN_RESOLUTION     = int(os.environ.get('LAST_SEEN_RESOLUTION') or 60)
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 30)
+
+    # Activities are queued in memory by each worker and inserted in bulk once
+    # ACTIVITY_FLUSH_SIZE are waiting or every ACTIVITY_FLUSH_INTERVAL seconds.
+    # When the queue is full, ACTIVITY_OVERFLOW is either 'drop' or 'block'.
+    ACTIVITY_QUEUE_SIZE     = int(os.environ.get('ACTIVITY_QUEUE_SIZE') or 10000)
+    ACTIVITY_FLUSH_SIZE     = int(os.environ.get('ACTIVITY_FLUSH_SIZE') or 500)
+    ACTIVITY_FLUSH_INTERVAL = int(os.environ.get('ACTIVITY_FLUSH_INTERVAL') or 5)
+    ACTIVITY_OVERFLOW       = os.environ.get('ACTIVITY_OVERFLOW') or 'drop'
+    ACTIVITY_BLOCK_TIMEOUT  = float(os.environ.get('ACTIVITY_BLOCK_TIMEOUT') or 1.0)
+
+    # The activity table is partitioned by month (see app.partitions), with
+    # ACTIVITY_PARTITIONS_AHEAD months created in advance on PostgreSQL.
+    # `flask activity archive` writes the months older than
+    # ACTIVITY_RETENTION_MONTHS to ACTIVITY_ARCHIVE_DIR and drops them.
+    ACTIVITY_RETENTION_MONTHS = int(os.environ.get('ACTIVITY_RETENTION_MONTHS') or 12)
+    ACTIVITY_PARTITIONS_AHEAD = int(os.environ.get('ACTIVITY_PARTITIONS_AHEAD') or 3)
+    ACTIVITY_ARCHIVE_DIR      = os.environ.get('ACTIVITY_ARCHIVE_DIR') or os.path.join(basedir, 'archive')
+
+    # Passwords are hashed with PASSWORD_HASH_ITERATIONS rounds of PBKDF2 on a
+    # pool of PASSWORD_HASH_WORKERS threads per worker; at most
+    # PASSWORD_HASH_QUEUE more hashes may wait for it. See `flask passwords
+    # benchmark` for picking the iterations.
+    PASSWORD_HASH_ITERATIONS = int(os.environ.get('PASSWORD_HASH_ITERATIONS') or 50000)
+    PASSWORD_HASH_WORKERS    = int(os.environ.get('PASSWORD_HASH_WORKERS') or 2)
+    PASSWORD_HASH_QUEUE      = int(os.environ.get('PASSWORD_HASH_QUEUE') or 16)
+    PASSWORD_HASH_TIMEOUT    = float(os.environ.get('PASSWORD_HASH_TIMEOUT') or 10)
+
+    # Prefilter of the registered usernames and emails for the availability
+    # checks of the signup page, sized for BLOOM_CAPACITY users.
+    BLOOM_CAPACITY         = int(os.environ.get('BLOOM_CAPACITY') or 1000000)
+    BLOOM_ERROR_RATE       = float(os.environ.get('BLOOM_ERROR_RATE') or 0.01)
+    BLOOM_REFRESH_INTERVAL = int(os.environ.get('BLOOM_REFRESH_INTERVAL') or 10)
+    BLOOM_BATCH_SIZE       = int(os.environ.get('BLOOM_BATCH_SIZE') or 50000)
+
+    # How often, in seconds, a worker checks whether the levels have changed.
+    LEVEL_CATALOG_CHECK_INTERVAL = int(os.environ.get('LEVEL_CATALOG_CHECK_INTERVAL') or 5)
+
+    # JSON API tokens, see app.tokens. Revocations made by other workers are
+    # picked up every TOKEN_REVOCATION_REFRESH_INTERVAL seconds, and read
+    # again for TOKEN_REVOCATION_SETTLE seconds in case they commit late.
+    TOKEN_SECRET_KEY                  = os.environ.get('TOKEN_SECRET_KEY')
+    TOKEN_ACCESS_TTL                  = int(os.environ.get('TOKEN_ACCESS_TTL') or 300)
+    TOKEN_REFRESH_TTL                 = int(os.environ.get('TOKEN_REFRESH_TTL') or 30 * 24 * 3600)
+    TOKEN_REVOCATION_REFRESH_INTERVAL = int(os.environ.get('TOKEN_REVOCATION_REFRESH_INTERVAL') or 5)
+    TOKEN_REVOCATION_SETTLE           = int(os.environ.get('TOKEN_REVOCATION_SETTLE') or 120)
+
+    # Live dashboard updates, see app.events. When EVENTS_BROKER_SOCKET is set,
+    # workers exchange events through the broker started on it by `flask
+    # events broker`; otherwise they stay within each worker. Each stream
+    # buffers at most EVENTS_QUEUE_SIZE events and sends a keep-alive every
+    # EVENTS_HEARTBEAT seconds.
+    EVENTS_BROKER_SOCKET = os.environ.get('EVENTS_BROKER_SOCKET') or None
+    EVENTS_QUEUE_SIZE    = int(os.environ.get('EVENTS_QUEUE_SIZE') or 100)
+    EVENTS_HEARTBEAT     = float(os.environ.get('EVENTS_HEARTBEAT') or 15)
+
+    # Per-worker cache of the users loaded by Flask-Login.
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE') or 4096)
+    USER_CACHE_TTL  = int(os.environ.get('USER_CACHE_TTL') or 60)
+
+    # Per-worker cache of the rendered layout blocks, see app.fragments.
+    FRAGMENT_CACHE_ENABLED = os.environ.get('FRAGMENT_CACHE_ENABLED', '1') != '0'
+    FRAGMENT_CACHE_SIZE    = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 8192)
+    FRAGMENT_CACHE_TTL     = int(os.environ.get('FRAGMENT_CACHE_TTL') or 60)
+
+    # Bundled static assets, built by `flask assets build`, see app.assets.
+    ASSETS_BUNDLED = os.environ.get('ASSETS_BUNDLED', '1') != '0'
+    ASSETS_DIR     = os.environ.get('ASSETS_DIR') or os.path.join(basedir, 'app', 'static', 'dist')
+    ASSETS_MAX_AGE = int(os.environ.get('ASSETS_MAX_AGE') or 365 * 24 * 3600)
+
+    # Request metrics, written by every worker to METRICS_DIR and served at
+    # /metrics. Scrapers must send METRICS_TOKEN as a bearer token; while it
+    # is not set, only signed-in admins can see them.
+    METRICS_DIR            = os.environ.get('METRICS_DIR') or os.path.join(tempfile.gettempdir(), 'quickmining-metrics')
+    METRICS_FLUSH_INTERVAL = int(os.environ.get('METRICS_FLUSH_INTERVAL') or 5)
+    METRICS_TOKEN          = os.environ.get('METRICS_TOKEN')
+
+    # N+1 and slow query detection, for tests and staging: a statement shape
+    # run QUERY_REPEAT_THRESHOLD times in one request, or a statement taking
+    # SLOW_QUERY_THRESHOLD seconds, is logged and appended to QUERY_REPORT_PATH.
+    QUERY_WATCH_ENABLED    = os.environ.get('QUERY_WATCH_ENABLED') is not None
+    QUERY_REPEAT_THRESHOLD = int(os.environ.get('QUERY_REPEAT_THRESHOLD') or 5)
+    SLOW_QUERY_THRESHOLD   = float(os.environ.get('SLOW_QUERY_THRESHOLD') or 0.1)
+    QUERY_REPORT_PATH      = os.environ.get('QUERY_REPORT_PATH')
+
+    # Users are credited once per accrual period (in seconds), in chunks of
+    # ACCRUAL_CHUNK_SIZE user ids per UPDATE.
+    ACCRUAL_PERIOD     = int(os.environ.get('ACCRUAL_PERIOD') or 3600)
+    ACCRUAL_CHUNK_SIZE = int(os.environ.get('ACCRUAL_CHUNK_SIZE') or 50000)
+
+    # Maximum number of activities returned by one history page.
+    HISTORY_PAGE_SIZE = int(os.environ.get('HISTORY_PAGE_SIZE') or 50)
+
+    # Source rows folded into the dashboard rollups per transaction, the
+    # most buckets a chart may ask for, and how old (in seconds) rows must be
+    # before they are folded: longer than any transaction writing them stays
+    # open, ACTIVITY_FLUSH_INTERVAL included.
+    ROLLUP_BATCH_SIZE = int(os.environ.get('ROLLUP_BATCH_SIZE') or 100000)
+    ROLLUP_MAX_POINTS = int(os.environ.get('ROLLUP_MAX_POINTS') or 400)
+    ROLLUP_SETTLE     = int(os.environ.get('ROLLUP_SETTLE') or 120)
+
+    # Users written per transaction, and rows fetched per round trip, by the
+    # bulk imports and exports (`flask users import/export`, admin exports).
+    BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE') or 10000)
+
+    # Users checked per batch when reconciling balances with the credit ledger.
+    LEDGER_BATCH_SIZE = int(os.environ.get('LEDGER_BATCH_SIZE') or 10000)
+
     MAIL_SERVER   = os.environ.get('MAIL_SERVER')
     MAIL_PORT     = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS  = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = ['your-email@example.com']
+
+    # Logging runs on a background thread. The log file is written in batches
+    # of LOG_BATCH_SIZE records (or every LOG_BATCH_INTERVAL seconds), and an
+    # error is mailed at most once per LOG_MAIL_DEDUP_WINDOW seconds.
+    LOG_QUEUE_SIZE        = int(os.environ.get('LOG_QUEUE_SIZE') or 10000)
+    LOG_BATCH_SIZE        = int(os.environ.get('LOG_BATCH_SIZE') or 100)
+    LOG_BATCH_INTERVAL    = float(os.environ.get('LOG_BATCH_INTERVAL') or 2)
+    LOG_FILE_MAX_BYTES    = int(os.environ.get('LOG_FILE_MAX_BYTES') or 10 * 1024 * 1024)
+    LOG_MAIL_DEDUP_WINDOW = int(os.environ.get('LOG_MAIL_DEDUP_WINDOW') or 600)
+    LOG_MAIL_MAX_PER_HOUR = int(os.environ.get('LOG_MAIL_MAX_PER_HOUR') or 10)
+
+    # Mail is sent from a queue by MAIL_WORKERS background threads, each
+    # keeping its SMTP connection open until idle for MAIL_IDLE_TIMEOUT
+    # seconds. Failures are retried MAIL_MAX_RETRIES times with a backoff
+    # starting at MAIL_RETRY_DELAY seconds.
+    MAIL_WORKERS      = int(os.environ.get('MAIL_WORKERS') or 2)
+    MAIL_QUEUE_SIZE   = int(os.environ.get('MAIL_QUEUE_SIZE') or 1000)
+    MAIL_IDLE_TIMEOUT = float(os.environ.get('MAIL_IDLE_TIMEOUT') or 5)
+    MAIL_MAX_RETRIES  = int(os.environ.get('MAIL_MAX_RETRIES') or 5)
+    MAIL_RETRY_DELAY  = float(os.environ.get('MAIL_RETRY_DELAY') or 2)
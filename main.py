@@ -1,5 +1,7 @@
+import click
+
 from app import app, db
-from app.models import User, Level, Activity
+from app.models import User, Level, Activity, CreditEntry
 
 
 @app.shell_context_processor
@@ -9,6 +11,7 @@ def make_shell_context():
         'User': User,
         'Level': Level,
         'Activity': Activity,
+        'CreditEntry': CreditEntry,
     }
 
 
@@ -22,3 +25,331 @@ def routes():
         output.append(line)
     for line in sorted(output):
         print(line)
+
+
+@app.cli.command()
+@click.option('--loop', is_flag=True, help='Keep running, one tick per accrual period.')
+def accrue(loop):
+    """Credits users for the elapsed accrual periods."""
+    from time import sleep, time
+    from app.accrual import accrue, current_period
+    while True:
+        report = accrue()
+        print(f'period {report.period}: {report.users} users in {report.seconds:.2f}s '
+              f'({report.rate:.0f} users/s)')
+        if not loop:
+            break
+        length = app.config['ACCRUAL_PERIOD']
+        sleep((current_period() + 1) * length - time())
+
+
+@app.cli.command()
+def rollup():
+    """Folds new credits and activities into the dashboard rollups."""
+    from app.rollup import update_rollups
+    for source, count in update_rollups().items():
+        print(f'{source}: {count} new rows')
+
+
+@app.cli.group()
+def credits():
+    """Credit ledger commands."""
+
+
+@credits.command()
+@click.option('--fix', is_flag=True, help='Reset diverging balances to the ledger total.')
+def reconcile(fix):
+    """Compares every balance with the sum of its ledger entries."""
+    from app.ledger import reconcile
+    count = 0
+    for mismatch in reconcile(fix=fix):
+        count += 1
+        print(f'user {mismatch.user_id}: balance {mismatch.credit}, ledger {mismatch.expected}')
+    print(f'{count} mismatching balances' + (' fixed' if fix and count else ''))
+
+
+@app.cli.group()
+def passwords():
+    """Password hashing commands."""
+
+
+@passwords.command()
+@click.option('--target-ms', default=250, help='Time one verification should take.')
+def benchmark(target_ms):
+    """Measures the password hash cost on this machine."""
+    import os
+    from app.passwords import benchmark
+    current = app.config['PASSWORD_HASH_ITERATIONS']
+    seconds, per_core = benchmark(current)
+    cores = os.cpu_count() or 1
+    print(f'{current} iterations: {seconds * 1000:.1f} ms per sign-in, '
+          f'{per_core:.1f} sign-ins/s per core, {per_core * cores:.1f}/s on {cores} cores')
+    suggested = max(1000, int(current * target_ms / 1000 / seconds) // 1000 * 1000)
+    print(f'For {target_ms} ms per sign-in set PASSWORD_HASH_ITERATIONS={suggested}')
+
+
+@app.cli.group()
+def fragments():
+    """Template fragment cache commands."""
+
+
+@fragments.command('benchmark')
+@click.option('--renders', default=200, help='Number of renders of each kind.')
+@click.option('--username', default=None, help='User to render the layout for (default: the first one).')
+def benchmark_fragments(renders, username):
+    """Compares the layout render time with and without the fragment cache."""
+    from time import perf_counter
+    from flask import render_template
+    from flask_login import login_user
+    from app.fragments import fragment_cache
+    from app.models import UserSnapshot
+    user = User.query.filter_by(username=username).first() if username else User.query.first()
+    if user is None:
+        raise click.ClickException('No such user')
+    enabled = fragment_cache.enabled
+    timings = {}
+    with app.test_request_context('/'):
+        login_user(UserSnapshot(user))
+        for enabled_now in (False, True):
+            fragment_cache.enabled = enabled_now
+            fragment_cache.clear()
+            render_template('production/base.html')
+            started = perf_counter()
+            for _ in range(renders):
+                render_template('production/base.html')
+            timings[enabled_now] = (perf_counter() - started) / renders
+    fragment_cache.enabled = enabled
+    print(f'without cache: {timings[False] * 1000:.3f} ms per render')
+    print(f'with cache:    {timings[True] * 1000:.3f} ms per render '
+          f'({(1 - timings[True] / timings[False]) * 100:.0f}% saved)')
+
+
+@app.cli.group()
+def assets():
+    """Static asset bundle commands."""
+
+
+@assets.command('build')
+@click.option('--allow-missing', is_flag=True, help='Leave out referenced files that do not exist.')
+def build_assets(allow_missing):
+    """Bundles, hashes and precompresses the assets referenced by the templates."""
+    from app.assets import assets, MissingAssets
+    print(f'Building bundles into {assets.directory}')
+    try:
+        manifest = assets.build(allow_missing=allow_missing)
+    except MissingAssets as e:
+        for name, filename in e.missing:
+            print(f'  {name}: missing {filename}')
+        raise click.ClickException(f'{len(e.missing)} referenced files are missing, '
+                                   f'nothing was built (use --allow-missing to skip them)')
+    files = sum(len(files) for files in assets.trace().values())
+    print(f'{len(manifest)} bundles replace {files} static references')
+
+
+@app.cli.group()
+def queries():
+    """SQL query inspection commands."""
+
+
+@queries.command('check')
+@click.option('--username', default=None, help='User to sign in as (default: the first admin).')
+def check_queries(username):
+    """Requests every page without URL arguments and reports its statements."""
+    from app.querywatch import query_watch
+    user = User.query.filter_by(username=username).first() if username \
+        else User.query.filter_by(is_admin=True).first()
+    if user is None:
+        raise click.ClickException('No such user')
+    client = app.test_client()
+    with client.session_transaction() as session:
+        # Flask-Login 0.4 keeps the id under 'user_id', later versions under '_user_id'.
+        session['user_id'] = session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+    rules = sorted(rule.rule for rule in app.url_map.iter_rules()
+                   if 'GET' in rule.methods and not rule.arguments
+                   and rule.endpoint not in ('logout', 'export_metrics'))
+    total = 0
+    for rule in rules:
+        with query_watch.recording(query_watch.slow_threshold) as recorder:
+            response = client.get(rule)
+        findings = query_watch.report(rule, recorder)
+        total += len(findings)
+        print(f'{rule} [{response.status_code}] {recorder.summary(limit=3)}')
+        for finding in findings:
+            print(f'  !! {finding["kind"]}: {finding["statement"]}')
+    print(f'{total} findings')
+
+
+@app.cli.group()
+def bench():
+    """Load and latency benchmark commands."""
+
+
+@bench.command('seed')
+@click.option('--users', default=10000, help='Number of benchmark users to create.')
+@click.option('--activities', default=1000, help='Activities of the benchmark user.')
+@click.option('--reset', is_flag=True, help='Delete the benchmark users of a previous seed first.')
+def bench_seed(users, activities, reset):
+    """Fills the database with benchmark users."""
+    from app.bench import seed, unseed, BENCH_PREFIX
+    if reset:
+        unseed()
+    elif User.query.filter_by(username=f'{BENCH_PREFIX}0').first() is not None:
+        raise click.ClickException('The database is already seeded, use --reset to start over')
+    seed(users, activities)
+
+
+@bench.command('run')
+@click.option('--scenario', '-s', 'scenarios', multiple=True, help='Scenario to run (default: all).')
+@click.option('--requests', default=200, help='Timed requests per scenario.')
+@click.option('--concurrency', default=1, help='Concurrent sessions.')
+@click.option('--warmup', default=10, help='Untimed requests per scenario.')
+@click.option('--url', default=None, help='Benchmark a running server (e.g. a local gunicorn) instead of the test client.')
+@click.option('--output', '-o', type=click.Path(), default=None, help='Write the results to this JSON file.')
+def bench_run(scenarios, requests, concurrency, warmup, url, output):
+    """Measures throughput and latency percentiles of the main pages."""
+    import json
+    from app.bench import run, SCENARIOS
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise click.BadParameter(f'unknown scenario {", ".join(sorted(unknown))}, '
+                                 f'choose from {", ".join(SCENARIOS)}', param_hint='--scenario')
+    results = run(scenarios or list(SCENARIOS), requests, concurrency, warmup, url)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Results written to {output}')
+
+
+@bench.command('compare')
+@click.argument('baseline', type=click.File())
+@click.argument('current', type=click.File())
+@click.option('--threshold', default=10.0, help='Percentage beyond which a change is a regression.')
+def bench_compare(baseline, current, threshold):
+    """Flags the regressions between two `flask bench run` results."""
+    import json
+    from app.bench import compare
+    rows = compare(json.load(baseline), json.load(current), threshold / 100)
+    for name, metric, before, after, change, regressed in rows:
+        print(f'{name:14s} {metric:10s} {before:10.2f} -> {after:10.2f}  {change * 100:+7.1f}%'
+              + ('  REGRESSION' if regressed else ''))
+    regressions = sum(1 for row in rows if row[-1])
+    print(f'{regressions} regressions')
+    if regressions:
+        raise SystemExit(1)
+
+
+@app.cli.group()
+def sqlite():
+    """SQLite deployment commands."""
+
+
+@sqlite.command('benchmark')
+@click.option('--processes', default=4, help='Writer processes, like gunicorn workers.')
+@click.option('--threads', default=4, help='Threads per process.')
+@click.option('--writes', default=100, help='Transactions per thread.')
+def benchmark_sqlite(processes, threads, writes):
+    """Compares write throughput with and without single-writer mode."""
+    from app.sqlite import benchmark
+    for single_writer in (False, True):
+        rate, errors = benchmark(processes, threads, writes, single_writer)
+        mode = 'single writer' if single_writer else 'default'
+        print(f'{mode:14s} {rate:8.0f} transactions/s, {len(errors)} failed'
+              + (f' ({errors[0]})' if errors else ''))
+
+
+@app.cli.group()
+def activity():
+    """Activity partitioning and archival commands."""
+
+
+@activity.command('partition')
+def partition_activity():
+    """Creates the upcoming monthly partitions (PostgreSQL) or moves past months to theirs (SQLite)."""
+    from app.partitions import partitions, create_partitions, move_closed_months
+    with db.engine.connect() as connection:
+        if connection.dialect.name == 'postgresql':
+            for name in create_partitions(connection):
+                print(f'created {name}')
+        else:
+            for name, count in move_closed_months(connection):
+                print(f'{name}: {count} rows moved')
+        print(f'{len(partitions(connection))} partitions')
+
+
+@activity.command('archive')
+@click.option('--keep-months', type=int, default=None, help='Months to keep (default: ACTIVITY_RETENTION_MONTHS).')
+@click.option('--dry-run', is_flag=True, help='Only list the partitions that would be archived.')
+def archive_activity(keep_months, dry_run):
+    """Archives the partitions past the retention period to compressed files and drops them."""
+    from time import perf_counter
+    from app.partitions import expired, archive, move_closed_months
+    with db.engine.connect() as connection:
+        if connection.dialect.name == 'sqlite' and not dry_run:
+            move_closed_months(connection)
+        for month, name in expired(connection, keep_months):
+            if dry_run:
+                print(f'would archive {name}')
+                continue
+            started = perf_counter()
+            count, path = archive(connection, name)
+            print(f'{name}: {count} rows archived to {path} in {perf_counter() - started:.1f}s')
+
+
+@app.cli.group()
+def users():
+    """Bulk user import and export commands."""
+
+
+@users.command('import')
+@click.argument('path')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default=None,
+              help='Input format (default: after the file extension).')
+@click.option('--chunk-size', type=int, default=None, help='Users per transaction (default: BULK_CHUNK_SIZE).')
+@click.option('--hash-workers', type=int, default=None, help='Processes hashing plain text passwords.')
+def users_import(path, fmt, chunk_size, hash_workers):
+    """Creates users from a CSV or JSON lines file (- for stdin, *.gz gzipped)."""
+    from app.bulk import import_users, read_records, open_file, format_of
+    with open_file(path, 'r') as f:
+        report = import_users(read_records(f, format_of(path, fmt)), chunk_size, hash_workers)
+    print(f'{report.inserted} users created, {report.skipped} already taken, {report.invalid} invalid '
+          f'({report.rate:.0f} rows/s)')
+
+
+@users.command('export')
+@click.argument('path')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default=None,
+              help='Output format (default: after the file extension).')
+def users_export(path, fmt):
+    """Writes all the users to a CSV or JSON lines file (- for stdout, *.gz gzipped)."""
+    from time import perf_counter
+    from app.bulk import export_users, open_file, format_of
+
+    def log(line):
+        click.echo(line, err=True)
+
+    started = perf_counter()
+    with open_file(path, 'w') as f:
+        count = export_users(f, format_of(path, fmt), log=log)
+    elapsed = perf_counter() - started
+    log(f'{count} users exported in {elapsed:.1f}s ({count / max(elapsed, 1e-6):.0f} rows/s)')
+
+
+@app.cli.group()
+def events():
+    """Live update commands."""
+
+
+@events.command('broker')
+def events_broker():
+    """Relays the live update events between the workers of this machine."""
+    from app.events import Broker
+    path = app.config['EVENTS_BROKER_SOCKET']
+    if not path:
+        raise click.ClickException('EVENTS_BROKER_SOCKET is not set')
+    server = Broker(path)
+    print(f'Relaying events on {path}')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
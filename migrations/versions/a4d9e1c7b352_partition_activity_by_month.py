@@ -0,0 +1,102 @@
+"""partition activity by month
+
+Revision ID: a4d9e1c7b352
+Revises: f3a8c2d1b7e4
+Create Date: 2018-03-14 09:12:44.530871
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d9e1c7b352'
+down_revision = 'f3a8c2d1b7e4'
+branch_labels = None
+depends_on = None
+
+# Months created in advance, keep in line with ACTIVITY_PARTITIONS_AHEAD.
+AHEAD = 3
+
+
+def _months(first, last):
+    month = datetime(first.year, first.month, 1)
+    while month <= last:
+        following = datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+        yield month, following
+        month = following
+
+
+def upgrade():
+    # On PostgreSQL (11 or later) activity becomes a table partitioned by
+    # range of timestamp, with one partition per month and a default one for
+    # anything outside them. SQLite has no partitioning: app.partitions
+    # moves past months to tables of their own instead, so nothing changes.
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return
+
+    op.execute('ALTER TABLE activity RENAME TO activity_unpartitioned')
+    op.execute('ALTER INDEX ix_activity_timestamp RENAME TO ix_activity_unpartitioned_timestamp')
+    op.execute('ALTER INDEX ix_activity_user_id_timestamp_id RENAME TO ix_activity_unpartitioned_user_id_timestamp_id')
+    op.execute('ALTER TABLE activity_unpartitioned RENAME CONSTRAINT activity_pkey TO activity_unpartitioned_pkey')
+    # The partition key has to be part of the primary key, and not null.
+    op.execute('''
+        CREATE TABLE activity (
+            id INTEGER NOT NULL DEFAULT nextval('activity_id_seq'),
+            user_id INTEGER REFERENCES "user" (id),
+            timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            notes TEXT,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)
+    ''')
+    op.execute('ALTER SEQUENCE activity_id_seq OWNED BY activity.id')
+    op.create_index('ix_activity_timestamp', 'activity', ['timestamp'], unique=False)
+    op.create_index('ix_activity_user_id_timestamp_id', 'activity', ['user_id', 'timestamp', 'id'], unique=False)
+    op.execute('CREATE TABLE activity_default PARTITION OF activity DEFAULT')
+
+    now = datetime.utcnow()
+    first = bind.execute('SELECT min(timestamp) FROM activity_unpartitioned').scalar() or now
+    last = datetime(now.year + (now.month + AHEAD - 1) // 12, (now.month + AHEAD - 1) % 12 + 1, 1)
+    for month, following in _months(first, last):
+        op.execute(f"CREATE TABLE activity_{month:%Y_%m} PARTITION OF activity "
+                   f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{following:%Y-%m-%d}')")
+
+    op.execute('INSERT INTO activity (id, user_id, timestamp, notes) '
+               'SELECT id, user_id, COALESCE(timestamp, now()), notes FROM activity_unpartitioned')
+    op.execute('DROP TABLE activity_unpartitioned')
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        # Put the months moved out by app.partitions back.
+        names = [name for name, in bind.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'activity!_%' ESCAPE '!'")
+            if name[len('activity_'):].replace('_', '').isdigit()]
+        for name in names:
+            op.execute(f'INSERT INTO activity (id, user_id, timestamp, notes) '
+                       f'SELECT id, user_id, timestamp, notes FROM {name}')
+            op.drop_table(name)
+        return
+
+    op.execute('ALTER TABLE activity RENAME TO activity_partitioned')
+    op.execute('ALTER INDEX ix_activity_timestamp RENAME TO ix_activity_partitioned_timestamp')
+    op.execute('ALTER INDEX ix_activity_user_id_timestamp_id RENAME TO ix_activity_partitioned_user_id_timestamp_id')
+    op.execute('ALTER TABLE activity_partitioned RENAME CONSTRAINT activity_pkey TO activity_partitioned_pkey')
+    op.create_table('activity',
+    sa.Column('id', sa.Integer(), server_default=sa.text("nextval('activity_id_seq')"), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.Column('notes', sa.Text(), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.execute('ALTER SEQUENCE activity_id_seq OWNED BY activity.id')
+    op.execute('INSERT INTO activity (id, user_id, timestamp, notes) '
+               'SELECT id, user_id, timestamp, notes FROM activity_partitioned')
+    op.execute('DROP TABLE activity_partitioned')
+    op.create_index('ix_activity_timestamp', 'activity', ['timestamp'], unique=False)
+    op.create_index('ix_activity_user_id_timestamp_id', 'activity', ['user_id', 'timestamp', 'id'], unique=False)
@@ -0,0 +1,28 @@
+"""add unique accrual entry index
+
+Revision ID: c3f7a2e9d461
+Revises: b6e2f9a4c813
+Create Date: 2018-03-16 10:41:05.218734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3f7a2e9d461'
+down_revision = 'b6e2f9a4c813'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # One accrual entry per user and period: a second, concurrent run of the
+    # same tick fails instead of crediting twice.
+    op.create_index('uq_credit_entry_user_id_accrual', 'credit_entry', ['user_id', 'reason'], unique=True,
+                    postgresql_where=sa.text("reason LIKE 'accrual %'"),
+                    sqlite_where=sa.text("reason LIKE 'accrual %'"))
+
+
+def downgrade():
+    op.drop_index('uq_credit_entry_user_id_accrual', table_name='credit_entry')
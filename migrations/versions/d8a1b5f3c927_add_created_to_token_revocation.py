@@ -0,0 +1,34 @@
+"""add created to token_revocation, unique jti
+
+Revision ID: d8a1b5f3c927
+Revises: c3f7a2e9d461
+Create Date: 2018-03-17 11:05:37.912046
+
+"""
+from time import time
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd8a1b5f3c927'
+down_revision = 'c3f7a2e9d461'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('token_revocation') as batch_op:
+        batch_op.add_column(sa.Column('created', sa.Float(), nullable=True))
+        batch_op.create_unique_constraint('uq_token_revocation_jti', ['jti'])
+    op.create_index(op.f('ix_token_revocation_created'), 'token_revocation', ['created'], unique=False)
+    # Existing rows count as created now, so that every worker reads them.
+    op.execute(sa.text('UPDATE token_revocation SET created = :now').bindparams(now=time()))
+
+
+def downgrade():
+    op.drop_index(op.f('ix_token_revocation_created'), table_name='token_revocation')
+    with op.batch_alter_table('token_revocation') as batch_op:
+        batch_op.drop_constraint('uq_token_revocation_jti', type_='unique')
+        batch_op.drop_column('created')
@@ -0,0 +1,85 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+import pytest
+
+# The configuration is read when the app package is imported, so the tests
+# get a database and metrics directory of their own before that.
+TEST_DIR = tempfile.mkdtemp(prefix='quickmining-tests-')
+# Registered first so it runs last, after the flushes the app registers.
+atexit.register(shutil.rmtree, TEST_DIR, True)
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(TEST_DIR, 'test.db')
+os.environ['METRICS_DIR'] = os.path.join(TEST_DIR, 'metrics')
+os.environ['PASSWORD_HASH_ITERATIONS'] = '1000'
+os.environ['ASSETS_BUNDLED'] = '0'
+for name in ('DATABASE_REPLICA_URLS', 'EVENTS_BROKER_SOCKET', 'MAIL_SERVER', 'QUERY_WATCH_ENABLED'):
+    os.environ.pop(name, None)
+
+from app import app as flask_app, db as _db  # noqa: E402
+from app.catalog import level_catalog  # noqa: E402
+from app.fragments import fragment_cache  # noqa: E402
+from app.models import User, Level, user_cache  # noqa: E402
+from app.tracking import last_seen_tracker  # noqa: E402
+
+PASSWORD = 'correct horse'
+
+
+@pytest.fixture(scope='session')
+def app():
+    flask_app.config['TESTING'] = True
+    flask_app.config['WTF_CSRF_ENABLED'] = False
+    # Created once: the background flushes of the app keep running between
+    # the tests and would fail on missing tables.
+    _db.create_all()
+    return flask_app
+
+
+@pytest.fixture
+def db(app):
+    """The database with two levels, emptied again after the test."""
+    _db.session.add(Level(id=1, title='Basic', hash_rate=11, earning_rate=5, profit_rate=1,
+                          affiliate_bonus=0.04, price=10, credit=0))
+    _db.session.add(Level(id=2, title='Standard', hash_rate=97, earning_rate=20, profit_rate=2,
+                          affiliate_bonus=0.06, price=20, credit=0))
+    _db.session.commit()
+    yield _db
+    _db.session.remove()
+    last_seen_tracker.flush()
+    for table in reversed(_db.metadata.sorted_tables):
+        _db.session.execute(table.delete())
+    _db.session.commit()
+    # The per-worker caches would outlive the rows they were filled from.
+    user_cache.clear()
+    fragment_cache.clear()
+    level_catalog.expire()
+
+
+@pytest.fixture
+def make_user(db):
+    def make_user(username, **fields):
+        user = User(username=username, email=f'{username}@example.com', **fields)
+        user.set_password(PASSWORD)
+        db.session.add(user)
+        db.session.commit()
+        return user
+    return make_user
+
+
+@pytest.fixture
+def admin(make_user):
+    return make_user('admin', is_admin=True)
+
+
+@pytest.fixture
+def client(app, db):
+    return app.test_client()
+
+
+@pytest.fixture
+def signed_in(client, admin):
+    """A test client signed in as the admin."""
+    response = client.post('/signin', data={'username': admin.username, 'password': PASSWORD})
+    assert response.status_code == 302
+    return client
@@ -0,0 +1,37 @@
+from app.accrual import accrue
+from app.models import User, CreditEntry
+
+
+def balances(db):
+    return {user.username: (user.credit, user.accrued_period) for user in db.session.query(User)}
+
+
+def test_accrue_is_idempotent(db, make_user):
+    make_user('basic')
+    make_user('standard', level_id=2)
+
+    assert accrue(period=100).users == 2
+    assert accrue(period=100).users == 0
+    # Users never accrued before get a single period.
+    assert balances(db) == {'basic': (55, 100), 'standard': (1940, 100)}
+    assert db.session.query(CreditEntry).filter_by(reason='accrual 100').count() == 2
+
+
+def test_accrue_catches_up_missed_periods(db, make_user):
+    make_user('basic')
+    accrue(period=100)
+    assert accrue(period=103).users == 1
+    assert balances(db) == {'basic': (55 + 3 * 55, 103)}
+
+
+def test_accrue_advances_users_without_a_level(db, make_user):
+    orphan = make_user('orphan')
+    orphan.level_id = None
+    db.session.commit()
+    make_user('lost').level_id = 99
+    db.session.commit()
+
+    assert accrue(period=100).users == 2
+    assert accrue(period=101).users == 2
+    assert balances(db) == {'orphan': (0, 101), 'lost': (0, 101)}
+    assert db.session.query(CreditEntry).count() == 0
@@ -0,0 +1,43 @@
+import pytest
+
+from tests.conftest import PASSWORD
+
+
+@pytest.fixture
+def users(admin, make_user):
+    names = [None, 'Ann', None, 'Bob', 'Ann', None, 'Cid']
+    users = [admin] + [make_user(f'user{i}', display_name=name) for i, name in enumerate(names)]
+    # Read now: the requests end the session the rows were loaded in.
+    return [(user.id, user.display_name) for user in users]
+
+
+def pages(client, column, direction, length=2):
+    ids, cursor = [], None
+    while True:
+        query = f'/admin/users.json?draw=1&length={length}&order[0][column]={column}&order[0][dir]={direction}'
+        page = client.get(query + (f'&cursor={cursor}' if cursor else '')).get_json()
+        ids += [row['id'] for row in page['data']]
+        cursor = page['cursor']
+        if cursor is None:
+            return ids
+
+
+@pytest.mark.parametrize('direction', ['asc', 'desc'])
+def test_keyset_pages_cross_nulls(signed_in, users, direction):
+    # SQLite sorts NULLs first, the primary key breaks ties.
+    expected = [id for id, name in sorted(
+        users, key=lambda user: (user[1] is not None, user[1] or '', user[0]), reverse=direction == 'desc')]
+    assert pages(signed_in, 2, direction) == expected
+    assert pages(signed_in, 2, direction, length=3) == expected
+
+
+def test_keyset_pages_on_primary_key(signed_in, users):
+    assert pages(signed_in, 0, 'desc') == sorted((id for id, name in users), reverse=True)
+
+
+@pytest.mark.parametrize('path', ['/admin', '/admin/users.json', '/admin/contracts.json'])
+def test_admin_pages_need_an_admin(client, make_user, path):
+    assert client.get(path).status_code == 302
+    make_user('miner')
+    client.post('/signin', data={'username': 'miner', 'password': PASSWORD})
+    assert client.get(path).status_code == 403
@@ -0,0 +1,27 @@
+import pytest
+
+from app import app as flask_app
+from app.email import send_mail, mail_queue
+from app.smtpsink import SMTPSink
+
+
+@pytest.fixture
+def sink(monkeypatch):
+    sink = SMTPSink(('localhost', 0)).start()
+    # Flask-Mail reads its settings when the app is created.
+    state = flask_app.extensions['mail']
+    monkeypatch.setattr(state, 'server', 'localhost')
+    monkeypatch.setattr(state, 'port', sink.server_address[1])
+    monkeypatch.setattr(state, 'suppress', False)
+    yield sink
+    sink.stop()
+
+
+def test_mail_is_sent_from_the_queue(sink):
+    for i in range(3):
+        send_mail(f'Message {i}', sender='no-reply@example.com', recipients=['miner@example.com'],
+                  body_text=f'Hello {i}', body_html=f'<p>Hello {i}</p>')
+    mail_queue.join()
+    assert sorted(message['Subject'] for message in sink.messages) == ['Message 0', 'Message 1', 'Message 2']
+    # The worker threads reuse their connection.
+    assert sink.connections <= mail_queue.workers
@@ -0,0 +1,37 @@
+import json
+import os
+
+from app.metrics import metrics
+
+DEAD_PID = 999999999
+
+
+def test_metrics_need_an_admin_without_a_token(client, signed_in):
+    assert signed_in.get('/metrics').status_code == 200
+    client.get('/logout')
+    assert client.get('/metrics').status_code == 403
+
+
+def test_metrics_need_the_token(app, client, monkeypatch):
+    monkeypatch.setitem(app.config, 'METRICS_TOKEN', 'scraper')
+    assert client.get('/metrics').status_code == 403
+    assert client.get('/metrics', headers={'Authorization': 'Bearer nope'}).status_code == 403
+    assert client.get('/metrics', headers={'Authorization': 'Bearer scraper'}).status_code == 200
+
+
+def write_snapshot(pid, requests):
+    with open(os.path.join(metrics.directory, f'{pid}.json'), 'w') as f:
+        json.dump({'counters': [['http_requests_total', [['endpoint', 'gone']], requests]],
+                   'histograms': []}, f)
+
+
+def test_exited_workers_are_retired(signed_in):
+    signed_in.get('/home')
+    write_snapshot(DEAD_PID, 3)
+    metrics.flush()
+    assert not os.path.exists(os.path.join(metrics.directory, f'{DEAD_PID}.json'))
+    assert os.path.exists(os.path.join(metrics.directory, f'{os.getpid()}.json'))
+
+    write_snapshot(DEAD_PID, 4)
+    assert 'http_requests_total{endpoint="gone"} 7' in metrics.render()
+    assert sorted(os.listdir(metrics.directory)) == [f'{os.getpid()}.json', 'retire.lock', 'retired.json']
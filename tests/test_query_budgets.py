@@ -0,0 +1,43 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.models import Activity
+from app.querywatch import query_budget
+
+
+@pytest.fixture
+def history(db, admin, make_user):
+    for i in range(5):
+        make_user(f'miner{i}', display_name=None if i % 2 else f'Miner {i}')
+    now = datetime.utcnow()
+    db.session.add_all(Activity(user_id=admin.id, timestamp=now - timedelta(minutes=i), notes=f'activity {i}')
+                       for i in range(30))
+    db.session.commit()
+
+
+@pytest.mark.parametrize('path', ['/home', '/history', '/admin'])
+def test_page_budget(signed_in, history, path):
+    # The user, the level catalog version and the levels; nothing per row.
+    with query_budget(3, max_repeats=1):
+        assert signed_in.get(path).status_code == 200
+    # Then the cached user snapshot, catalog and layout fragments serve it.
+    with query_budget(0):
+        assert signed_in.get(path).status_code == 200
+
+
+def test_history_page_budget(signed_in, history):
+    signed_in.get('/home')
+    with query_budget(2, max_repeats=1):
+        page = signed_in.get('/history/activities.json?limit=10').get_json()
+    with query_budget(2, max_repeats=1):
+        signed_in.get(f'/history/activities.json?limit=10&cursor={page["cursor"]}')
+
+
+def test_admin_users_budget(signed_in, history):
+    signed_in.get('/home')
+    with query_budget(2, max_repeats=1):
+        page = signed_in.get('/admin/users.json?draw=1&length=3').get_json()
+    # The counts are cached, the next page is a single seek.
+    with query_budget(1):
+        signed_in.get(f'/admin/users.json?draw=2&length=3&cursor={page["cursor"]}')
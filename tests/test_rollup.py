@@ -0,0 +1,37 @@
+from datetime import datetime, timedelta
+
+from app.models import CreditEntry, Activity, Rollup
+from app.rollup import update_rollups, truncate, _horizon
+
+
+def test_rows_are_counted_once(db, admin):
+    now = datetime.utcnow()
+    db.session.add_all([CreditEntry(user_id=admin.id, delta=10, reason='bonus', timestamp=now),
+                        CreditEntry(user_id=admin.id, delta=5, reason='bonus', timestamp=now),
+                        Activity(user_id=admin.id, timestamp=now, notes='signed in')])
+    db.session.commit()
+    update_rollups(settle=0)
+    update_rollups(settle=0)
+    db.session.add(CreditEntry(user_id=admin.id, delta=1, reason='bonus', timestamp=now))
+    db.session.commit()
+    update_rollups(settle=0)
+
+    hour = Rollup.query.filter_by(granularity='hour', user_id=admin.id, bucket=truncate(now, 'hour')).one()
+    assert (hour.credits, hour.activities) == (16, 1)
+    total = Rollup.query.filter_by(granularity='day', user_id=Rollup.GLOBAL, bucket=truncate(now, 'day')).one()
+    assert (total.credits, total.activities) == (16, 1)
+
+
+def test_horizon_leaves_unsettled_rows(db, admin, monkeypatch):
+    now = datetime.utcnow()
+    settled = CreditEntry(user_id=admin.id, delta=1, reason='bonus', timestamp=now - timedelta(minutes=10))
+    recent = CreditEntry(user_id=admin.id, delta=1, reason='bonus', timestamp=now)
+    db.session.add_all([settled, recent])
+    db.session.commit()
+    table = CreditEntry.__table__
+
+    # SQLite commits in id order, so everything is settled there.
+    assert _horizon(table, settle=120) == recent.id
+    monkeypatch.setattr(db.engine.dialect, 'name', 'postgresql')
+    assert _horizon(table, settle=120) == settled.id
+    assert _horizon(table, settle=0) == recent.id
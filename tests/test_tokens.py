@@ -0,0 +1,45 @@
+import pytest
+
+from app.models import User
+from app.tokens import token_auth, RevocationList
+from tests.conftest import PASSWORD
+
+
+@pytest.fixture
+def tokens(client, admin):
+    response = client.post('/api/tokens', json={'username': admin.username, 'password': PASSWORD})
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def bearer(token):
+    return {'Authorization': 'Bearer ' + token}
+
+
+def test_refresh_token_is_single_use(client, tokens):
+    assert client.post('/api/tokens/refresh', json={'refresh_token': tokens['refresh_token']}).status_code == 200
+    response = client.post('/api/tokens/refresh', json={'refresh_token': tokens['refresh_token']})
+    assert response.status_code == 401
+    assert response.get_json() == {'error': 'Token has been revoked'}
+
+
+def test_revoke_signs_out(app, client, tokens):
+    claims = token_auth.decode(tokens['access_token'])
+    headers = bearer(tokens['access_token'])
+    assert client.get('/api/history/activities.json', headers=headers).status_code == 200
+    response = client.post('/api/tokens/revoke', headers=headers, json={'refresh_token': tokens['refresh_token']})
+    assert response.get_json() == {'revoked': True}
+
+    assert client.get('/api/history/activities.json', headers=headers).status_code == 401
+    assert client.post('/api/tokens/refresh', json={'refresh_token': tokens['refresh_token']}).status_code == 401
+    # Another worker loads the revocation from the database.
+    assert RevocationList(app).is_revoked(claims)
+
+
+def test_level_change_revokes_access_tokens_only(app, db, client, admin, tokens):
+    with app.app_context():
+        db.session.query(User).get(token_auth.decode(tokens['access_token'])['uid']).modify_level(2)
+    assert client.get('/api/history/activities.json', headers=bearer(tokens['access_token'])).status_code == 401
+    response = client.post('/api/tokens/refresh', json={'refresh_token': tokens['refresh_token']})
+    assert response.status_code == 200
+    assert token_auth.decode(response.get_json()['access_token'])['lvl'] == 2